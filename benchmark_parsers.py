@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import extract
+import transform
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+
+def load_sample_hands(path, max_hands=None):
+    """Read the raw hands of all files below path, at most max_hands."""
+    hands = []
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            for hand, _ in extract.iter_raw_hands(os.path.join(root, filename)):
+                hands.append(hand)
+                if max_hands and len(hands) >= max_hands:
+                    return hands
+    return hands
+
+
+def available_backends():
+    backends = []
+    for backend in transform.PARSER_BACKENDS:
+        try:
+            transform.get_parser(backend)
+            backends.append(backend)
+        except ImportError:
+            logger.info(f'Parser backend {backend} is not installed, skipping it.')
+    return backends
+
+
+def compare_backends(hands, backends=None):
+    """
+    Parse the hands with every backend and compare the results with the first one.
+
+    :return: dict of backend -> number of hands with a different ParsedHand
+    """
+    backends = backends or available_backends()
+    reference = [transform.parse_hand(hand, backends[0]) for hand in hands]
+    differences = {}
+    for backend in backends[1:]:
+        parse = transform.get_parser(backend)
+        differences[backend] = sum(parse(hand) != parsed for hand, parsed in zip(hands, reference))
+    return differences
+
+
+def benchmark_parsers(hands, backends=None, repeat=3):
+    """
+    Measure the parsing speed of the backends, the best of repeat runs over all hands.
+
+    :return: dict of backend -> hands per second
+    """
+    backends = backends or available_backends()
+    hands_per_second = {}
+    for backend in backends:
+        parse = transform.get_parser(backend)
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for hand in hands:
+                parse(hand)
+            seconds = time.perf_counter() - start_time
+            best = seconds if best is None else min(best, seconds)
+        hands_per_second[backend] = len(hands) / best if best else 0.0
+    return hands_per_second
+
+
+if __name__ == '__main__':
+    # python benchmark_parsers.py <folder with handhistories> [max hands]
+    sample_hands = load_sample_hands(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print(f'{len(sample_hands)} hands')
+    for backend, n_different in compare_backends(sample_hands).items():
+        print(f'{backend}: {n_different} hands differ from {transform.DEFAULT_PARSER_BACKEND}')
+    for backend, rate in benchmark_parsers(sample_hands).items():
+        print(f'{backend}: {rate:.0f} hands/s')
@@ -1,14 +1,133 @@
+import numbers
+import operator
+from collections import deque
+from functools import partial
+from itertools import chain, groupby
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
-import xml.etree.ElementTree as ET
+from sqlalchemy import text
 from my_logger import CustomLogger
-from poker_metrics import euro_to_float
+import transform
 import load
+import stat_plugins
 
 
 
 logger = CustomLogger(__name__).get_logger()
 
+# preflop action types which count for VPIP and PFR
+VPIP_ACTION_TYPES = stat_plugins.VPIP_ACTION_TYPES
+PFR_ACTION_TYPES = stat_plugins.PFR_ACTION_TYPES
+
+# first preflop action of every player in every hand, {hand_filter} restricts the hands (see hand_filter),
+# {cell_columns} and {cell_join} add the cube cell of the hand (see cell_query_parts)
+FIRST_PREFLOP_ACTIONS_TEMPLATE = """
+    SELECT a.player_id, a.action_type{cell_columns}
+    FROM actions AS a
+    JOIN (SELECT hand_id, player_id, MIN(action_no) AS action_no
+          FROM actions WHERE round_no = 1{hand_filter} GROUP BY hand_id, player_id) AS f
+        ON a.hand_id = f.hand_id AND a.action_no = f.action_no{cell_join}
+"""
+# every player who acted on the flop and if he won the hand, the flop actions are found by ix_actions_round so
+# only the hand_players rows of the flop players are read instead of all of them
+PLAYERS_ON_FLOP_TEMPLATE = """
+    SELECT hp.player_id, hp.win > 0 AS won_hand{cell_columns}
+    FROM (SELECT DISTINCT hand_id, player_id FROM actions WHERE round_no = 2{hand_filter}) AS f
+    JOIN hand_players AS hp ON hp.hand_id = f.hand_id AND hp.player_id = f.player_id{cell_join}
+"""
+# the players of every hand with their actions for the walk of the stat plugins, one row per action (one row
+# without action for players who had none), ordered by hand
+HAND_ACTIONS_TEMPLATE = """
+    SELECT hp.hand_id, hp.player_id, hp.player_no, hp.win, a.action_no, a.round_no, a.action_type,
+        a.amount{cell_columns}
+    FROM hand_players AS hp
+    LEFT JOIN actions AS a ON a.hand_id = hp.hand_id AND a.player_id = hp.player_id{cell_join}
+    WHERE hp.hand_id IS NOT NULL{hand_filter}
+    ORDER BY hp.hand_id
+"""
+# hands ingested before the actions and hand_players tables existed
+HANDS_WITHOUT_TABLES_CONDITION = "NOT EXISTS (SELECT 1 FROM hand_players AS hp WHERE hp.hand_id = hh.hand_id)"
+# the hands which are counted in the player_stats at the watermark :ingest_id, and the ones ingested after it
+STATS_WATERMARK = 'player_stats'
+COUNTED_HANDS_CONDITION = "hh.ingest_id IS NULL OR hh.ingest_id <= :ingest_id"
+NEW_HANDS_CONDITION = "hh.ingest_id > :last_ingest_id AND hh.ingest_id <= :ingest_id"
+# the counters of count_raw_data -> their columns in player_stats
+COUNTER_COLUMNS = {'hands': 'hands', 'vpip': 'vpip_count', 'pfr': 'pfr_count', 'saw_flop': 'saw_flop',
+                   'won_hand': 'won_at_showdown_or_flop'}
+# the stat plugins of the stored stats and their counters besides the core ones, stored under their own names
+STORED_STATS = stat_plugins.resolve_stat_plugins(stat_plugins.STORED_STAT_PLUGINS)
+PLUGIN_COUNTERS = [counter for counter in stat_plugins.counter_names(STORED_STATS) if counter not in COUNTER_COLUMNS]
+STORED_COUNTER_COLUMNS = {**COUNTER_COLUMNS, **{counter: counter for counter in PLUGIN_COUNTERS}}
+PLAYER_COUNTERS_QUERY = f"SELECT player_id, {', '.join(STORED_COUNTER_COLUMNS.values())} FROM player_stats"
+# the stats cube: counters per player and cell of limit, table size and month, see update_stats_cube
+CUBE_WATERMARK = 'player_stats_cube'
+CUBE_CELL = ['big_blind', 'n_active_players', 'month']
+CUBE_KEYS = ['player_id', *CUBE_CELL]
+CUBE_CELLS_QUERY = f"""
+    SELECT {', '.join(CUBE_KEYS)},
+        {', '.join(f'{column} AS {counter}' for counter, column in STORED_COUNTER_COLUMNS.items())}
+    FROM player_stats_cube WHERE month >= :first_month
+"""
+# the counters of the cells which match the filter {conditions}, summed up per player
+CUBE_COUNTERS_TEMPLATE = f"""
+    SELECT player_id,
+        {', '.join(f'SUM({column}) AS {counter}' for counter, column in STORED_COUNTER_COLUMNS.items())}
+    FROM player_stats_cube WHERE {{conditions}} GROUP BY player_id
+"""
+
+
+def hand_filter(alias, condition):
+    """SQL that restricts the rows of the table alias to the hands of hand_history (alias hh) with the condition."""
+    if not condition:
+        return ''
+    return f" AND {alias}.hand_id IN (SELECT hh.hand_id FROM hand_history AS hh WHERE {condition})"
+
+
+def cell_query_parts(alias, by_cell):
+    """The columns and the join which add the limit, table size and start date of the hand of the table alias."""
+    if not by_cell:
+        return {'cell_columns': '', 'cell_join': ''}
+    return {'cell_columns': ', hi.big_blind, hi.n_active_players, hi.start_date',
+            'cell_join': f"\n    JOIN hand_info AS hi ON hi.hand_id = {alias}.hand_id"}
+
+
+def stats_queries(condition=None, by_cell=False):
+    """
+    The queries of count_raw_data_from_tables and count_plugins_from_tables.
+
+    :param condition: optional sql condition on the hand_history table (alias hh), see hand_filter
+    :return: dict of 'first_preflop_actions', 'players_on_flop' and 'hand_actions' -> query
+    """
+    return {
+        'first_preflop_actions': FIRST_PREFLOP_ACTIONS_TEMPLATE.format(hand_filter=hand_filter('actions', condition),
+                                                                       **cell_query_parts('a', by_cell)),
+        'players_on_flop': PLAYERS_ON_FLOP_TEMPLATE.format(hand_filter=hand_filter('actions', condition),
+                                                           **cell_query_parts('hp', by_cell)),
+        'hand_actions': HAND_ACTIONS_TEMPLATE.format(hand_filter=hand_filter('hp', condition),
+                                                     **cell_query_parts('hp', by_cell))
+    }
+
+
+def xml_hands_condition(condition=None, from_tables=True):
+    """
+    The condition of the hands which _count_hands parses from the xml.
+
+    :param from_tables: the other hands were counted from the actions tables, only the hands without them are parsed
+    """
+    if not from_tables:
+        return condition
+    if condition:
+        return f'{HANDS_WITHOUT_TABLES_CONDITION} AND ({condition})'
+    return HANDS_WITHOUT_TABLES_CONDITION
+
+
+def month_of(date):
+    """The month of a date (datetime or string) like it is stored in the cube, 'YYYY-MM'."""
+    return pd.Timestamp(date).strftime('%Y-%m')
+
+
 player_cohorts = {
             "fish_passiv": [("hands", ">=", 100), ("vpip", ">=", 40), ("wwsf", "<", 45)],
             "fish_aggro": [("hands", ">=", 100), ("vpip", ">=", 50), ("wwsf", ">=", 45)],
@@ -45,6 +164,155 @@ def classify_player_type(row):
     return "unknown"
 
 
+COHORT_OPERATORS = {'>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt, '==': operator.eq}
+UNKNOWN_COHORT = 'unknown'
+
+
+def _cohort_rules(cohorts):
+    rules = []
+    for cohort, conditions in cohorts.items():
+        for column, cond, value in conditions:
+            if cond not in COHORT_OPERATORS:
+                raise ValueError(f"Unknown operator {cond} in the rules of the cohort {cohort}")
+            if not column.isidentifier():
+                raise ValueError(f"Invalid column {column} in the rules of the cohort {cohort}")
+            if not isinstance(value, numbers.Real) or isinstance(value, bool):
+                raise ValueError(f"The value {value!r} in the rules of the cohort {cohort} is no number")
+        rules.append((cohort, conditions))
+    return rules
+
+
+def compile_cohort_rules(cohorts=None):
+    """
+    Compile the cohort rules (player_cohorts) into a function that labels a dataframe of player stats at once.
+
+    Every cohort becomes one mask of its conditions, the first matching cohort wins like in classify_player_type
+    and players without a match are 'unknown'.
+
+    :return: function dataframe of stats -> series of the cohorts, with the index of the dataframe
+    """
+    rules = _cohort_rules(player_cohorts if cohorts is None else cohorts)
+
+    def classify_cohorts(stats):
+        masks = []
+        for cohort, conditions in rules:
+            mask = np.ones(len(stats), dtype=bool)
+            for column, cond, value in conditions:
+                mask &= COHORT_OPERATORS[cond](stats[column].to_numpy(), value)
+            masks.append(mask)
+        labels = np.select(masks, [cohort for cohort, _ in rules], default=UNKNOWN_COHORT) if masks \
+            else np.full(len(stats), UNKNOWN_COHORT)
+        return pd.Series(labels, index=stats.index, dtype=object)
+
+    return classify_cohorts
+
+
+def _sql_number(value):
+    # plain python numbers, the repr of numpy numbers like np.int64(100) is no SQL
+    value = float(value)
+    return repr(int(value)) if value.is_integer() else repr(value)
+
+
+def cohort_case_sql(cohorts=None):
+    """The cohort rules as sql CASE expression on the columns of player_stats, with the same first match."""
+    whens = []
+    for cohort, conditions in _cohort_rules(player_cohorts if cohorts is None else cohorts):
+        condition = ' AND '.join(f"{column} {'=' if cond == '==' else cond} {_sql_number(value)}"
+                                 for column, cond, value in conditions) or '1 = 1'
+        whens.append(f"WHEN {condition} THEN '{cohort.replace(chr(39), chr(39) * 2)}'")
+    return f"CASE {' '.join(whens)} ELSE '{UNKNOWN_COHORT}' END"
+
+
+# the counters of count_raw_data, in this order in the lists of count_hand_shard
+COUNTERS = stat_plugins.counter_names()
+SHARD_HANDS = 1000
+
+
+def count_hand_shard(hand_histories, parser_backend=transform.DEFAULT_PARSER_BACKEND, by_cell=False, stats=None):
+    """
+    Count the VPIP/PFR and WWSF data of a shard of hands, runs in the worker processes of the stats.
+
+    :param by_cell: count per (player name, big_blind, n_active_players, month) for the stats cube
+    :param stats: names of additional stat plugins (see stat_plugins), all are counted in the same walk
+    :return: (number of hands, dict of player name -> list of the counters, see stat_plugins.counter_names)
+    """
+    parse_hand = transform.get_parser(parser_backend)
+    stat_counter = stat_plugins.StatCounter(stats)
+    counters = {}
+    n_hands = 0
+    for hand in hand_histories:
+        parsed_hand = parse_hand(hand)
+        cell = None
+        if by_cell:
+            hand_info = parsed_hand.hand_info
+            cell = (hand_info['big_blind'], hand_info['n_active_players'], hand_info['start_date'].strftime('%Y-%m'))
+        stat_counter.count_hand(parsed_hand, counters, cell)
+        n_hands += 1
+    return n_hands, counters
+
+
+def merge_counters(counters, shard_counters):
+    """Add the counters of a shard to counters (both dicts of player -> list of the COUNTERS)."""
+    for player, player_counters in shard_counters.items():
+        total = counters.get(player)
+        if total is None:
+            counters[player] = list(player_counters)
+        else:
+            for i, count in enumerate(player_counters):
+                total[i] += count
+    return counters
+
+
+def counters_to_frame(counters, key='player', columns=None):
+    """
+    The merged counters as dataframe like count_raw_data: indexed by the key, sorted, one column per counter.
+
+    :param key: name of the index, a list of names for the tuple keys of the cube cells
+    :param columns: names of the counters, COUNTERS if None
+    """
+    counts = pd.DataFrame.from_dict(counters, orient='index', columns=columns or COUNTERS, dtype='int64')
+    if isinstance(key, list):
+        counts.index = pd.MultiIndex.from_tuples(counts.index, names=key) if len(counts) \
+            else pd.MultiIndex.from_arrays([[]] * len(key), names=key)
+        return counts.sort_index()
+    return counts.rename_axis(key).sort_index()
+
+
+def hands_from_action_rows(rows, by_cell=False):
+    """
+    Build the hands for the stat plugins from the rows of HAND_ACTIONS_TEMPLATE, without parsing any xml.
+
+    The players are named by their player_id and only what the plugins read is filled in.
+
+    :param by_cell: the rows have the cell columns of cell_query_parts, the hands come with their cube cell
+    :return: generator of (ParsedHand, cell), cell is (big_blind, n_active_players, month) or None
+    """
+    for hand_id, hand_rows in groupby(rows, key=operator.itemgetter(0)):
+        players = {}
+        actions = []
+        for row in hand_rows:
+            _, player_id, player_no, win, action_no, round_no, action_type, amount = row[:8]
+            players[player_id] = (player_no, win)
+            if action_no is not None:
+                actions.append(transform.ActionRow(round_no, action_no, action_type, amount, player_id))
+        actions.sort(key=operator.attrgetter('action_no'))
+        # like transform.build_parsed_hand
+        first_preflop_actions = {}
+        players_on_flop = set()
+        for action in actions:
+            if action.round_no == 1:
+                first_preflop_actions.setdefault(action.player, action.action_type)
+            elif action.round_no == 2:
+                players_on_flop.add(action.player)
+        player_rows = tuple(
+            transform.PlayerRow(name=player_id, player_no=player_no, seat=None, dealer=None, bet=None, win=win,
+                                chips=None, first_preflop_action=first_preflop_actions.get(player_id),
+                                saw_flop=player_id in players_on_flop)
+            for player_id, (player_no, win) in sorted(players.items(), key=lambda item: item[1][0]))
+        cell = (row[8], row[9], month_of(row[10])) if by_cell else None
+        yield transform.ParsedHand({'hand_id': hand_id}, player_rows, tuple(actions)), cell
+
+
 class PokerStats:
     """Class to retrieve the stats about a player"""
     stats_table: DataFrame
@@ -55,7 +323,11 @@ class PokerStats:
                  min_active_players=3,
                  max_active_players=10,
                  start_date=None,
-                 end_date=None):
+                 end_date=None,
+                 raw_store=None,
+                 parser_backend=transform.DEFAULT_PARSER_BACKEND,
+                 cohorts=None,
+                 stats=None):
         self.min_bigblind = min_bigblind
         self.max_bigblind = max_bigblind
         self.min_active_players = min_active_players
@@ -64,109 +336,416 @@ class PokerStats:
         self.end_date = end_date
 
         self.DB_connection = db_connection
+        # optional RawHandStore, the hands which have to be parsed from the xml are read from it
+        self.raw_store = raw_store
+        # parses the hands which are not in the actions tables, see transform.get_parser
+        self.parser_backend = parser_backend
+        self.parse_hand = transform.get_parser(parser_backend)
+        # the rules of the cohorts, player_cohorts if None
+        self.cohorts = cohorts
+        self.classify_cohorts = compile_cohort_rules(cohorts)
+        # stat plugins which are counted besides VPIP/PFR and WWSF when the hand histories are parsed
+        self.stats = stat_plugins.resolve_stat_plugins(stats)
 
     # _____________________calc stats from xml files____________________________
-    def calc_wwsf_from_hand(self, root):
-        players_on_flop = set()
+    def calc_wwsf_from_hand(self, parsed_hand):
+        # the players who saw the flop and if they won the hand
+        return [{'player': player.name, 'saw_flop': True, 'won_hand': player.win > 0}
+                for player in parsed_hand.players if player.saw_flop]
 
-        # players who saw flop
-        for action in root.findall(".//round[@no='2']/action"):
-            players_on_flop.add(action.attrib['player'])
-
-        wwsf = []
-        # check if the player won who were on the flop
-        for player in root.findall('.//players/player'):
-            player_name = player.attrib['name']
-            if player_name not in players_on_flop:
-                continue
-            amount_won = euro_to_float(player.attrib['win'])
-            wwsf.append({
-                'player': player_name,
-                'saw_flop': True,
-                'won_hand': amount_won > 0
-            })
-        return wwsf
-
-    def calc_vpip_pfr_from_hand(self, root):
-        stats = []
-        players_first_action = set()
-        round_1_actions = root.findall(".//round[@no='1']/action")
-
-        for action in round_1_actions:
-            action_type = int(action.get('type'))
-            player_name = action.get('player')
-
-            if player_name in players_first_action:
-                continue
-            players_first_action.add(player_name)
-
-            flag_vpip = action_type in [3, 4, 5, 23]
-            flag_pfr = action_type in [5, 23]
-
-            stats.append({
-                'player': player_name,
-                'flag_vpip': flag_vpip,
-                'flag_pfr': flag_pfr
-            })
-        return stats
+    def calc_vpip_pfr_from_hand(self, parsed_hand):
+        # VPIP and PFR are decided by the first preflop action of each player
+        return [{'player': player.name,
+                 'flag_vpip': player.first_preflop_action in VPIP_ACTION_TYPES,
+                 'flag_pfr': player.first_preflop_action in PFR_ACTION_TYPES}
+                for player in parsed_hand.players if player.first_preflop_action is not None]
 
     def parse_hand_history(self, hand_histories):
         vpip_raw = []
         wwsf_raw = []
 
         for hand in hand_histories:
-            root = ET.fromstring(hand)
+            parsed_hand = self.parse_hand(hand)
 
             # getting the raw stats:
-            vpip_raw.extend(self.calc_vpip_pfr_from_hand(root))
-            wwsf_raw.extend(self.calc_wwsf_from_hand(root))
+            vpip_raw.extend(self.calc_vpip_pfr_from_hand(parsed_hand))
+            wwsf_raw.extend(self.calc_wwsf_from_hand(parsed_hand))
 
         n_hands = len(hand_histories)
-        logger.info(f"Calculated Stats for {n_hands} hands.")
+        logger.debug(f"Calculated Stats for {n_hands} hands.")
 
         return vpip_raw, wwsf_raw
 
-    def process_raw_data(self, vpip_raw, wwsf_raw):
-        # process VPIP stats
-        vpip = pd.DataFrame(vpip_raw)
-        vpip = vpip.groupby('player').agg(
-            hands=('player', 'count'),
+    def count_hand_histories(self, hand_histories, n_workers=1, shard_size=SHARD_HANDS):
+        """
+        Count the VPIP/PFR and WWSF data of the hands per player name, like count_raw_data(*parse_hand_history()),
+        with the counters of the stat plugins of self.stats.
+
+        The hands are split into shards of shard_size which are counted in n_workers processes, each shard only
+        returns the counters of its players. The memory grows with the number of players, not with the hands.
+
+        :param hand_histories: iterable of the hand xml, it is read shard by shard
+        """
+        counters = {}
+        n_hands = 0
+        shards = self._iter_shards(hand_histories, shard_size)
+        for shard_hands, shard_counters in self._map_shards(shards, n_workers, stats=self.stats):
+            merge_counters(counters, shard_counters)
+            n_hands += shard_hands
+        logger.debug(f"Counted the stats of {n_hands} hands.")
+        return counters_to_frame(counters, columns=stat_plugins.counter_names(self.stats))
+
+    def process_hand_histories(self, hand_histories, n_workers=1, shard_size=SHARD_HANDS):
+        """The stats of the hands, the same as process_raw_data(*parse_hand_history(hand_histories))."""
+        return self.stats_from_counts(self.count_hand_histories(hand_histories, n_workers, shard_size), key='player')
+
+    def _iter_shards(self, hand_histories, shard_size):
+        shard = []
+        for hand in hand_histories:
+            shard.append(hand)
+            if len(shard) >= shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    def _map_shards(self, shards, n_workers=1, by_cell=False, stats=None):
+        """
+        Yield count_hand_shard of every shard, in the order of the shards.
+
+        With n_workers > 1 they are counted in a process pool, at most two shards per worker are waiting,
+        so the shards are not read ahead of the workers.
+        """
+        count_shard = partial(count_hand_shard, parser_backend=self.parser_backend, by_cell=by_cell, stats=stats)
+        if n_workers <= 1:
+            yield from map(count_shard, shards)
+            return
+        with Pool(n_workers) as pool:
+            pending = deque()
+            for shard in shards:
+                pending.append(pool.apply_async(count_shard, (shard,)))
+                if len(pending) >= 2 * n_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def count_raw_data_from_tables(self, batch_size=100000, condition=None, params=None, by_cell=False,
+                                   stats=None):
+        """
+        Count the VPIP/PFR and WWSF data per player_id from the actions and hand_players tables, without parsing
+        any xml. The rows are streamed in batches, only the counters are kept in memory.
+
+        :param condition: optional sql condition on the hand_history table (alias hh), only these hands are counted
+        :param params: values of the bound parameters of the condition
+        :param by_cell: count per player_id and cube cell (CUBE_KEYS), the hands without hand_info are left out
+        :param stats: names of stat plugins which are counted as well, see count_plugins_from_tables
+        :return: dataframe of counters per player_id (see count_raw_data), None if the tables cannot be queried
+        """
+        counts = None
+        key = CUBE_KEYS if by_cell else 'player_id'
+        keys = CUBE_KEYS if by_cell else ['player_id']
+        cell_columns = ['big_blind', 'n_active_players', 'start_date'] if by_cell else []
+        queries = stats_queries(condition, by_cell)
+        try:
+            for rows in self.DB_connection.iter_query_batches(queries['first_preflop_actions'], batch_size, params):
+                first_actions = self._with_month(pd.DataFrame(rows, columns=['player_id', 'action_type',
+                                                                             *cell_columns]))
+                vpip_raw = first_actions[keys].assign(
+                    flag_vpip=first_actions['action_type'].isin(VPIP_ACTION_TYPES),
+                    flag_pfr=first_actions['action_type'].isin(PFR_ACTION_TYPES)
+                )
+                counts = self._add_counts(counts, self.count_raw_data(vpip_raw, [], key=key))
+            for rows in self.DB_connection.iter_query_batches(queries['players_on_flop'], batch_size, params):
+                players_on_flop = self._with_month(pd.DataFrame(rows, columns=['player_id', 'won_hand',
+                                                                               *cell_columns]))
+                wwsf_raw = players_on_flop[keys].assign(
+                    saw_flop=True,
+                    won_hand=players_on_flop['won_hand'] > 0
+                )
+                counts = self._add_counts(counts, self.count_raw_data([], wwsf_raw, key=key))
+            if counts is None:
+                counts = self.count_raw_data([], [], key=key)
+            if set(stat_plugins.resolve_stat_plugins(stats)) - set(stat_plugins.CORE_STAT_PLUGINS):
+                plugin_counts = self.count_plugins_from_tables(batch_size, condition, params, by_cell, stats)
+                counts = counts.join(plugin_counts, how='outer').fillna(0).astype(int)
+        except Exception as e:
+            logger.warning(f'Cannot count the stats from the tables. Error: {e}')
+            return None
+        return counts
+
+    def count_plugins_from_tables(self, batch_size=100000, condition=None, params=None, by_cell=False, stats=None):
+        """
+        Count the counters of the stat plugins besides the core ones from the actions and hand_players tables,
+        with one walk over the actions of every hand like count_hand_shard, but without parsing any xml.
+
+        :param stats: names of the stat plugins, see stat_plugins.resolve_stat_plugins
+        :return: dataframe of the counters of the plugins besides the core ones per player_id (per CUBE_KEYS
+            with by_cell)
+        """
+        stat_counter = stat_plugins.StatCounter(stats)
+        query = stats_queries(condition, by_cell)['hand_actions']
+        rows = chain.from_iterable(self.DB_connection.iter_query_batches(query, batch_size=batch_size,
+                                                                         params=params))
+        counters = {}
+        for parsed_hand, cell in hands_from_action_rows(rows, by_cell):
+            stat_counter.count_hand(parsed_hand, counters, cell)
+        counter_names = stat_plugins.counter_names(stats)
+        counts = counters_to_frame(counters, key=CUBE_KEYS if by_cell else 'player_id', columns=counter_names)
+        return counts[[counter for counter in counter_names if counter not in COUNTER_COLUMNS]]
+
+    def _with_month(self, rows):
+        # the cube cells are by month, the start dates come as datetime or as string (SQLite)
+        if 'start_date' in rows:
+            rows['month'] = pd.to_datetime(rows.pop('start_date')).dt.strftime('%Y-%m')
+        return rows
+
+    def count_raw_data(self, vpip_raw, wwsf_raw, key='player'):
+        """
+        Sum up the raw VPIP/PFR and WWSF rows to counters per player.
+
+        :param key: column of the player, or a list of columns like CUBE_KEYS to count per player and cell
+        :return: dataframe indexed by the key with the columns hands, vpip, pfr, saw_flop and won_hand
+        """
+        keys = key if isinstance(key, list) else [key]
+        vpip = pd.DataFrame(vpip_raw, columns=[*keys, 'flag_vpip', 'flag_pfr']).groupby(key).agg(
+            hands=('flag_vpip', 'count'),
             vpip=('flag_vpip', 'sum'),
             pfr=('flag_pfr', 'sum')
         )
-        vpip['vpip'] = vpip['vpip'] / vpip['hands'] * 100
-        vpip['pfr'] = vpip['pfr'] / vpip['hands'] * 100
-        vpip['vpip_pfr_gap'] = vpip['vpip'] - vpip['pfr']
-
-        # process WWSF stats
-        wwsf = pd.DataFrame(wwsf_raw).groupby('player').agg(
+        wwsf = pd.DataFrame(wwsf_raw, columns=[*keys, 'saw_flop', 'won_hand']).groupby(key).agg(
             saw_flop=('saw_flop', 'sum'),
             won_hand=('won_hand', 'sum')
         )
-        wwsf['wwsf'] = wwsf['won_hand'] / wwsf['saw_flop'] * 100
+        return vpip.join(wwsf, how='outer').astype(float).fillna(0).astype(int)
+
+    def _add_counts(self, counts, batch_counts):
+        if counts is None:
+            return batch_counts
+        return counts.add(batch_counts, fill_value=0).astype(int)
+
+    def stats_from_counts(self, counts, key='player'):
+        """
+        Calculate the player stats and cohorts from the counters of count_raw_data.
+
+        With the counters of further stat plugins (see count_hand_histories) their counters and the stats of every
+        plugin whose counters are all there follow.
 
-        # merge tables
-        final_player_stats = vpip.reset_index().merge(wwsf.reset_index()[['player', 'wwsf']], on='player', how='left').fillna(0)
+        :return: dataframe with the counters (named like the player_stats columns), the stats and the cohort
+        """
+        # players who only appear in the wwsf data have no hands, their stats are 0
+        hands = counts['hands'].where(counts['hands'] > 0)
+        stats = counts.rename(columns=COUNTER_COLUMNS)
+        stats['vpip'] = (counts['vpip'] / hands * 100).fillna(0)
+        stats['pfr'] = (counts['pfr'] / hands * 100).fillna(0)
+        stats['vpip_pfr_gap'] = stats['vpip'] - stats['pfr']
+        stats['wwsf'] = (counts['won_hand'] / counts['saw_flop'] * 100).fillna(0)
+        plugin_counters = [column for column in counts.columns if column not in COUNTER_COLUMNS]
+        final_player_stats = stats.rename_axis(key).reset_index()[[key, *COUNTER_COLUMNS.values(), *plugin_counters,
+                                                                   'vpip', 'pfr', 'vpip_pfr_gap', 'wwsf']]
 
         numeric_cols = final_player_stats.select_dtypes(exclude='object').columns
         final_player_stats[numeric_cols] = final_player_stats[numeric_cols].round(0).astype(int)
+        if plugin_counters:
+            plugin_stats = stat_plugins.StatCounter(stat_plugins.plugins_with_counters(counts.columns)).stats(counts)
+            for column in plugin_stats:
+                final_player_stats[column] = plugin_stats[column].to_numpy()
         logger.info('Add cohort')
-        final_player_stats['cohort'] = final_player_stats.apply(classify_player_type, axis=1)
+        final_player_stats['cohort'] = self.classify_cohorts(final_player_stats)
         logger.info('Finish Add cohort')
 
         return final_player_stats
 
+    def process_raw_data(self, vpip_raw, wwsf_raw, key='player'):
+        # the players are identified by the key column (name or player_id)
+        return self.stats_from_counts(self.count_raw_data(vpip_raw, wwsf_raw, key=key), key=key)
+
     def classify_player_type(self):
         return
 
-    def update_stats_from_xml(self):
-        hand_histories = self.DB_connection.get_table_as_df(f"""SELECT * FROM hand_history""")
-        hand_histories = hand_histories['hand_history'].tolist()
+    def reclassify_cohorts(self, cohorts=None):
+        """
+        Assign the cohorts of the stored player_stats again, e.g. after a threshold changed.
 
-        logger.info('Calculate stats')
-        vpip_raw, wwsf_raw = self.parse_hand_history(hand_histories)
-        logger.info('Finish  parse_hand_history')
-        final_player_stats = self.process_raw_data(vpip_raw, wwsf_raw)
+        The rules run as one UPDATE inside the database, the stats are not calculated again.
+
+        :param cohorts: new cohort rules like player_cohorts, they are used for the next stats as well once the
+            stored cohorts are updated, errors of the update are raised
+        """
+        cohorts = self.cohorts if cohorts is None else cohorts
+        classify_cohorts = compile_cohort_rules(cohorts)
+        with self.DB_connection.begin() as connection:
+            connection.execute(text(f"UPDATE player_stats SET cohort = {cohort_case_sql(cohorts)}"))
+        self.cohorts = cohorts
+        self.classify_cohorts = classify_cohorts
+
+    def update_stats_from_xml(self, batch_size=1000, n_workers=1):
+        """
+        Calculate the stats of all players and store them in the player_stats table.
+
+        The stats are counted from the actions and hand_players tables, only hands which are not in these tables
+        are parsed from the xml. Both are read in batches, so the memory doesn't grow with the number of hands.
+        The counters are stored with the stats and the watermark, so update_stats_incremental can add new hands.
+        Besides VPIP/PFR and WWSF the stat plugins of STORED_STATS are counted, from the tables by one walk over
+        the actions of every hand.
+
+        :param batch_size: number of hand histories which are parsed at once
+        :param n_workers: number of processes which parse the hand histories, 1 parses them in this process
+        """
+        # hands which are loaded while counting are left for the next incremental update
+        ingest_id = self.DB_connection.last_ingest_id()
+        if ingest_id is None:
+            counts = self._count_hands(batch_size, n_workers=n_workers)
+        else:
+            counts = self._count_hands(batch_size, COUNTED_HANDS_CONDITION, {'ingest_id': ingest_id}, n_workers)
+        final_player_stats = self.stats_from_counts(counts, key='player_id')
         logger.info('Finish calculate stats')
 
-        self.DB_connection.load_stats_table(final_player_stats)
\ No newline at end of file
+        self.DB_connection.load_stats_table(final_player_stats, watermark=ingest_id or 0)
+
+    def update_stats_incremental(self, batch_size=1000, n_workers=1):
+        """
+        Add the hands which were ingested since the last stats update to the player_stats table.
+
+        Only the new hands are counted, their counters are added to the stored counters and the stats and cohorts
+        of the players in these hands are calculated again. Without a watermark all stats are calculated.
+
+        :param batch_size: number of hand histories which are parsed at once
+        :param n_workers: number of processes which parse the hand histories, 1 parses them in this process
+        """
+        last_ingest_id = self.DB_connection.get_watermark(STATS_WATERMARK)
+        if last_ingest_id is None or self._missing_plugin_counters('player_stats'):
+            logger.info('No stats watermark or stats without the plugin counters, calculating the stats of all hands.')
+            self.update_stats_from_xml(batch_size=batch_size, n_workers=n_workers)
+            return
+        ingest_id = self.DB_connection.last_ingest_id()
+        if ingest_id is None or ingest_id <= last_ingest_id:
+            logger.info('No new hands since the last stats update.')
+            return
+
+        counts = self._count_hands(batch_size, NEW_HANDS_CONDITION,
+                                   {'last_ingest_id': last_ingest_id, 'ingest_id': ingest_id}, n_workers)
+        stored_counts = self.DB_connection.get_table_as_df(PLAYER_COUNTERS_QUERY, index_col='player_id')
+        stored_counts = stored_counts.rename(columns={column: counter
+                                                      for counter, column in STORED_COUNTER_COLUMNS.items()})
+        stored_counts = stored_counts[stored_counts.index.isin(counts.index)].fillna(0)
+        counts = self._add_counts(stored_counts, counts)
+        final_player_stats = self.stats_from_counts(counts, key='player_id')
+        logger.info(f'Finish calculate stats, updated {len(final_player_stats)} players.')
+
+        self.DB_connection.load_stats_table(final_player_stats, if_exists='append', watermark=ingest_id)
+
+    def update_stats_cube(self, batch_size=1000, n_workers=1):
+        """
+        Count the hands since the last cube update into the player_stats_cube table, all hands the first time.
+
+        The cube has the counters of player_stats per player, limit, table size and month, so stats_from_cube
+        answers the filters of PokerStats by summing up cells instead of counting the hands again.
+        The counters of the new hands are added to the stored cells.
+
+        :param batch_size: number of hand histories which are parsed at once
+        :param n_workers: number of processes which parse the hand histories, 1 parses them in this process
+        """
+        last_ingest_id = self.DB_connection.get_watermark(CUBE_WATERMARK)
+        ingest_id = self.DB_connection.last_ingest_id()
+        if last_ingest_id is None or self._missing_plugin_counters('player_stats_cube'):
+            logger.info('No cube watermark or cells without the plugin counters, counting all hands into the cube.')
+            if_exists = 'replace'
+            condition, params = (None, None) if ingest_id is None else (COUNTED_HANDS_CONDITION,
+                                                                         {'ingest_id': ingest_id})
+        elif ingest_id is None or ingest_id <= last_ingest_id:
+            logger.info('No new hands since the last cube update.')
+            return
+        else:
+            if_exists = 'append'
+            condition, params = NEW_HANDS_CONDITION, {'last_ingest_id': last_ingest_id, 'ingest_id': ingest_id}
+
+        cells = self._count_hands(batch_size, condition, params, n_workers, by_cell=True)
+        if if_exists == 'append' and len(cells):
+            # new hands are mostly in the last months, only their cells are read
+            first_month = cells.index.get_level_values('month').min()
+            stored_cells = self.DB_connection.get_table_as_df(CUBE_CELLS_QUERY, index_col=CUBE_KEYS,
+                                                              params={'first_month': first_month})
+            cells = self._add_counts(stored_cells[stored_cells.index.isin(cells.index)], cells)
+        logger.info(f'Finish counting the stats cube, updated {len(cells)} cells.')
+
+        self.DB_connection.load_stats_table(cells.rename(columns=COUNTER_COLUMNS).reset_index(), if_exists=if_exists,
+                                            watermark=ingest_id or 0, table_name=CUBE_WATERMARK)
+
+    def _missing_plugin_counters(self, table_name):
+        # rows stored before the plugin counters had their columns have NULL there, they are counted again
+        condition = ' OR '.join(f'{counter} IS NULL' for counter in PLUGIN_COUNTERS)
+        return self.DB_connection.my_sql_select_query(f'SELECT COUNT(*) FROM {table_name} WHERE {condition}',
+                                                      single_value=True) > 0
+
+    def cube_filter(self):
+        """
+        The sql condition and its parameters which select the cube cells of the filters of PokerStats.
+
+        The blinds are in euro like in PokerMetrics, the dates are matched by month.
+        """
+        conditions = ['big_blind BETWEEN :min_bigblind AND :max_bigblind',
+                      'n_active_players BETWEEN :min_active_players AND :max_active_players']
+        params = {'min_bigblind': round(self.min_bigblind * 100), 'max_bigblind': round(self.max_bigblind * 100),
+                  'min_active_players': int(self.min_active_players),
+                  'max_active_players': int(self.max_active_players)}
+        if self.start_date is not None:
+            conditions.append('month >= :start_month')
+            params['start_month'] = month_of(self.start_date)
+        if self.end_date is not None:
+            conditions.append('month <= :end_month')
+            params['end_month'] = month_of(self.end_date)
+        return ' AND '.join(conditions), params
+
+    def stats_from_cube(self):
+        """
+        The stats of the players in the hands which match the filters of PokerStats (limits, table sizes and
+        start_date to end_date), summed up from the cells of update_stats_cube without reading any hand.
+
+        :return: dataframe like stats_from_counts per player_id, None if the cube cannot be read
+        """
+        conditions, params = self.cube_filter()
+        counts = self.DB_connection.get_table_as_df(CUBE_COUNTERS_TEMPLATE.format(conditions=conditions),
+                                                    index_col='player_id', params=params)
+        if counts is None:
+            return None
+        return self.stats_from_counts(counts.astype('int64'), key='player_id')
+
+    def _count_hands(self, batch_size=1000, condition=None, params=None, n_workers=1, by_cell=False,
+                     stats=STORED_STATS):
+        """
+        Count the hands with the condition on the hand_history table (alias hh), see count_raw_data.
+
+        The hands without tables are parsed in n_workers processes, see count_hand_histories.
+        Players only known from the xml are added to the players table.
+
+        :param by_cell: count per player_id and cube cell (CUBE_KEYS) for update_stats_cube
+        :param stats: names of the stat plugins which are counted besides the core ones, the stored ones by default
+        """
+        key = CUBE_KEYS if by_cell else 'player_id'
+        counts = self.count_raw_data_from_tables(condition=condition, params=params, by_cell=by_cell, stats=stats)
+        xml_condition = xml_hands_condition(condition, from_tables=counts is not None)
+        if counts is None:
+            logger.warning('Cannot read the actions tables, parsing all hand histories.')
+            counts = self.count_raw_data([], [], key=key)
+
+        # every batch of hands from the database is one shard
+        logger.info('Calculate stats')
+        shards = ([hand_history for _, hand_history in rows]
+                  for rows in self.DB_connection.iter_hand_histories(batch_size=batch_size, condition=xml_condition,
+                                                                     raw_store=self.raw_store, params=params))
+        counters = {}
+        n_hands = 0
+        for shard_hands, shard_counters in self._map_shards(shards, n_workers, by_cell, stats=stats):
+            merge_counters(counters, shard_counters)
+            n_hands += shard_hands
+        logger.info(f'Finish parse_hand_history, parsed {n_hands} hands.')
+
+        # the stats are stored by player_id, players only known from the xml are added to the players table
+        player_registry = load.PlayerRegistry(self.DB_connection)
+        if counters:
+            xml_counts = counters_to_frame(counters, key=['player', *CUBE_CELL] if by_cell else 'player',
+                                           columns=stat_plugins.counter_names(stats)).reset_index()
+            player_registry.register_players(xml_counts['player'])
+            xml_counts.insert(0, 'player_id', xml_counts.pop('player').map(player_registry.get_id))
+            counts = self._add_counts(counts, xml_counts.set_index(key))
+        return counts
@@ -0,0 +1,99 @@
+import random
+import struct
+import zlib
+from hashlib import blake2b
+
+HEADER_END_TAG = '</general>'  # the session header of a hand ends with the first </general>
+ZLIB_WINDOW = 32 * 1024  # deflate only looks back this far, a longer dictionary is cut to its end
+DICTIONARY_MIN_HANDS = 200  # hands needed to train a dictionary, smaller batches are compressed without
+DICTIONARY_SAMPLE_HANDS = 1000
+
+# first byte of a stored body, the dictionary format is followed by the uint16 dictionary id
+BODY_DEFLATE = 1
+BODY_DEFLATE_DICTIONARY = 2
+_DICTIONARY_ID = struct.Struct('<H')
+
+
+def split_hand_history(hand):
+    """
+    Split a stored hand into the session header (everything up to the first </general>) and the game body.
+
+    header + body is the hand again. A hand without a header returns an empty header.
+    """
+    end = hand.find(HEADER_END_TAG)
+    if end == -1:
+        return '', hand
+    end += len(HEADER_END_TAG)
+    return hand[:end], hand[end:]
+
+
+def session_header_id(header):
+    """Id of the session header in the session_headers table, a 63 bit hash of its text."""
+    return int.from_bytes(blake2b(header.encode('UTF-8'), digest_size=8).digest(), 'big') >> 1
+
+
+def train_dictionary(bodies, size=ZLIB_WINDOW, seed=0):
+    """
+    Build a deflate dictionary from sample bodies.
+
+    The dictionary is a concatenation of randomly chosen bodies, so it contains the tags, the player names and
+    the amounts which are typical for the archive. Deflate finds the matches of a new body in it.
+    """
+    sample = list(bodies)
+    random.Random(seed).shuffle(sample)
+    dictionary = b''
+    for body in sample[:DICTIONARY_SAMPLE_HANDS]:
+        dictionary += body.encode('UTF-8')
+        if len(dictionary) >= size:
+            break
+    return dictionary[-size:]
+
+
+class HandHistoryCodec:
+    """
+    Compression of the hand bodies with deflate and the dictionaries of the compression_dictionaries table.
+
+    The dictionaries never change once they are stored, every body records the id of the dictionary it was
+    compressed with, so the hands can always be restored exactly.
+    """
+
+    def __init__(self, dictionaries=None):
+        self.dictionaries = dict(dictionaries or {})  # dictionary_id -> bytes
+
+    @property
+    def dictionary_id(self):
+        """Id of the dictionary new bodies are compressed with, None if there is none yet."""
+        return max(self.dictionaries, default=None)
+
+    def compress_body(self, body):
+        dictionary_id = self.dictionary_id
+        if dictionary_id is None:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            prefix = bytes([BODY_DEFLATE])
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dictionaries[dictionary_id])
+            prefix = bytes([BODY_DEFLATE_DICTIONARY]) + _DICTIONARY_ID.pack(dictionary_id)
+        return prefix + compressor.compress(body.encode('UTF-8')) + compressor.flush()
+
+    def decompress_body(self, data):
+        data = bytes(data)
+        if data[0] == BODY_DEFLATE:
+            decompressor = zlib.decompressobj(-15)
+            data = data[1:]
+        elif data[0] == BODY_DEFLATE_DICTIONARY:
+            dictionary_id = _DICTIONARY_ID.unpack_from(data, 1)[0]
+            if dictionary_id not in self.dictionaries:
+                raise KeyError(f"Unknown compression dictionary {dictionary_id}")
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionaries[dictionary_id])
+            data = data[1 + _DICTIONARY_ID.size:]
+        else:
+            raise ValueError(f"Unknown body format {data[0]}")
+        return (decompressor.decompress(data) + decompressor.flush()).decode('UTF-8')
+
+    def encode(self, hand):
+        """:return: (header_id, header, body) for the session_headers and hand_history tables"""
+        header, body = split_hand_history(hand)
+        return session_header_id(header), header, self.compress_body(body)
+
+    def decode(self, header, body):
+        return (header or '') + self.decompress_body(body)
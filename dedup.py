@@ -0,0 +1,192 @@
+import os
+import math
+import struct
+import numpy as np
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+# odd 64 bit constants for the multiply-shift hashing of the bloom filter
+_HASH_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+                     0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x94D049BB133111EB, 0xBF58476D1CE4E5B9)
+_MASK_64 = (1 << 64) - 1
+# magic, log2 of the number of bits, number of hashes, count, watermark (-1 for None)
+_BLOOM_HEADER = struct.Struct('<4sBBQq')
+_BLOOM_MAGIC = b'PJTW'
+# the hand_ids of a list which are loaded already, {hand_ids} is filled in by get_table_as_df_for_hand_ids
+LOADED_HAND_IDS_QUERY = 'SELECT hand_id FROM hand_history WHERE hand_id IN {hand_ids}'
+
+
+class BloomFilter:
+    """
+    Bloom filter for integer keys, like the hand_id. Can be saved to and loaded from a file.
+
+    The watermark is saved with the filter, e.g. the last ingest batch whose hands were added.
+    """
+
+    def __init__(self, bits_log2=23, n_hashes=7, count=0, bits=None, watermark=None):
+        if not 3 <= bits_log2 <= 40:
+            raise ValueError(f"bits_log2 has to be between 3 and 40, got {bits_log2}")
+        if not 1 <= n_hashes <= len(_HASH_MULTIPLIERS):
+            raise ValueError(f"n_hashes has to be between 1 and {len(_HASH_MULTIPLIERS)}, got {n_hashes}")
+        self.bits_log2 = bits_log2
+        self.n_hashes = n_hashes
+        self.count = count
+        self.watermark = watermark
+        self.bits = bits if bits is not None else np.zeros(1 << (bits_log2 - 3), dtype=np.uint8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.001):
+        """Create a filter that holds capacity keys with about the given false positive rate."""
+        capacity = max(int(capacity), 1)
+        n_bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        bits_log2 = min(max(math.ceil(math.log2(n_bits)), 3), 40)
+        n_hashes = round((1 << bits_log2) / capacity * math.log(2))
+        return cls(bits_log2=bits_log2, n_hashes=min(max(n_hashes, 1), len(_HASH_MULTIPLIERS)))
+
+    def _positions(self, key):
+        shift = 64 - self.bits_log2
+        return [((key * multiplier) & _MASK_64) >> shift for multiplier in _HASH_MULTIPLIERS[:self.n_hashes]]
+
+    def add(self, key):
+        for position in self._positions(int(key)):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def add_many(self, keys):
+        keys = np.asarray(keys, dtype=np.int64).astype(np.uint64)
+        shift = np.uint64(64 - self.bits_log2)
+        for multiplier in _HASH_MULTIPLIERS[:self.n_hashes]:
+            positions = (keys * np.uint64(multiplier)) >> shift  # uint64 multiplication wraps like the mask
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+        self.count += len(keys)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(int(key)))
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            watermark = -1 if self.watermark is None else self.watermark
+            file.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, self.bits_log2, self.n_hashes, self.count, watermark))
+            file.write(self.bits.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            magic, bits_log2, n_hashes, count, watermark = _BLOOM_HEADER.unpack(file.read(_BLOOM_HEADER.size))
+            if magic != _BLOOM_MAGIC:
+                raise ValueError(f"Not a bloom filter file: {path}")
+            bits = np.frombuffer(file.read(), dtype=np.uint8).copy()
+        if len(bits) != 1 << (bits_log2 - 3):
+            raise ValueError(f"Bloom filter file is truncated: {path}")
+        return cls(bits_log2=bits_log2, n_hashes=n_hashes, count=count, bits=bits,
+                   watermark=None if watermark == -1 else watermark)
+
+
+class HandIdIndex:
+    """
+    Membership index of the hand_ids which are already in the database or in the current run.
+
+    The hand_ids from the database are kept as a sorted int64 array (8 bytes per hand), the hands of the
+    current run in a set. An optional bloom filter in front answers most lookups of new hands without
+    searching the array. It can be persisted with save(), so the next run loads it instead of reading every
+    hand_id and looks up its hits in the database (see from_database).
+    """
+
+    def __init__(self, existing_hand_ids=None, bloom_filter=None, bloom_filter_path=None, db_connection=None):
+        existing = np.asarray(existing_hand_ids if existing_hand_ids is not None else [], dtype=np.int64)
+        self.existing_hand_ids = np.unique(existing)  # sorted and without duplicates
+        self.new_hand_ids = set()
+        self.bloom_filter = bloom_filter
+        self.bloom_filter_path = bloom_filter_path
+        # the hits of the bloom filter are looked up in this database instead of existing_hand_ids
+        self.db_connection = db_connection
+
+    @classmethod
+    def from_database(cls, db_connection, bloom_filter_path=None, batch_size=100000):
+        """
+        Index the hand_ids of the hand_history table.
+
+        If bloom_filter_path has a filter which was saved at the last ingest batch of the database, only the filter
+        is loaded and its hits are looked up in the database. Otherwise the hand_ids are loaded without going
+        through pandas and the filter is rebuilt from them.
+        """
+        watermark = db_connection.last_ingest_id()
+        if bloom_filter_path and watermark is not None and os.path.exists(bloom_filter_path):
+            try:
+                bloom_filter = BloomFilter.load(bloom_filter_path)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f'Cannot load the bloom filter, rebuilding it. Error: {e}')
+            else:
+                if bloom_filter.watermark == watermark:
+                    return cls(bloom_filter=bloom_filter, bloom_filter_path=bloom_filter_path,
+                               db_connection=db_connection)
+                logger.info('Hands were loaded after the bloom filter was saved, rebuilding it.')
+
+        chunks = []
+        for rows in db_connection.iter_query_batches('SELECT hand_id FROM hand_history', batch_size=batch_size):
+            chunks.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+        existing_hand_ids = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+        index = cls(existing_hand_ids, bloom_filter_path=bloom_filter_path)
+        if bloom_filter_path:
+            bloom_filter = BloomFilter.for_capacity(max(2 * len(index.existing_hand_ids), 1000000))
+            bloom_filter.add_many(index.existing_hand_ids)
+            index.bloom_filter = bloom_filter
+        return index
+
+    def __contains__(self, hand_id):
+        if hand_id in self.new_hand_ids:
+            return True
+        if self.bloom_filter is not None and hand_id not in self.bloom_filter:
+            return False
+        if self.db_connection is not None:
+            return bool(self._query_loaded_hand_ids([hand_id]))
+        position = np.searchsorted(self.existing_hand_ids, hand_id)
+        return position < len(self.existing_hand_ids) and self.existing_hand_ids[position] == hand_id
+
+    def __len__(self):
+        return len(self.existing_hand_ids) + len(self.new_hand_ids)
+
+    def loaded_hand_ids(self, hand_ids):
+        """The hand_ids of the list which were in the database when the index was built, with one query at most."""
+        candidates = [hand_id for hand_id in hand_ids if hand_id not in self.new_hand_ids]
+        if self.bloom_filter is not None:
+            candidates = [hand_id for hand_id in candidates if hand_id in self.bloom_filter]
+        if not candidates:
+            return set()
+        if self.db_connection is not None:
+            return self._query_loaded_hand_ids(candidates)
+        candidates = np.asarray(candidates, dtype=np.int64)
+        positions = np.searchsorted(self.existing_hand_ids, candidates)
+        found = positions < len(self.existing_hand_ids)
+        found[found] = self.existing_hand_ids[positions[found]] == candidates[found]
+        return set(candidates[found].tolist())
+
+    def _query_loaded_hand_ids(self, hand_ids):
+        rows = self.db_connection.get_table_as_df_for_hand_ids(LOADED_HAND_IDS_QUERY, hand_ids)
+        # without an answer the hands are loaded again, the database skips the ones it has
+        return set() if rows is None else set(rows['hand_id'].tolist())
+
+    def add(self, hand_id):
+        """Mark a hand of the current run as seen. Returns False if it was already known."""
+        if hand_id in self:
+            return False
+        self.new_hand_ids.add(hand_id)
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(hand_id)
+        return True
+
+    def save(self, path=None, watermark=None):
+        """
+        Persist the bloom filter, call it after the new hands were loaded to the database.
+
+        :param watermark: the last ingest_id of the database, the next from_database only uses the filter if no
+            batch was loaded after it
+        """
+        path = path or self.bloom_filter_path
+        if self.bloom_filter is not None and path:
+            self.bloom_filter.watermark = watermark
+            self.bloom_filter.save(path)
@@ -1,113 +1,820 @@
+import os
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
 import pandas as pd
-from sqlalchemy import create_engine, text, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, event, text, bindparam, inspect, MetaData, Table, Column, Index, Sequence, Integer, BigInteger, Float, String, DateTime, Text, LargeBinary
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import time
 from my_logger import CustomLogger
+from transform import euro_to_cents
+import compression
 
 logger = CustomLogger(__name__).get_logger()
 
 ##### DATABASE TABLES #####
 Base = declarative_base()
+class Players(Base):
+    __tablename__ = 'players'
+
+    # the sequence is only used by backends without autoincrement columns (DuckDB)
+    player_id = Column(Integer, Sequence('players_player_id_seq'), primary_key=True, autoincrement=True)
+    player = Column(String(50), unique=True, nullable=False)
+
+
 class PlayerStats(Base):
     __tablename__ = 'player_stats'
 
-    player = Column(String(50), primary_key=True)
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
     hands = Column(Integer)
+    # additive counters, the stats below are calculated from them and new hands are added to them
+    vpip_count = Column(Integer)
+    pfr_count = Column(Integer)
+    saw_flop = Column(Integer)
+    won_at_showdown_or_flop = Column(Integer)  # hands won after seeing the flop
+    # counters of the stat_plugins.STORED_STAT_PLUGINS
+    three_bet_opportunities = Column(Integer)
+    three_bets = Column(Integer)
+    fold_to_three_bet_opportunities = Column(Integer)
+    folds_to_three_bet = Column(Integer)
+    cbet_opportunities = Column(Integer)
+    cbets = Column(Integer)
+    postflop_aggressive_actions = Column(Integer)
+    postflop_calls = Column(Integer)
+    went_to_showdown = Column(Integer)
     vpip = Column(Integer)
     pfr = Column(Integer)
     vpip_pfr_gap = Column(Integer)
     wwsf = Column(Integer)
+    # stats of the stored stat plugins
+    three_bet = Column(Integer)
+    fold_to_three_bet = Column(Integer)
+    cbet = Column(Integer)
+    aggression_factor = Column(Float(53))  # double precision
+    wtsd = Column(Integer)
     cohort = Column(String(50))
 
 
+class PlayerStatsCube(Base):
+    __tablename__ = 'player_stats_cube'
+    __table_args__ = (
+        Index('ix_player_stats_cube_month', 'month', 'big_blind', 'n_active_players'),
+    )
+
+    # one cell per player, limit, table size and month with the additive counters of player_stats
+    player_id = Column(Integer, primary_key=True, autoincrement=False)
+    big_blind = Column(Integer, primary_key=True, autoincrement=False)  # in cents
+    n_active_players = Column(Integer, primary_key=True, autoincrement=False)
+    month = Column(String(7), primary_key=True)  # 'YYYY-MM' of the start_date
+    hands = Column(Integer)
+    vpip_count = Column(Integer)
+    pfr_count = Column(Integer)
+    saw_flop = Column(Integer)
+    won_at_showdown_or_flop = Column(Integer)
+    three_bet_opportunities = Column(Integer)
+    three_bets = Column(Integer)
+    fold_to_three_bet_opportunities = Column(Integer)
+    folds_to_three_bet = Column(Integer)
+    cbet_opportunities = Column(Integer)
+    cbets = Column(Integer)
+    postflop_aggressive_actions = Column(Integer)
+    postflop_calls = Column(Integer)
+    went_to_showdown = Column(Integer)
+
+
 class PlayerTimestamps(Base):
     __tablename__ = 'player_timestamps'
+    __table_args__ = (
+        Index('ix_player_timestamps_player_hand', 'player_id', 'hand_id'),
+        Index('ux_player_timestamps_hand_player', 'hand_id', 'player_id', unique=True),
+        Index('ix_player_timestamps_limit', 'big_blind', 'n_active_players', 'start_date'),
+        Index('ix_player_timestamps_start_date', 'start_date'),
+    )
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    player = Column(String(50))
-    hand_id = Column(Integer)
+    id = Column(Integer, Sequence('player_timestamps_id_seq'), primary_key=True, autoincrement=True)
+    player_id = Column(Integer)
+    hand_id = Column(BigInteger)
     start_date = Column(DateTime)
-    big_blind = Column(String(50))
+    big_blind = Column(Integer)  # in cents
     n_active_players = Column(Integer)
 
 
 class HandHistory(Base):
     __tablename__ = 'hand_history'
+    __table_args__ = (
+        Index('ix_hand_history_ingest_id', 'ingest_id'),
+    )
+
+    hand_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    hand_history = Column(Text)  # the plain xml, only for hands stored without compression
+    header_id = Column(BigInteger)  # session header in session_headers
+    body = Column(LargeBinary)  # the game after the session header, see compression.HandHistoryCodec
+    ingest_id = Column(Integer)  # batch of ingest_batches the hand was loaded with, NULL for older hands
+
+
+class IngestBatches(Base):
+    __tablename__ = 'ingest_batches'
+
+    ingest_id = Column(Integer, Sequence('ingest_batches_ingest_id_seq'), primary_key=True, autoincrement=True)
+    loaded_at = Column(DateTime)
+    n_hands = Column(Integer)
+
+
+class StatsWatermarks(Base):
+    __tablename__ = 'stats_watermarks'
+
+    name = Column(String(50), primary_key=True)
+    ingest_id = Column(Integer)  # the hands up to this ingest batch are counted in the stats
+
+
+class SessionHeaders(Base):
+    __tablename__ = 'session_headers'
+
+    header_id = Column(BigInteger, primary_key=True, autoincrement=False)  # compression.session_header_id
+    header = Column(Text)
 
-    hand_id = Column(Integer, primary_key=True)
-    hand_history = Column(Text)
+
+class CompressionDictionaries(Base):
+    __tablename__ = 'compression_dictionaries'
+
+    dictionary_id = Column(Integer, primary_key=True, autoincrement=False)
+    dictionary = Column(LargeBinary)
 
 
 class HandInfo(Base):
     __tablename__ = 'hand_info'
+    __table_args__ = (
+        Index('ix_hand_info_limit', 'big_blind', 'n_active_players', 'start_date'),
+        Index('ix_hand_info_start_date', 'start_date'),
+    )
 
-    hand_id = Column(Integer, primary_key=True)
+    hand_id = Column(BigInteger, primary_key=True, autoincrement=False)
     start_date = Column(DateTime)
     game_type = Column(String(50))
     mode = Column(String(50))
     table_name = Column(String(50))
     table_currency = Column(String(50))
-    small_blind = Column(String(50))
-    big_blind = Column(String(50))
+    small_blind = Column(Integer)  # in cents
+    big_blind = Column(Integer)  # in cents
     n_active_players = Column(Integer)
+    last_round = Column(Integer)  # highest <round no> of the hand, 2 or more means the flop was dealt
+
+
+class Actions(Base):
+    __tablename__ = 'actions'
+    __table_args__ = (
+        Index('ix_actions_round', 'round_no', 'hand_id', 'player_id', 'action_no'),
+        Index('ix_actions_hand_player', 'hand_id', 'player_id', 'round_no'),
+    )
+
+    hand_id = Column(BigInteger, primary_key=True)
+    action_no = Column(Integer, primary_key=True)
+    round_no = Column(Integer)
+    action_type = Column(Integer)
+    amount = Column(Integer)  # in cents
+    player_id = Column(Integer)
+
+
+class HandPlayers(Base):
+    __tablename__ = 'hand_players'
+
+    hand_id = Column(BigInteger, primary_key=True)
+    player_id = Column(Integer, primary_key=True)
+    player_no = Column(Integer)  # order of the player in the handhistory
+    seat = Column(Integer)
+    dealer = Column(Integer)
+    bet = Column(Integer)  # in cents
+    win = Column(Integer)  # in cents
+    chips = Column(Integer)  # in cents
+
+# size of one executemany batch of the bulk loader
+BULK_LOAD_BATCH_BYTES = 4 * 1024 * 1024
+BULK_LOAD_MAX_BATCH_ROWS = 50000
+
+# keys which identify a row for the 'ignore' and 'update' load modes
+UPSERT_KEYS = {
+    'players': ['player'],
+    'player_stats': ['player_id'],
+    'player_stats_cube': ['player_id', 'big_blind', 'n_active_players', 'month'],
+    'player_timestamps': ['hand_id', 'player_id'],
+    'hand_history': ['hand_id'],
+    'session_headers': ['header_id'],
+    'compression_dictionaries': ['dictionary_id'],
+    'ingest_batches': ['ingest_id'],
+    'stats_watermarks': ['name'],
+    'hand_info': ['hand_id'],
+    'actions': ['hand_id', 'action_no'],
+    'hand_players': ['hand_id', 'player_id']
+}
+LOAD_DATA_CONFLICT = {None: '', 'ignore': 'IGNORE ', 'update': 'REPLACE '}
+
+# lists of hand_ids up to this length are sent as bound parameters, longer ones through a temporary table
+IN_LIST_MAX_LENGTH = 1000
+HAND_ID_TEMP_TABLE = 'tmp_hand_ids'
+
+# one page of the keyset pagination over the hand_history table, the condition may refer to the table as hh
+HAND_HISTORY_PAGE_QUERY = """
+    SELECT hh.hand_id, hh.hand_history, sh.header, hh.body
+    FROM hand_history AS hh LEFT JOIN session_headers AS sh ON hh.header_id = sh.header_id
+    WHERE hh.hand_id > :last_hand_id{condition}
+    ORDER BY hh.hand_id
+    LIMIT :batch_size
+"""
+HAND_ID_PAGE_QUERY = """
+    SELECT hh.hand_id
+    FROM hand_history AS hh
+    WHERE hh.hand_id > :last_hand_id{condition}
+    ORDER BY hh.hand_id
+    LIMIT :batch_size
+"""
+
+
+def hand_page_query(condition=None, hand_ids_only=False):
+    """The page query of iter_hand_histories, condition is an optional sql condition on hand_history (alias hh)."""
+    page_query = HAND_ID_PAGE_QUERY if hand_ids_only else HAND_HISTORY_PAGE_QUERY
+    return page_query.format(condition=f' AND ({condition})' if condition else '')
+
+
+# {hand_ids} is filled in by get_table_as_df_for_hand_ids
+HAND_HISTORIES_QUERY = """
+    SELECT hh.hand_id, hh.hand_history, sh.header, hh.body
+    FROM hand_history AS hh LEFT JOIN session_headers AS sh ON hh.header_id = sh.header_id
+    WHERE hh.hand_id IN {hand_ids}
+"""
+
+# tables which referenced the players by name in older versions
+PLAYER_FACT_TABLES = ['player_stats', 'player_timestamps', 'actions', 'hand_players']
+
+###### BULK LOADING #####
+def _column_to_python(series):
+    # plain python values, the database drivers cannot bind numpy types
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return [None if value is pd.NaT else value.to_pydatetime() for value in series.astype(object)]
+    # NaN and pd.NA of the nullable dtypes -> None
+    return [None if pd.isna(value) else value for value in series.tolist()]
+
+
+def _column_bytes(values):
+    if values and isinstance(next((value for value in values if value is not None), None), (str, bytes)):
+        return sum(len(value) for value in values if value is not None)
+    return 8 * len(values)
+
+
+def _tune_batch_size(avg_row_bytes):
+    return int(min(max(BULK_LOAD_BATCH_BYTES / max(avg_row_bytes, 1), 1), BULK_LOAD_MAX_BATCH_ROWS))
+
+
+def _upsert_sql(table_name, columns, keys, on_conflict, source=None):
+    # insert statement of SQLite and DuckDB, the rows come from the source query or from ? parameters
+    values = f"({', '.join(columns)}) " + (source or f"VALUES ({', '.join('?' * len(columns))})")
+    if on_conflict == 'ignore':
+        return f"INSERT OR IGNORE INTO {table_name} {values}"
+    if on_conflict == 'update':
+        updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column not in keys)
+        action = f'DO UPDATE SET {updates}' if updates else 'DO NOTHING'
+        return f"INSERT INTO {table_name} {values} ON CONFLICT ({', '.join(keys)}) {action}"
+    return f"INSERT INTO {table_name} {values}"
+
+
+def _tsv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class LatencyMetrics:
+    """Count, total and maximum of a latency, the most recent samples are kept for the percentiles."""
+
+    def __init__(self, n_samples=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=n_samples)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.samples.append(seconds)
+
+    def summary(self):
+        """Return count, mean, p50, p95 and max, the times in milliseconds."""
+        with self._lock:
+            samples = sorted(self.samples)
+            count, total, maximum = self.count, self.total, self.max
+
+        def percentile(fraction):
+            return samples[min(int(fraction * len(samples)), len(samples) - 1)] * 1000 if samples else 0.0
+
+        return {'count': count, 'mean_ms': total / count * 1000 if count else 0.0,
+                'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95), 'max_ms': maximum * 1000}
+
 
 ###### DATABASE HANDLING #####
+def _unfinished_swap(column_types, column_name):
+    # _replace_column stopped between dropping the old column and renaming the new one
+    return column_name not in column_types and f'{column_name}_typed' in column_types
+
+
+def _first_rows_condition(table, old_table_name, old_columns):
+    # like _delete_duplicate_rows, the row with the lowest primary key of each value of a unique index
+    key = table.primary_key.columns.values()[0].name
+    conditions = []
+    for index in table.indexes:
+        if not index.unique or key not in old_columns:
+            continue
+        group_by = ', '.join('p2.player_id' if column.name == 'player_id' else f'o2.{column.name}'
+                             for column in index.columns)
+        conditions.append(f"o.{key} IN (SELECT MIN(o2.{key}) FROM {old_table_name} AS o2 "
+                          f"JOIN players AS p2 ON o2.player = p2.player GROUP BY {group_by})")
+    return f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+
 class DataBaseManagement():
-    def __init__(self, url, create_all_tables=False):
+    def __init__(self, url, create_all_tables=False, use_load_data=False, pool_size=5, max_overflow=10,
+                 pool_timeout=30, pool_recycle=3600, pool_pre_ping=True):
+        """
+        :param url: sqlalchemy url of a MySQL, SQLite or DuckDB database (DuckDB needs the optional duckdb_engine)
+        :param pool_size: number of connections kept open in the pool
+        :param max_overflow: connections opened on top of pool_size under load, closed again when returned
+        :param pool_timeout: seconds to wait for a free connection before raising an error
+        :param pool_recycle: connections older than this many seconds are replaced, before the server drops them
+        :param pool_pre_ping: test connections on checkout and replace the ones the server has closed
+        """
         self.url = url
-        self.engine = create_engine(url)
+        # load with LOAD DATA LOCAL INFILE instead of executemany on MySQL
+        self.use_load_data = use_load_data
+        engine_options = {'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+        url_parts = make_url(url)
+        # in-memory sqlite databases live in one connection, they have no pool to size
+        if url_parts.get_backend_name() != 'sqlite' or url_parts.database not in (None, '', ':memory:'):
+            engine_options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+        self.engine = create_engine(url, **engine_options)
         self.SessionLocal = sessionmaker(bind=self.engine)
 
+        # latency of getting a connection from the pool and of every statement sent to the database
+        self.metrics = {'checkout': LatencyMetrics(), 'query': LatencyMetrics()}
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute', self._after_cursor_execute)
+
         if create_all_tables:
             self.create_all_tables()
 
     def create_all_tables(self):
         Base.metadata.create_all(self.engine, checkfirst=True)
+        self.migrate_typed_columns()
+        self.migrate_player_ids()
+        self.add_missing_columns()
+        self.create_missing_indexes()
+
+    def add_missing_columns(self):
+        """Add the columns of the models which are missing in tables created by an older version."""
+        inspector = inspect(self.engine)
+        with self.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing_columns:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    logger.warning(f'Adding missing column {column.name} to table {table.name}')
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+    def create_missing_indexes(self):
+        """Create the indexes of the models which are missing in existing tables."""
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing_indexes = self._index_names(inspector, table.name)
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.unique:
+                    self._delete_duplicate_rows(table, [column.name for column in index.columns])
+                logger.warning(f'Creating missing index {index.name} on table {table.name}')
+                index.create(self.engine)
+
+    def _index_names(self, inspector, table_name):
+        if self.engine.dialect.name == 'duckdb':
+            # duckdb_engine cannot reflect indexes, they are listed by the catalog function
+            with self.connect() as connection:
+                return {row[0] for row in connection.execute(
+                    text('SELECT index_name FROM duckdb_indexes() WHERE table_name = :table_name'),
+                    {'table_name': table_name})}
+        return {index['name'] for index in inspector.get_indexes(table_name)}
+
+    def _delete_duplicate_rows(self, table, columns):
+        """Keep only the first row (lowest primary key) of the rows with the same values in the columns."""
+        key = table.primary_key.columns.values()[0].name
+        group_by = ', '.join(columns)
+        with self.begin() as connection:
+            # the extra derived table lets MySQL select from the table it deletes from
+            result = connection.execute(text(
+                f"DELETE FROM {table.name} WHERE {key} NOT IN "
+                f"(SELECT {key} FROM (SELECT MIN({key}) AS {key} FROM {table.name} GROUP BY {group_by}) AS keep_rows)"))
+        if result.rowcount:
+            logger.warning(f'Deleted {result.rowcount} duplicate rows of ({group_by}) from {table.name}')
+
+    def explain_query(self, query, params=None):
+        """
+        Get the query plan of a select query and the tables which are read with a full table scan.
+
+        :return: (plan, full_scans), plan as list of strings, one for each step
+        """
+        plan = []
+        full_scans = []
+        with self.connect() as connection:
+            if self.engine.dialect.name == 'sqlite':
+                subqueries = set()
+                for row in connection.execute(text(f'EXPLAIN QUERY PLAN {query}'), params or {}):
+                    detail = row[-1]
+                    plan.append(detail)
+                    if detail.startswith('MATERIALIZE '):
+                        subqueries.add(detail.split()[1])
+                    # 'SCAN pt' reads the whole table, 'SCAN pt USING INDEX ...' only the index
+                    elif detail.startswith('SCAN ') and ' USING ' not in detail:
+                        if detail.split()[1] not in subqueries:
+                            full_scans.append(detail.split()[1])
+            elif self.engine.dialect.name == 'duckdb':
+                # duckdb reads the columns sequentially with min/max pruning, a scan is no missing index
+                for row in connection.execute(text(f'EXPLAIN {query}'), params or {}):
+                    plan.extend(row[-1].splitlines())
+            else:
+                result = connection.execute(text(f'EXPLAIN {query}'), params or {})
+                for row in result.mappings():
+                    plan.append(', '.join(f'{key}={value}' for key, value in row.items()))
+                    if row['type'] == 'ALL':
+                        full_scans.append(row['table'])
+        return plan, full_scans
+
+    @contextmanager
+    def connect(self):
+        """Check out a connection of the pool, the waiting time is recorded in the checkout metrics."""
+        start_time = time.perf_counter()
+        connection = self.engine.connect()
+        self.metrics['checkout'].add(time.perf_counter() - start_time)
+        with connection:
+            yield connection
+
+    @contextmanager
+    def begin(self):
+        """Like connect, inside a transaction which is committed at the end or rolled back on an error."""
+        with self.connect() as connection, connection.begin():
+            yield connection
 
-    def mysql_query(self, query):
-        session = self.SessionLocal()
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['query_start_time'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_time = conn.info.pop('query_start_time', None)
+        if start_time is not None:
+            self.metrics['query'].add(time.perf_counter() - start_time)
+
+    def query_metrics(self):
+        """Latencies of the pool checkouts and the queries (see LatencyMetrics.summary) and the pool status."""
+        return {'checkout': self.metrics['checkout'].summary(),
+                'query': self.metrics['query'].summary(),
+                'pool': self.engine.pool.status()}
+
+    def log_query_metrics(self):
+        for name in ('checkout', 'query'):
+            summary = self.metrics[name].summary()
+            logger.info(f"{name}: {summary['count']} times, mean {summary['mean_ms']:.2f}ms, "
+                        f"p50 {summary['p50_ms']:.2f}ms, p95 {summary['p95_ms']:.2f}ms, max {summary['max_ms']:.2f}ms")
+        logger.info(self.engine.pool.status())
+
+    def mysql_query(self, query, params=None):
         try:
-            logger.info('Trying to create the table')
-            session.execute(text(query))
+            with self.begin() as connection:
+                connection.execute(text(query), params or {})
             logger.info('mysql_query sent')
-        except:
+        except Exception:
             logger.error(f'Query cannot be sent: {query}')
-        finally:
-            logger.info('Closing sql session')
-            session.close()
 
-    def my_sql_select_query(self, query, single_value=False):
-        session = self.SessionLocal()
+    def my_sql_select_query(self, query, single_value=False, params=None):
         try:
-            result = session.execute(text(query))
-            if single_value:
-                return round(float(result.scalar()), 3)
-            else:
-                return result.fetchall()
+            with self.connect() as connection:
+                result = connection.execute(text(query), params or {})
+                if single_value:
+                    return round(float(result.scalar()), 3)
+                else:
+                    return result.fetchall()
         except Exception as e:
             print(f"An error occured in my_sql_select_query returning 0: {e}")
             return 0
-        finally:
-            session.close()
 
 
-    def get_table_as_df(self, query, index_col=None):
+    def migrate_typed_columns(self):
+        """
+        Convert the tables of older versions in place to the typed schema.
+
+        Blinds stored as text like '0,50' or '€1' become integer cents and start dates stored as text become
+        DATETIME. Each column is converted into a new column, which then replaces the old one.
+        """
+        inspector = inspect(self.engine)
+        existing_tables = inspector.get_table_names()
+        for table_name, column_name in (('hand_info', 'small_blind'), ('hand_info', 'big_blind'),
+                                        ('player_timestamps', 'big_blind')):
+            if table_name not in existing_tables:
+                continue
+            column_types = {column['name']: column['type'] for column in inspector.get_columns(table_name)}
+            if isinstance(column_types.get(column_name), String) or _unfinished_swap(column_types, column_name):
+                logger.warning(f'Migrating {table_name}.{column_name} to integer cents')
+                self._replace_column(table_name, column_name, Integer(), convert=euro_to_cents)
+
+        # sqlite stores DATETIME as text anyway, other databases need a real DATETIME column
+        if self.engine.dialect.name == 'sqlite':
+            return
+        for table_name in ('hand_info', 'player_timestamps'):
+            if table_name not in existing_tables:
+                continue
+            column_types = {column['name']: column['type'] for column in inspector.get_columns(table_name)}
+            if isinstance(column_types.get('start_date'), String) or _unfinished_swap(column_types, 'start_date'):
+                logger.warning(f'Migrating {table_name}.start_date to DATETIME')
+                self._replace_column(table_name, 'start_date', DateTime(), sql_cast='DATETIME')
+
+    def _replace_column(self, table_name, column_name, new_type, convert=None, sql_cast=None):
+        """
+        Convert the column into {column_name}_typed, then swap it with the old column.
+
+        Every step can run again after a crash or an error (MySQL commits each DDL statement on its own):
+        an existing {column_name}_typed is reused and filled again, the old column is only dropped when all its
+        values are converted, and a swap which stopped after the drop is finished with the rename.
+        """
+        new_column = f'{column_name}_typed'
+        columns = {column['name'] for column in inspect(self.engine).get_columns(table_name)}
+        if column_name in columns:
+            new_values = []
+            if convert:
+                # only few distinct values (the limits), so convert each one in python before changing anything
+                with self.connect() as connection:
+                    values = connection.execute(text(f'SELECT DISTINCT {column_name} FROM {table_name} '
+                                                     f'WHERE {column_name} IS NOT NULL')).scalars().all()
+                new_values = [{'new_value': convert(value), 'old_value': value} for value in values]
+            if new_column not in columns:
+                column_type = new_type.compile(dialect=self.engine.dialect)
+                with self.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {new_column} {column_type}'))
+            with self.begin() as connection:
+                if sql_cast:
+                    connection.execute(text(f'UPDATE {table_name} SET {new_column} = '
+                                            f'CAST({column_name} AS {sql_cast})'))
+                elif new_values:
+                    connection.execute(text(f'UPDATE {table_name} SET {new_column} = :new_value '
+                                            f'WHERE {column_name} = :old_value'), new_values)
+                n_unconverted = connection.execute(text(f'SELECT COUNT(*) FROM {table_name} WHERE {column_name} '
+                                                        f'IS NOT NULL AND {new_column} IS NULL')).scalar()
+            if n_unconverted:
+                raise ValueError(f'{n_unconverted} values of {table_name}.{column_name} cannot be converted, '
+                                 f'the column is kept')
+            with self.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table_name} DROP COLUMN {column_name}'))
+                connection.execute(text(f'ALTER TABLE {table_name} RENAME COLUMN {new_column} TO {column_name}'))
+        else:
+            with self.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table_name} RENAME COLUMN {new_column} TO {column_name}'))
+
+    def migrate_player_ids(self):
+        """
+        Replace the player names in the fact tables of older versions by the player_id of the players table.
+
+        Every table which still has a player column is renamed, created again from the model and
+        filled with the old rows joined to the players table. Of the old rows which break a unique index of the
+        model only the first one is copied. On MySQL the DDL commits at once, a migration which stopped after the
+        rename is finished from the renamed table on the next run.
+        """
+        inspector = inspect(self.engine)
+        existing_tables = inspector.get_table_names()
+        for table_name in PLAYER_FACT_TABLES:
+            old_table_name = f'{table_name}_old'
+            if old_table_name in existing_tables:
+                logger.warning(f'Finishing the migration of {table_name} to player ids')
+            elif table_name in existing_tables and \
+                    'player' in {column['name'] for column in inspector.get_columns(table_name)}:
+                logger.warning(f'Migrating {table_name} to player ids')
+                with self.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE {table_name} RENAME TO {old_table_name}'))
+            else:
+                continue
+            old_columns = [column['name'] for column in inspector.get_columns(old_table_name)]
+            table = Base.metadata.tables[table_name]
+            copy_columns = [column.name for column in table.columns
+                            if column.name in old_columns and column.name != 'player_id']
+            with self.begin() as connection:
+                connection.execute(text(f'INSERT INTO players (player) SELECT DISTINCT player FROM {old_table_name} '
+                                        f'WHERE player IS NOT NULL AND player NOT IN (SELECT player FROM players)'))
+                table.create(connection, checkfirst=True)
+                connection.execute(text(
+                    f"INSERT INTO {table_name} ({', '.join(copy_columns + ['player_id'])}) "
+                    f"SELECT {', '.join('o.' + column for column in copy_columns)}, p.player_id "
+                    f"FROM {old_table_name} AS o JOIN players AS p ON o.player = p.player"
+                    f"{_first_rows_condition(table, old_table_name, old_columns)}"))
+                connection.execute(text(f'DROP TABLE {old_table_name}'))
+
+    def iter_query_batches(self, query, batch_size=100000, params=None):
+        """Run a select query and yield the rows in lists of batch_size, without building a dataframe."""
+        with self.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(text(query), params or {})
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def iter_hand_histories(self, batch_size=1000, condition=None, raw_store=None, params=None):
+        """
+        Yield the stored hands as lists of (hand_id, hand_history) rows, ordered by hand_id.
+        Compressed hands are restored to their original xml.
+
+        Every batch is a separate query that continues after the last hand_id of the previous batch (keyset
+        pagination on the primary key), so only one batch is in memory and no cursor is held open between batches.
+
+        :param batch_size: number of hands per batch
+        :param condition: optional sql condition on the hand_history table (alias hh), e.g. to skip parsed hands
+        :param raw_store: optional RawHandStore, only the hand_ids are queried and the hands are read from the
+            store, the ones which are not in it from the database
+        :param params: values of the bound parameters of the condition
+        """
+        query = text(hand_page_query(condition, hand_ids_only=raw_store is not None))
+        last_hand_id = -1
+        while True:
+            with self.connect() as connection:
+                rows = connection.execute(query, {**(params or {}), 'last_hand_id': last_hand_id,
+                                                  'batch_size': batch_size}).fetchall()
+            if not rows:
+                break
+            if raw_store is not None:
+                hand_histories = self.get_hand_histories([row[0] for row in rows], raw_store=raw_store)
+                yield list(zip(hand_histories['hand_id'], hand_histories['hand_history']))
+            else:
+                yield self._decode_hand_rows(rows)
+            last_hand_id = rows[-1][0]
+
+    def hand_history_codec(self, refresh=False):
+        """The codec with the dictionaries of the compression_dictionaries table, loaded once."""
+        if refresh or getattr(self, '_codec', None) is None:
+            dictionaries = {}
+            for rows in self.iter_query_batches('SELECT dictionary_id, dictionary FROM compression_dictionaries'):
+                dictionaries.update((dictionary_id, bytes(dictionary)) for dictionary_id, dictionary in rows)
+            self._codec = compression.HandHistoryCodec(dictionaries)
+        return self._codec
+
+    def _decode_hand_rows(self, rows):
+        # rows of (hand_id, hand_history, header, body) -> (hand_id, hand_history)
+        codec = self.hand_history_codec()
+        decoded = []
+        for hand_id, hand_history, header, body in rows:
+            if body is not None:
+                try:
+                    hand_history = codec.decode(header, body)
+                except KeyError:
+                    # a dictionary which was added by another process since the codec was loaded
+                    codec = self.hand_history_codec(refresh=True)
+                    hand_history = codec.decode(header, body)
+            decoded.append((hand_id, hand_history))
+        return decoded
+
+    def get_hand_histories(self, hand_ids, raw_store=None):
+        """
+        Get the xml of the hands as dataframe with the columns hand_id and hand_history, in the order of hand_ids.
+
+        :param raw_store: optional RawHandStore, only the hands which are not in it are queried from the database
+        """
+        hand_ids = list(dict.fromkeys(hand_ids))
+        hands = raw_store.get_text(hand_ids) if raw_store is not None else {}
+        missing_hand_ids = [hand_id for hand_id in hand_ids if hand_id not in hands]
+        if missing_hand_ids:
+            rows = self.get_table_as_df_for_hand_ids(HAND_HISTORIES_QUERY, missing_hand_ids)
+            if rows is None:
+                return None
+            hands.update(self._decode_hand_rows(rows.itertuples(index=False, name=None)))
+        return pd.DataFrame([(hand_id, hands[hand_id]) for hand_id in hand_ids if hand_id in hands],
+                            columns=['hand_id', 'hand_history'])
+
+    def fill_raw_store(self, raw_store, batch_size=1000):
+        """Copy the hands of the hand_history table which are not in the RawHandStore yet into it."""
+        n_appended = 0
+        for rows in self.iter_hand_histories(batch_size=batch_size):
+            n_appended += raw_store.append(rows)
+            raw_store.commit()
+        logger.info(f"Added {n_appended} hands to the raw hand store.")
+        return n_appended
+
+    def store_dictionary(self, dictionary):
+        """
+        Store a new compression dictionary in its own transaction and return the codec with the stored ones.
+
+        The codec is read again after the commit, so it only contains dictionaries which are in the table.
+        If another process stored a dictionary with the same id first, its dictionary is used instead.
+        """
+        dictionary_id = (self.hand_history_codec(refresh=True).dictionary_id or 0) + 1
+        with self.begin() as connection:
+            self.bulk_insert(pd.DataFrame([{'dictionary_id': dictionary_id, 'dictionary': dictionary}]),
+                             'compression_dictionaries', connection, on_conflict='ignore')
+        return self.hand_history_codec(refresh=True)
+
+    def encode_hand_histories(self, hand_histories):
+        """
+        Compress the rows of the hand_history table.
+
+        Without a stored dictionary, one is trained from the first DICTIONARY_MIN_HANDS hands and committed
+        before the hands are compressed with it, so a batch which fails to load leaves no unknown dictionary.
+
+        :param hand_histories: list of dicts with hand_id and hand_history
+        :return: dict of table name -> dataframe for session_headers and hand_history
+        """
+        codec = self.hand_history_codec()
+        if codec.dictionary_id is None and len(hand_histories) >= compression.DICTIONARY_MIN_HANDS:
+            bodies = [compression.split_hand_history(row['hand_history'])[1] for row in hand_histories]
+            codec = self.store_dictionary(compression.train_dictionary(bodies))
+        headers = {}
+        rows = []
+        for row in hand_histories:
+            header_id, header, body = codec.encode(row['hand_history'])
+            headers[header_id] = header
+            rows.append({'hand_id': row['hand_id'], 'header_id': header_id, 'body': body})
+        return {'session_headers': pd.DataFrame(list(headers.items()), columns=['header_id', 'header']),
+                'hand_history': pd.DataFrame(rows, columns=['hand_id', 'header_id', 'body'])}
+
+    def compress_stored_hand_histories(self, batch_size=1000):
+        """
+        Compress the hands which were stored as plain xml by an older version, in batches of batch_size hands.
+
+        MySQL only gives the space of the table free after an OPTIMIZE TABLE hand_history.
+        """
+        n_hands = 0
+        for rows in self.iter_hand_histories(batch_size=batch_size, condition='hh.body IS NULL'):
+            tables = self.encode_hand_histories([{'hand_id': hand_id, 'hand_history': hand_history}
+                                                 for hand_id, hand_history in rows if hand_history is not None])
+            with self.begin() as connection:
+                if not tables['session_headers'].empty:
+                    self.bulk_insert(tables['session_headers'], 'session_headers', connection, on_conflict='ignore')
+                connection.execute(text('UPDATE hand_history SET header_id = :header_id, body = :body, '
+                                        'hand_history = NULL WHERE hand_id = :hand_id'),
+                                   tables['hand_history'].to_dict('records'))
+            n_hands += len(tables['hand_history'])
+        logger.info(f'Compressed {n_hands} stored hand histories')
+        return n_hands
+
+    def get_table_as_df(self, query, index_col=None, params=None, parse_dates=None):
         try:
-            df = pd.read_sql(query, self.engine, index_col=index_col)
-            return df
+            with self.connect() as connection:
+                # parse_dates for the backends which return the dates of a text query as strings (SQLite)
+                return pd.read_sql(text(query), connection, index_col=index_col, params=params,
+                                   parse_dates=parse_dates)
         except Exception as e:
-            logger.error("Cannot get the table as dataframe. Error: ", e)
+            logger.error(f"Cannot get the table as dataframe. Error: {e}")
+
+    def get_table_as_df_for_hand_ids(self, query, hand_ids, index_col=None, params=None):
+        """
+        Run a query which is restricted to a list of hand_ids by an 'IN {hand_ids}' placeholder.
+
+        Up to IN_LIST_MAX_LENGTH hand_ids are sent as one bound parameter list, longer lists are written to
+        a temporary table of the connection and the query selects from it.
+        """
+        hand_ids = [int(hand_id) for hand_id in hand_ids]
+        params = dict(params or {})
+        try:
+            with self.connect() as connection:
+                if len(hand_ids) > IN_LIST_MAX_LENGTH:
+                    self._fill_hand_id_table(connection, hand_ids)
+                    statement = text(query.replace('{hand_ids}', f'(SELECT hand_id FROM {HAND_ID_TEMP_TABLE})'))
+                else:
+                    statement = text(query.replace('{hand_ids}', ':hand_ids')).bindparams(
+                        bindparam('hand_ids', expanding=True))
+                    params['hand_ids'] = hand_ids
+                return pd.read_sql(statement, connection, index_col=index_col, params=params)
+        except Exception as e:
+            logger.error(f"Cannot get the table as dataframe. Error: {e}")
+
+    def _fill_hand_id_table(self, connection, hand_ids):
+        # temporary tables belong to the connection, they are emptied before every use
+        connection.execute(text(f'CREATE TEMPORARY TABLE IF NOT EXISTS {HAND_ID_TEMP_TABLE} '
+                                f'(hand_id BIGINT PRIMARY KEY)'))
+        connection.execute(text(f'DELETE FROM {HAND_ID_TEMP_TABLE}'))
+        connection.execute(text(f'INSERT INTO {HAND_ID_TEMP_TABLE} (hand_id) VALUES (:hand_id)'),
+                           [{'hand_id': hand_id} for hand_id in set(hand_ids)])
 
     def truncate_table(self, table_name):
-        query = f"""TRUNCATE TABLE {table_name};"""
+        if self.engine.dialect.name in ('sqlite', 'duckdb'):
+            query = f"""DELETE FROM {table_name};"""
+        else:
+            query = f"""TRUNCATE TABLE {table_name};"""
         self.mysql_query(query)
 
     def load_table_player_timestamps(self, df, index=False, if_exists='append'):
         # check if table exists
         table_name = 'player_timestamps'
         try:
-            self.send_df_to_table(df=df, table=table_name, index=index, if_exists=if_exists)
+            self.send_df_to_table(df=df, table=table_name, index=index, if_exists=if_exists, on_conflict='ignore')
         except Exception as e:
             print(f"Failed to load the {table_name}. \n Error: {e}")
 
@@ -116,7 +823,8 @@ class DataBaseManagement():
         print(f'Len of {table_name} table: {len(df)}')
         try:
             start_time = time.time()
-            self.send_df_to_table(df, table_name, index=index, if_exists=if_exists, chunks=True)
+            self.send_df_to_table(df, table_name, index=index, if_exists=if_exists, chunks=True,
+                                  on_conflict='ignore')
             end_time = time.time()
             print(f'Duration of loading {table_name}: {end_time - start_time}')
         except Exception as e:
@@ -127,25 +835,93 @@ class DataBaseManagement():
         print(f'Len of {table_name} table: {len(df)}')
         try:
             start_time = time.time()
-            self.send_df_to_table(df, table_name, index=index, if_exists=if_exists)
+            self.send_df_to_table(df, table_name, index=index, if_exists=if_exists, on_conflict='ignore')
             end_time = time.time()
             print(f'Duration of loading {table_name}: {end_time - start_time}')
         except Exception as e:
             print(f"Failed to load the player_timestamp table to the database. \n Error: {e}")
 
-    def load_stats_table(self, df, index=False, if_exists='replace'):
-        table_name = 'player_stats'
+    def load_stats_table(self, df, index=False, if_exists='replace', watermark=None, table_name='player_stats'):
+        """
+        Store the player stats, 'replace' replaces all rows, 'append' updates the rows with the keys of df.
+
+        :param watermark: ingest_id up to which the hands are counted in the stats, stored in the same transaction
+        :param table_name: player_stats or player_stats_cube, the watermark is stored under this name
+        """
         try:
-            self.send_df_to_table(df, table_name, index=index, if_exists=if_exists)
+            with self.begin() as connection:
+                if if_exists == 'replace':
+                    # replace the rows, but keep the table definition with its keys
+                    connection.execute(text(f'DELETE FROM {table_name}'))
+                    self.bulk_insert(df, table_name, connection)
+                else:
+                    self.bulk_insert(df, table_name, connection, on_conflict='update')
+                if watermark is not None:
+                    self.bulk_insert(pd.DataFrame({'name': [table_name], 'ingest_id': [watermark]}),
+                                     'stats_watermarks', connection, on_conflict='update')
         except Exception as e:
             logger.error(f"Failed to load the {table_name} to the database. \n Error: {e}")
 
-    def send_df_to_table(self, df, table, index=False, if_exists='append', chunks=False, chunk_size=4500):
-        session = self.SessionLocal()
+    def get_watermark(self, name):
+        """The ingest_id up to which the hands are counted in the table name, None if it was never calculated."""
+        try:
+            with self.connect() as connection:
+                return connection.execute(text('SELECT ingest_id FROM stats_watermarks WHERE name = :name'),
+                                          {'name': name}).scalar()
+        except Exception as e:
+            logger.warning(f"Cannot read the watermark of {name}. Error: {e}")
+            return None
+
+    def last_ingest_id(self):
+        """The ingest_id of the last loaded ingest batch, None if no batch was loaded yet."""
+        try:
+            with self.connect() as connection:
+                return connection.execute(text('SELECT MAX(ingest_id) FROM ingest_batches')).scalar()
+        except Exception as e:
+            logger.warning(f"Cannot read the ingest batches. Error: {e}")
+            return None
+
+    def load_ingest_batch(self, tables, on_conflict='ignore'):
+        """
+        Load the tables of one ingest batch in a single transaction.
+
+        Either all rows of the batch are committed or none, so an interrupted ingestion can be started again
+        and continues after the last committed batch. Errors are raised after the rollback.
+        Rows which are already in the tables are skipped by the database, so loading a batch twice is harmless.
+        The hands get the ingest_id of a new row of ingest_batches, the incremental stats update counts the hands
+        after its watermark by it.
+
+        :param tables: dict of table name -> dataframe, loaded in this order
+        :param on_conflict: 'ignore' or 'update' for rows which are already in the table, see bulk_insert
+        :return: dict of table name -> number of inserted rows, None if the backend doesn't report it
+        """
+        start_time = time.time()
+        inserted = {}
+        with self.begin() as connection:
+            for table_name, df in tables.items():
+                if df.empty:
+                    continue
+                if table_name == 'hand_history':
+                    result = connection.execute(self._get_table('ingest_batches').insert().values(
+                        loaded_at=datetime.now(), n_hands=len(df)))
+                    df = df.assign(ingest_id=result.inserted_primary_key[0])
+                inserted[table_name] = self.bulk_insert(df, table_name, connection, on_conflict=on_conflict)['inserted']
+        end_time = time.time()
+        logger.info(f"Loaded ingest batch of {len(tables.get('hand_history', []))} hands "
+                    f"in {end_time - start_time:.2f}s")
+        return inserted
+
+    def send_df_to_table(self, df, table, index=False, if_exists='append', chunks=False, chunk_size=4500,
+                         on_conflict=None):
         try:
+            # appending to an existing table goes through the bulk loader in one transaction,
+            # everything else (creating or replacing tables) through pandas
+            if if_exists == 'append' and not index and inspect(self.engine).has_table(table):
+                with self.begin() as connection:
+                    self.bulk_insert(df, table, connection, on_conflict=on_conflict)
             # sending only 5000 rows at once
             # if the table is too big to send
-            if chunks:
+            elif chunks:
                 chunk_size = chunk_size
                 num_chunks = len(df) // chunk_size + (1 if len(df) % chunk_size else 0)
                 for i in range(num_chunks):
@@ -157,5 +933,143 @@ class DataBaseManagement():
                 df.to_sql(table, self.engine, index=index, if_exists=if_exists)
         except Exception as e:
             logger.error(f'Cannot load the table to the database. Error: {e}')
+
+    def bulk_insert(self, df, table_name, connection, on_conflict=None):
+        """
+        Insert the rows of the dataframe into an existing table with the fastest path of the backend.
+
+        on_conflict decides what happens with rows whose key (UPSERT_KEYS) is already in the table:
+        None raises an error, 'ignore' keeps the existing row and 'update' overwrites it with the new values.
+
+        On SQLite all rows go through one executemany of the driver. On MySQL the rows are sent as multi-row
+        inserts in batches of about BULK_LOAD_BATCH_BYTES, the batch size is tuned to the width of the rows.
+        With use_load_data=True they are loaded from a temporary tsv file with LOAD DATA LOCAL INFILE instead
+        (needs allow_local_infile=True in the connect args). Runs inside the transaction of the given connection.
+
+        :return: dict with rows, bytes, seconds, rows_per_s, mb_per_s and inserted (None if unknown)
+        """
+        if on_conflict not in (None, 'ignore', 'update'):
+            raise ValueError(f"on_conflict has to be None, 'ignore' or 'update', got {on_conflict}")
+        start_time = time.time()
+        inserted = None
+        columns = list(df.columns)
+        column_values = [_column_to_python(df[column]) for column in columns]
+        rows = list(zip(*column_values))
+        n_bytes = sum(_column_bytes(values) for values in column_values)
+
+        if not rows:
+            pass
+        elif self.use_load_data and self.engine.dialect.name == 'mysql' and \
+                not any(isinstance(value, bytes) for value in rows[0]):  # binary columns don't fit in the tsv
+            self._load_data_infile(rows, table_name, columns, connection, on_conflict)
+        elif self.engine.dialect.name == 'duckdb':
+            # duckdb reads the dataframe directly, one INSERT ... SELECT for all rows
+            view_name = f'bulk_insert_{table_name}'
+            connection.connection.register(view_name, df)
+            try:
+                # the ids of sequence columns are not filled in by a raw insert
+                sequences = {column.name: column.default.name for column in self._get_table(table_name).columns
+                             if isinstance(column.default, Sequence) and column.name not in columns}
+                select = ', '.join(columns + [f"nextval('{sequence}')" for sequence in sequences.values()])
+                insert = _upsert_sql(table_name, columns + list(sequences), self._upsert_keys(table_name), on_conflict,
+                                     source=f"SELECT {select} FROM {view_name}")
+                inserted = connection.exec_driver_sql(insert).fetchone()[0]
+            finally:
+                connection.connection.unregister(view_name)
+        elif self.engine.dialect.name == 'sqlite':
+            # sqlite executemany straight on the driver, dates in the text format of sqlalchemy
+            insert = _upsert_sql(table_name, columns, self._upsert_keys(table_name), on_conflict)
+            rows = [tuple(value.strftime('%Y-%m-%d %H:%M:%S.%f') if isinstance(value, datetime) else value
+                          for value in row) for row in rows]
+            inserted = connection.exec_driver_sql(insert, rows).rowcount
+        else:
+            # multi-row inserts, sqlalchemy batches the rows of each execute into INSERT ... VALUES (...), (...)
+            table = self._get_table(table_name)
+            if on_conflict == 'ignore':
+                insert = table.insert().prefix_with('IGNORE')
+            elif on_conflict == 'update':
+                insert = mysql_insert(table)
+                keys = self._upsert_keys(table_name)
+                insert = insert.on_duplicate_key_update({column: insert.inserted[column]
+                                                         for column in columns if column not in keys})
+            else:
+                insert = table.insert()
+            batch_size = _tune_batch_size(n_bytes / len(rows))
+            # MySQL counts an updated row twice, the inserted rows are only known without updates
+            inserted = 0 if on_conflict != 'update' else None
+            for start in range(0, len(rows), batch_size):
+                result = connection.execute(insert, [dict(zip(columns, row)) for row in rows[start:start + batch_size]])
+                if inserted is not None:
+                    inserted += result.rowcount
+
+        seconds = max(time.time() - start_time, 1e-9)
+        stats = {'rows': len(rows), 'bytes': n_bytes, 'seconds': seconds, 'inserted': inserted,
+                 'rows_per_s': len(rows) / seconds, 'mb_per_s': n_bytes / 1024 / 1024 / seconds}
+        logger.info(f"Loaded {stats['rows']} rows into {table_name} in {seconds:.2f}s "
+                    f"({stats['rows_per_s']:.0f} rows/s, {stats['mb_per_s']:.2f} MB/s)")
+        if on_conflict == 'ignore' and inserted is not None and inserted >= 0 and inserted < len(rows):
+            logger.info(f"Skipped {len(rows) - inserted} rows which were already in {table_name}")
+        return stats
+
+    def _upsert_keys(self, table_name):
+        if table_name in UPSERT_KEYS:
+            return UPSERT_KEYS[table_name]
+        return [column.name for column in self._get_table(table_name).primary_key.columns]
+
+    def _get_table(self, table_name):
+        if table_name in Base.metadata.tables:
+            return Base.metadata.tables[table_name]
+        return Table(table_name, MetaData(), autoload_with=self.engine)
+
+    def _load_data_infile(self, rows, table_name, columns, connection, on_conflict=None):
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='UTF-8', newline='\n', delete=False) as tsv_file:
+            for row in rows:
+                tsv_file.write('\t'.join(_tsv_value(value) for value in row) + '\n')
+        try:
+            path = tsv_file.name.replace('\\', '/')
+            connection.exec_driver_sql(
+                f"LOAD DATA LOCAL INFILE '{path}' {LOAD_DATA_CONFLICT[on_conflict]}INTO TABLE {table_name} "
+                f"CHARACTER SET utf8mb4 "
+                f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                f"({', '.join(columns)})")
         finally:
-            session.close()
+            os.remove(tsv_file.name)
+
+
+class PlayerRegistry:
+    """
+    In-memory cache of player name -> player_id of the players table.
+
+    Unknown players are inserted into the players table before their ids are used, the database assigns the ids
+    and they are read back by the unique player name. So writers which run at the same time, e.g. an ingestion
+    and the stats, get the same id for the same name.
+    """
+
+    def __init__(self, db_connection):
+        self.db_connection = db_connection
+        self.player_ids = {}
+        for rows in db_connection.iter_query_batches('SELECT player_id, player FROM players'):
+            self.player_ids.update((player, player_id) for player_id, player in rows)
+
+    def register_players(self, players):
+        """Make sure the players have an id, the unknown ones are inserted in one transaction."""
+        new_players = list(dict.fromkeys(player for player in players if player not in self.player_ids))
+        if not new_players:
+            return
+        with self.db_connection.begin() as connection:
+            self.db_connection.bulk_insert(pd.DataFrame({'player': new_players}), 'players', connection,
+                                           on_conflict='ignore')
+        # the ids of the names, also of the ones another writer inserted first
+        query = text('SELECT player_id, player FROM players WHERE player IN :players').bindparams(
+            bindparam('players', expanding=True))
+        with self.db_connection.connect() as connection:
+            for start in range(0, len(new_players), IN_LIST_MAX_LENGTH):
+                rows = connection.execute(query, {'players': new_players[start:start + IN_LIST_MAX_LENGTH]})
+                self.player_ids.update((player, player_id) for player_id, player in rows)
+
+    def get_id(self, player):
+        player_id = self.player_ids.get(player)
+        if player_id is None:
+            self.register_players([player])
+            player_id = self.player_ids[player]
+        return player_id
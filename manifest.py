@@ -0,0 +1,71 @@
+import os
+import json
+import zlib
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+HEAD_CHECKSUM_BYTES = 4096  # the start of a file is checksummed to notice files which were replaced
+
+
+def _head_checksum(path, length):
+    with open(path, 'rb') as file:
+        return zlib.crc32(file.read(length))
+
+
+class IngestManifest:
+    """
+    Persisted record of the ingested handhistory files.
+
+    For every file the path, size, mtime and the byte offset after the last processed <root> block
+    are stored in a json file. On the next run unchanged files are skipped and appended files are only
+    read from the stored offset. Files which got smaller or have a different start are read again from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self._pending = {}  # file path -> stat of the file, as seen before it was read in this run
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='UTF-8') as manifest_file:
+                    self.files = json.load(manifest_file)['files']
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f'Cannot read the ingest manifest {path}, all files get read again. Error: {e}')
+
+    def pending_offset(self, file_path):
+        """
+        Return the byte offset to continue reading the file from, or None if it didn't change since the last run.
+        """
+        stat = os.stat(file_path)
+        entry = self.files.get(file_path)
+        self._pending[file_path] = stat
+
+        if entry is None:
+            return 0
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return None
+        if stat.st_size < entry['offset'] or \
+                _head_checksum(file_path, entry['head_length']) != entry['head_checksum']:
+            logger.info(f'File was replaced, reading it from the start: {file_path}')
+            return 0
+        return entry['offset']
+
+    def mark_processed(self, file_path, offset):
+        """Record that the file was processed up to offset. Call save() once the hands are in the database."""
+        stat = self._pending.pop(file_path, None) or os.stat(file_path)
+        head_length = min(offset, HEAD_CHECKSUM_BYTES)  # only the processed part, the file may still grow
+        self.files[file_path] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'offset': offset,
+            'head_length': head_length,
+            'head_checksum': _head_checksum(file_path, head_length)
+        }
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='UTF-8') as manifest_file:
+            json.dump({'files': self.files}, manifest_file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+_END = object()  # put into a queue after the last item of a stage
+POLL_SECONDS = 0.1  # how often blocked stages check if the pipeline was stopped
+
+
+class PipelineStage:
+    """
+    One stage of a Pipeline and its throughput stats.
+
+    The first stage is a generator function without arguments, every other stage a generator function which
+    takes the iterator of the items of the stage before and yields its own items.
+
+    :param count: function that returns the number of units of an yielded item, e.g. the hands of a batch
+    """
+
+    def __init__(self, name, func, unit='items', count=None):
+        self.name = name
+        self.func = func
+        self.unit = unit
+        self.count = count or (lambda item: 1)
+        self.n_units = 0
+        self.seconds = 0.0
+        self.wait_input = 0.0  # waiting for the stage before
+        self.wait_output = 0.0  # waiting for space in the queue to the next stage (backpressure)
+
+    @property
+    def busy_seconds(self):
+        return max(self.seconds - self.wait_input - self.wait_output, 0.0)
+
+    def summary(self):
+        rate = self.n_units / self.busy_seconds if self.busy_seconds else 0.0
+        return (f"{self.name}: {self.n_units} {self.unit} in {self.seconds:.2f}s, busy {self.busy_seconds:.2f}s "
+                f"({rate:.0f} {self.unit}/s), waited {self.wait_input:.2f}s for input "
+                f"and {self.wait_output:.2f}s for the next stage")
+
+
+class Pipeline:
+    """
+    Run the stages in one thread each, connected by queues of at most queue_size items.
+
+    A full queue blocks the stage before it, so a fast stage cannot run ahead of a slow one and the memory
+    stays bounded. The wall-clock time approaches the time of the slowest stage, as long as the stages release
+    the GIL while they wait (file reads, database calls). If a stage fails, the others are stopped and
+    run() raises its error.
+    """
+
+    def __init__(self, stages, queue_size=4):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+        self.stop_event = threading.Event()
+        self.errors = []
+
+    def _iter_input(self, stage, input_queue):
+        while True:
+            start_time = time.perf_counter()
+            item = _END
+            while not self.stop_event.is_set():
+                try:
+                    item = input_queue.get(timeout=POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    continue
+            stage.wait_input += time.perf_counter() - start_time
+            if item is _END:
+                return
+            yield item
+
+    def _put(self, stage, output_queue, item):
+        start_time = time.perf_counter()
+        while not self.stop_event.is_set():
+            try:
+                output_queue.put(item, timeout=POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        stage.wait_output += time.perf_counter() - start_time
+
+    def _run_stage(self, i):
+        stage = self.stages[i]
+        input_queue = self.queues[i - 1] if i > 0 else None
+        output_queue = self.queues[i] if i < len(self.queues) else None
+        start_time = time.perf_counter()
+        try:
+            items = stage.func(self._iter_input(stage, input_queue)) if input_queue else stage.func()
+            for item in items:
+                stage.n_units += stage.count(item)
+                if output_queue is not None:
+                    self._put(stage, output_queue, item)
+                if self.stop_event.is_set():
+                    break
+        except BaseException as e:
+            logger.error(f'Pipeline stage {stage.name} failed. Error: {e}')
+            self.errors.append(e)
+            self.stop_event.set()
+        finally:
+            stage.seconds = time.perf_counter() - start_time
+            if output_queue is not None:
+                self._put(stage, output_queue, _END)
+
+    def run(self):
+        start_time = time.perf_counter()
+        threads = [threading.Thread(target=self._run_stage, args=(i,), name=f'pipeline-{stage.name}', daemon=True)
+                   for i, stage in enumerate(self.stages)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        logger.info(f'Pipeline finished in {time.perf_counter() - start_time:.2f}s')
+        for stage in self.stages:
+            logger.info(stage.summary())
+        if self.errors:
+            raise self.errors[0]
+        return self.stages
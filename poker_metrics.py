@@ -1,8 +1,8 @@
 import plotly.graph_objects as go
 import plotly.express as px
 import load
+import transform
 import pandas as pd
-import xml.etree.ElementTree as ET
 import logging
 import calendar
 from my_logger import CustomLogger
@@ -11,6 +11,46 @@ pd.set_option('display.max_columns', None)
 
 logger = CustomLogger(__name__).get_logger()
 
+# queries of the analysis, they are also checked by query_plans.explain_builtin_queries
+# the columns of load_player_data_from_DB
+PLAYER_DATA_COLUMNS = {
+    'start_date': 'pt.start_date',
+    'player': 'p.player',
+    'hand_id': 'pt.hand_id',
+    'big_blind': 'pt.big_blind',
+    'n_active_players': 'pt.n_active_players',
+    'cohort': 'ps.cohort'
+}
+# the regs are only counted at tables with at least min_active_players, e.g. not heads-up
+REG_COHORTS = ['reg_passiv', 'reg_medium', 'reg_aggro']
+# player rows within the limits (in cents) and table sizes, {player_filter} excludes players (see player_data_query)
+PLAYER_DATA_TEMPLATE = f'''
+        SELECT {{columns}}
+        FROM player_timestamps AS pt
+            JOIN players AS p ON pt.player_id = p.player_id
+            LEFT JOIN player_stats as ps ON pt.player_id = ps.player_id
+        WHERE pt.big_blind BETWEEN :min_bblind AND :max_bblind
+            AND pt.n_active_players <= :max_active_players
+            AND (pt.n_active_players >= :min_active_players OR ps.cohort IS NULL
+                 OR ps.cohort NOT IN ({', '.join(f"'{cohort}'" for cohort in REG_COHORTS)})){{player_filter}}
+        '''
+# hands of the hero within the limits, the blinds are stored in cents
+HERO_HAND_IDS_QUERY = """SELECT DISTINCT(pt.hand_id) from player_timestamps AS pt
+                            JOIN players AS p ON pt.player_id = p.player_id
+                            JOIN hand_info AS hi ON pt.hand_id = hi.hand_id
+                            WHERE p.player = :hero_nick
+                            AND hi.big_blind BETWEEN :min_bblind AND :max_bblind
+                            AND hi.n_active_players BETWEEN :min_active_players AND :max_active_players"""
+# {hand_ids} is filled in by DataBaseManagement.get_table_as_df_for_hand_ids
+HANDS_QUERY = """SELECT hi.hand_id, hi.start_date, hi.big_blind, hi.last_round,
+                          p.player, hp.seat, hp.bet, hp.win, hp.chips
+                   FROM hand_info AS hi JOIN hand_players AS hp ON hi.hand_id = hp.hand_id
+                       JOIN players AS p ON hp.player_id = p.player_id
+                   WHERE hi.hand_id IN {hand_ids} AND hi.last_round IS NOT NULL
+                   ORDER BY hi.hand_id, hp.player_no"""
+# the hands of a hero are loaded and evaluated in batches of this many hands
+HAND_BATCH_SIZE = 1000
+
 
 def euro_to_float(euro_string):
     if "€" in euro_string:
@@ -21,7 +61,7 @@ def euro_to_float(euro_string):
 
 class PokerMetrics:
     def __init__(self, db_connection, min_bigblind=0, max_bigblind=10000, min_active_players=3, max_active_players=6,
-                 filter_table_name=None):
+                 filter_table_name=None, raw_store=None, parser_backend=transform.DEFAULT_PARSER_BACKEND):
         self.min_bigblind = min_bigblind
         self.max_bigblind = max_bigblind
         self.min_active_players = min_active_players
@@ -30,6 +70,10 @@ class PokerMetrics:
 
         # Database connection for querying
         self.DB_CONNECTION = db_connection
+        # optional RawHandStore, the hands which have to be parsed from the xml are read from it
+        self.raw_store = raw_store
+        # parses the hands which are not in the hand_players table, see transform.get_parser
+        self.parse_hand = transform.get_parser(parser_backend)
 
         self.unknown_players = ["Player 1", "Player 2", "Player 3", "Player 4", "Player 5", "Player 6", "Player 7",
                                 "Player 8", "Player 9", "Player 10"]
@@ -38,30 +82,49 @@ class PokerMetrics:
 
         self.analyse_hand_count = 0
 
+    def player_data_query(self, columns=None, exclude_hero=True):
+        """
+        Build the query of load_player_data_from_DB, the filters of the instance are bound parameters.
+
+        :param columns: columns of PLAYER_DATA_COLUMNS to select besides the start_date, all if None
+        :return: (query, params)
+        """
+        columns = ['start_date', *[column for column in (columns or PLAYER_DATA_COLUMNS) if column != 'start_date']]
+        unknown_columns = [column for column in columns if column not in PLAYER_DATA_COLUMNS]
+        if unknown_columns:
+            raise ValueError(f"Unknown columns {unknown_columns}, use some of {list(PLAYER_DATA_COLUMNS)}")
+        params = {
+            'min_bblind': round(self.min_bigblind * 100),
+            'max_bblind': round(self.max_bigblind * 100),
+            'min_active_players': self.min_active_players,
+            'max_active_players': self.max_active_players
+        }
+        excluding_players = self.unknown_players + (self.hero if exclude_hero else [])
+        player_filter = ''
+        if excluding_players:
+            player_filter = '\n            AND p.player NOT IN ({})'.format(
+                ', '.join(f':excluded_player_{i}' for i in range(len(excluding_players))))
+            params.update({f'excluded_player_{i}': player for i, player in enumerate(excluding_players)})
+        query = PLAYER_DATA_TEMPLATE.format(
+            columns=', '.join(f'{PLAYER_DATA_COLUMNS[column]} AS {column}' for column in columns),
+            player_filter=player_filter)
+        return query, params
+
     def load_player_data_from_DB(self, return_only_columns=None, exclude_hero=True):
-        query = '''
-        SELECT start_date,
-            pt.player,
-            hand_id,
-            big_blind,
-            n_active_players,
-            cohort
-        FROM player_timestamps AS pt LEFT JOIN player_stats as ps ON pt.player = ps.player
-        '''
+        """
+        The player rows within the limits and table sizes, without the unknown players and the heroes.
+
+        The filters run in the database, only the qualifying rows and the requested columns are read.
+        """
         logger.info('Querying the df')
-        df = self.DB_CONNECTION.get_table_as_df(query, index_col='start_date')
+        query, params = self.player_data_query(return_only_columns, exclude_hero)
+        df = self.DB_CONNECTION.get_table_as_df(query, index_col='start_date', params=params,
+                                                parse_dates=['start_date'])
+        if 'player' in df:
+            # every player shows up in many rows, a category stores each name only once
+            df['player'] = df['player'].astype('category')
         logger.info('Finish Querying the df')
 
-        # filter the dataframe for the parameter
-        excluding_players = self.unknown_players + (self.hero if exclude_hero else [])
-        mask_exclude_regs_hu = (df['cohort'].isin(['reg_passiv', 'reg_medium', 'reg_aggro']))
-        df = df[
-            (~df['player'].isin(excluding_players)) &
-            (df['big_blind'].apply(euro_to_float) >= self.min_bigblind) &
-            (df['big_blind'].apply(euro_to_float) <= self.max_bigblind) &
-            (~mask_exclude_regs_hu | (df['n_active_players'] >= self.min_active_players) & mask_exclude_regs_hu)
-            ]
-
         if return_only_columns:
             return df[return_only_columns]
 
@@ -69,17 +132,26 @@ class PokerMetrics:
 
 
     def generate_SQL_query_from_criteria(self, criteria):
+        """
+        Build a query of the player_timestamps rows matching the criteria, like the conditions of player_cohorts.
+
+        :return: (query, params), the values of the criteria are bound parameters
+        """
         where_conditions = []
-        for column, operator, value in criteria:
+        params = {}
+        for i, (column, operator, value) in enumerate(criteria):
+            if operator not in ('<', '<=', '=', '==', '>=', '>', '!='):
+                raise ValueError(f"Unknown operator {operator}")
             if column in ['n_active_players']:
                 prefix = 'pt.'
             else:
                 prefix = 'ps.'
-            where_conditions.append(f"{prefix}{column} {operator} {value}")
+            where_conditions.append(f"{prefix}{column} {operator.replace('==', '=')} :value_{i}")
+            params[f'value_{i}'] = value
         where_clause = " AND ".join(where_conditions)
 
-        return f"SELECT pt.* FROM player_timestamps AS pt JOIN player_stats AS ps ON pt.player = ps.player " \
-               f"WHERE {where_clause}"
+        return f"SELECT pt.* FROM player_timestamps AS pt JOIN player_stats AS ps ON pt.player_id = ps.player_id " \
+               f"WHERE {where_clause}", params
 
     def grouping_date_index_data(self, df, time_unit='day'):
         # Kann man verbessern, wir haben bereits einen Dataframe mit big_winner und loooser gemeinsam und nichtmehr getrennt
@@ -273,13 +345,12 @@ class PokerMetrics:
 
         return heatmap_data
 
-    def _calculate_pot_from_handhistory(self, root):
+    def _calculate_pot_from_handhistory(self, players):
         pot = 0
         # bet amount of all players
         player_contribution_to_pot = []
-        for player in root.findall(".//game/general/players/player"):
-            bet = player.get('bet')
-            player_contribution_to_pot.append(euro_to_float(bet))
+        for player in players:
+            player_contribution_to_pot.append(player['bet'])
 
         # adjust the pot size if a player covers another or made a bet and no one called
         values_sorted = sorted(player_contribution_to_pot, reverse=True)
@@ -305,13 +376,11 @@ class PokerMetrics:
                 return cap
         return 4
 
-    def _calculate_rake_contribute_for_each_player(self, root, total_rake, hero_nick, bigblind):
+    def _calculate_rake_contribute_for_each_player(self, players, total_rake, hero_nick, bigblind):
         # bet amount of all players
         player_contribution_to_pot = {}
-        for player in root.findall(".//game/general/players/player"):
-            name = player.get('name')
-            bet = player.get('bet')
-            player_contribution_to_pot[name] = euro_to_float(bet)
+        for player in players:
+            player_contribution_to_pot[player['name']] = player['bet']
 
         # adjust the pot size if a player covers another or made a bet and no one called
         sorted_items = sorted(player_contribution_to_pot.items(), key=lambda x: x[1], reverse=True)
@@ -330,12 +399,10 @@ class PokerMetrics:
                        player_contribution_to_pot_pct.items()}
         return player_rake
 
-    def _calculate_seat_position_related_to_hero(self, root, hero):
+    def _calculate_seat_position_related_to_hero(self, hand_players, hero):
         players = []
-        for player in root.findall(".//game/general/players/player"):
-            name = player.get('name')
-            seat = int(player.get('seat'))
-            players.append((name, seat))
+        for player in hand_players:
+            players.append((player['name'], player['seat']))
 
         # Sort the players based on their seat numbers
         players.sort(key=lambda x: x[1])
@@ -359,17 +426,61 @@ class PokerMetrics:
                 count += 1
         return positions
 
-    def _calculate_net_result_vs_hero(self, xml_content, hero_nick, include_rake=True):
+    def _hand_from_xml(self, xml_content):
+        """Parse a stored handhistory into the hand record used by _calculate_net_result_vs_hero."""
+        parsed = self.parse_hand(xml_content)
+        return {
+            'start_date': str(parsed.hand_info['start_date']),
+            'big_blind': parsed.hand_info['big_blind'] / 100,
+            'last_round': parsed.hand_info['last_round'],
+            'players': [{'name': player.name, 'seat': player.seat, 'bet': player.bet / 100,
+                         'win': player.win / 100, 'chips': player.chips / 100}
+                        for player in parsed.players]
+        }
+
+    def _load_hands(self, hand_ids):
         """
-        Calculate the net result of the hero player against other players from the given XML content representing game data.
+        Get the hand records for the hand_ids from the hand_info and hand_players tables.
 
-        This method parses the provided XML content to determine the net result of the hero player compared to the other players.
+        Hands which are not in hand_players (ingested by an older version) are parsed from the raw hand store
+        or hand_history instead.
+        """
+        if not hand_ids:
+            return []
+        rows = self.DB_CONNECTION.get_table_as_df_for_hand_ids(HANDS_QUERY, hand_ids)
+
+        hands = {}
+        if rows is not None:
+            for row in rows.itertuples(index=False):
+                hand = hands.get(row.hand_id)
+                if hand is None:
+                    hand = hands[row.hand_id] = {'start_date': str(pd.Timestamp(row.start_date)),
+                                                 'big_blind': row.big_blind / 100,
+                                                 'last_round': row.last_round,
+                                                 'players': []}
+                hand['players'].append({'name': row.player, 'seat': row.seat, 'bet': row.bet / 100,
+                                        'win': row.win / 100, 'chips': row.chips / 100})
+
+        # fallback for the hands without parsed tables
+        missing_hand_ids = [hand_id for hand_id in hand_ids if hand_id not in hands]
+        if missing_hand_ids:
+            logger.info(f"Parsing {len(missing_hand_ids)} hands from the stored handhistory.")
+            hand_histories = self.DB_CONNECTION.get_hand_histories(missing_hand_ids, raw_store=self.raw_store)
+            for hand_id, xml_content in zip(hand_histories['hand_id'], hand_histories['hand_history']):
+                hands[hand_id] = self._hand_from_xml(xml_content)
+        return list(hands.values())
+
+    def _calculate_net_result_vs_hero(self, hand, hero_nick, include_rake=True):
+        """
+        Calculate the net result of the hero player against other players from the given hand.
+
+        This method uses the hand record (or parses the provided XML content) to determine the net result of the hero player compared to the other players.
         The net result is calculated based on the amount each player bet and won, normalized by the big blind value, and
         considering the rake contributed by each player. If the hero player is not found in the game data, or if the hand
         is from unknown players, the method returns an empty dictionary.
 
-        :param xml_content: str
-            The XML content representing the game data.
+        :param hand: dict or str
+            The hand record from _load_hands or the XML content representing the game data.
 
         :return: dict
             A dictionary where the keys are the names of the players and the values are the net results of the hero player
@@ -390,19 +501,21 @@ class PokerMetrics:
             `_calculate_pot_from_handhistory`, and `_calculate_rake_contribute_for_each_player`, to assist with calculations.
         """
         logger.debug(f'Calculate net results vs hero, hero: {hero_nick}')
-        root = ET.fromstring(xml_content)
+        if isinstance(hand, str):
+            hand = self._hand_from_xml(hand)
+        players = hand['players']
 
         players_data = {}
-        bigblind = euro_to_float(root.find(".//general/bigblind").text)
-        bool_raked_hand = True if root.find(".//game/round[@no='2']") is not None else False
-        start_date = root.find("./game/general/startdate").text
+        bigblind = hand['big_blind']
+        bool_raked_hand = (hand['last_round'] or 0) >= 2
+        start_date = hand['start_date']
 
         # find out the winner of the hand
         winner_of_hand = None
-        for player in root.findall(".//game/general/players/player"):
-            win = euro_to_float(player.attrib['win'])
+        for player in players:
+            win = player['win']
             if win > 0:
-                winner_of_hand = player.attrib['name']
+                winner_of_hand = player['name']
                 logger.debug(f"Winner of the hand {winner_of_hand}")
         if winner_of_hand is None:
             logger.error('No winner in this hand')
@@ -415,26 +528,26 @@ class PokerMetrics:
         # get the hero in the handhistory
         logger.debug(f'Looking for the hero in the handhistory. Hero Nick: {hero_nick}')
         hero_name = None
-        for player in root.findall(".//game/general/players/player"):
-            if player.attrib['name'] == hero_nick:
-                hero_name = player.attrib['name']
+        for player in players:
+            if player['name'] == hero_nick:
+                hero_name = player['name']
                 logger.debug('Found hero')
                 break
         if hero_name is None:
-            logger.info(f"No Hero Nickname found! Skipping this hand. \n Handhistory: {xml_content}")
+            logger.info(f"No Hero Nickname found! Skipping this hand. \n Hand: {hand}")
             return
 
         # if winner is not hero, bet amount from xml data gets to the winner of the hand.
         # we assign 0 to all other players, so we can count the number of hands they played later on.
         if winner_of_hand != hero_nick:
-            player = root.find(f".//game/general/players/player[@name='{hero_name}']")
-            amount_lost = euro_to_float(player.attrib['bet']) / bigblind
-            for player in root.findall(".//game/general/players/player"):
-                player_name = player.attrib['name']
+            player = next(player for player in players if player['name'] == hero_name)
+            amount_lost = player['bet'] / bigblind
+            for player in players:
+                player_name = player['name']
                 if player_name == hero_name:
                     continue
                 if player_name == winner_of_hand:
-                    winner_stacksize = euro_to_float(player.attrib['chips']) / bigblind
+                    winner_stacksize = player['chips'] / bigblind
                     amount_lost = winner_stacksize if amount_lost > winner_stacksize else amount_lost
                     players_data[winner_of_hand] = -amount_lost
                 else:
@@ -443,34 +556,34 @@ class PokerMetrics:
             # if winner is hero, calculate the loss of each player per round
             # find hero stack to check later on if a player covers us
             hero_stack = 0
-            for player in root.find(".//game/general/players"):
-                name = player.get('name')
+            for player in players:
+                name = player['name']
                 if name == hero_nick:
-                    hero_stack = euro_to_float(player.get('chips')) / bigblind
+                    hero_stack = player['chips'] / bigblind
                     break
             if hero_stack == 0:
                 logger.warning(f"Hero is winner, but no Stack found.")
 
             # add the player name and won/loss to the dict
-            for player in root.findall(".//game/general/players/player"):
-                if player.attrib['name'] == hero_nick:
+            for player in players:
+                if player['name'] == hero_nick:
                     continue
-                amount_won = euro_to_float(player.attrib['bet']) / bigblind
+                amount_won = player['bet'] / bigblind
                 if amount_won > hero_stack:
                     amount_won = hero_stack
-                players_data[player.attrib['name']] = amount_won
+                players_data[player['name']] = amount_won
 
             # substract the contributed rake from each player to get the net won.
             # only do it if we have round 2 in the handhistory, preflop is no rake
             if bool_raked_hand and include_rake:
                 # calculate rake
-                n_players = len(root.findall(".//players/player"))
-                pot = self._calculate_pot_from_handhistory(root)
+                n_players = len(players)
+                pot = self._calculate_pot_from_handhistory(players)
                 rake = self._calculate_rake(pot_in_eur=pot,
                                             n_players=n_players,
                                             bblind=bigblind)
                 # get the amount of rake each player paid
-                player_rake = self._calculate_rake_contribute_for_each_player(root,
+                player_rake = self._calculate_rake_contribute_for_each_player(players,
                                                                               total_rake=rake,
                                                                               hero_nick=hero_name,
                                                                               bigblind=bigblind)
@@ -482,7 +595,7 @@ class PokerMetrics:
         players_data = {key: [value, 1 / n_players] for key, value in players_data.items()}
 
         # calculate distance to hero
-        player_positions = self._calculate_seat_position_related_to_hero(root=root, hero=hero_nick)
+        player_positions = self._calculate_seat_position_related_to_hero(hand_players=players, hero=hero_nick)
         for key in player_positions:
             if key in players_data:
                 players_data[key].append(player_positions[key])
@@ -521,37 +634,31 @@ class PokerMetrics:
             logger.info(f"Looking for hands for hero: {hero_nick} Number {count} of {n_hero_names}.")
             count += 1
 
-            # getting the hand_ids, where the player is involved
-            query = f"""SELECT DISTINCT(hand_id) from player_timestamps 
-                            WHERE player = '{hero_nick}'"""
-            player_hand_ids = self.DB_CONNECTION.get_table_as_df(query)
-
-            # filter the hand_ids by min/max bblind and n_active_players
-            query = f"""SELECT hand_id, big_blind, n_active_players FROM hand_info WHERE hand_id in {tuple(player_hand_ids['hand_id'])}"""
-            hand_ids = self.DB_CONNECTION.get_table_as_df(query)
-            hand_ids['big_blind'] = hand_ids['big_blind'].apply(euro_to_float)
-            hand_ids = hand_ids[(hand_ids['big_blind'].between(min_bblind, max_bblind)) &
-                                (hand_ids['n_active_players'].between(min_active_players, max_active_players))]
-
-            # get hand histories
-            query = f"""SELECT * FROM hand_history WHERE hand_id in {tuple(hand_ids['hand_id'])} """
-            hand_histories = self.DB_CONNECTION.get_table_as_df(query)
-
-            # create the dataframe with the observations
-            df = hand_histories.copy()
-            logger.info(f"Number of hands to calculate the net_won: {len(df)}")
-
-            for xml_str in df['hand_history']:
-                try:
-                    net_won_vs_hero, start_date = self._calculate_net_result_vs_hero(xml_str, hero_nick=hero_nick,
-                                                                                     include_rake=include_rake)
-                except Exception as e:
-                    logger.warning(f'No data for the players, either players are unknown or no hero found. {e}')
-                    continue
-                # add net_won_vs_hero to a dataframe to get the changes over time
-                wins_sample.extend(
-                    (start_date, key, value[0], value[1], value[2]) for key, value in net_won_vs_hero.items())
-                logger.debug(wins_sample)
+            # getting the hand_ids, where the player is involved, filtered by min/max bblind and n_active_players
+            hand_ids = self.DB_CONNECTION.get_table_as_df(HERO_HAND_IDS_QUERY,
+                                                          params={'hero_nick': hero_nick,
+                                                                  'min_bblind': round(min_bblind * 100),
+                                                                  'max_bblind': round(max_bblind * 100),
+                                                                  'min_active_players': int(min_active_players),
+                                                                  'max_active_players': int(max_active_players)})
+
+            hand_ids = hand_ids['hand_id'].tolist()
+            logger.info(f"Number of hands to calculate the net_won: {len(hand_ids)}")
+
+            # get the hands from the parsed tables, older hands from the hand histories,
+            # only one batch of hands is in memory at once
+            for start in range(0, len(hand_ids), HAND_BATCH_SIZE):
+                for hand in self._load_hands(hand_ids[start:start + HAND_BATCH_SIZE]):
+                    try:
+                        net_won_vs_hero, start_date = self._calculate_net_result_vs_hero(hand, hero_nick=hero_nick,
+                                                                                         include_rake=include_rake)
+                    except Exception as e:
+                        logger.warning(f'No data for the players, either players are unknown or no hero found. {e}')
+                        continue
+                    # add net_won_vs_hero to a dataframe to get the changes over time
+                    wins_sample.extend(
+                        (start_date, key, value[0], value[1], value[2]) for key, value in net_won_vs_hero.items())
+                    logger.debug(wins_sample)
 
         df = pd.DataFrame(wins_sample,
                           columns=['start_date', 'player', 'won_vs_hero', 'share_of_hand', 'seat_distance_to_hero'])
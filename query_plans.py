@@ -0,0 +1,76 @@
+import load
+import calculate_statistics
+import poker_metrics
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+# example values for the bound parameters of the queries
+SAMPLE_PARAMS = {
+    'hero_nick': 'hero',
+    'min_bblind': 0,
+    'max_bblind': 100000,
+    'min_active_players': 3,
+    'max_active_players': 6,
+    'ingest_id': 2,
+    'last_ingest_id': 1,
+    'last_hand_id': -1,
+    'batch_size': 1000
+}
+# the {hand_ids} placeholder as it is filled in for a short list
+SAMPLE_HAND_IDS = '(1, 2)'
+# the conditions of the stats updates: all hands up to a watermark and the hands since the last one
+STATS_CONDITIONS = {'all': calculate_statistics.COUNTED_HANDS_CONDITION, 'new': calculate_statistics.NEW_HANDS_CONDITION}
+
+
+def builtin_queries(db_connection):
+    """
+    The queries of the stats and metrics calculation as they are built for running them, with the
+    {hand_ids} placeholder filled in.
+
+    :return: (queries, params), dict of query name -> query and the values of their bound parameters
+    """
+    queries = {}
+    for condition_name, condition in STATS_CONDITIONS.items():
+        for by_cell in (False, True):
+            prefix = f"{'cube' if by_cell else 'stats'}_{condition_name}"
+            for name, query in calculate_statistics.stats_queries(condition, by_cell).items():
+                queries[f'{prefix}_{name}'] = query
+        # the pages of the hands which are parsed from the xml, with and without a RawHandStore
+        xml_condition = calculate_statistics.xml_hands_condition(condition)
+        queries[f'stats_{condition_name}_hand_history_pages'] = load.hand_page_query(xml_condition)
+        queries[f'stats_{condition_name}_hand_id_pages'] = load.hand_page_query(xml_condition, hand_ids_only=True)
+    player_data_query, params = poker_metrics.PokerMetrics(db_connection).player_data_query()
+    queries.update({
+        'metrics_player_data': player_data_query,
+        'metrics_hero_hand_ids': poker_metrics.HERO_HAND_IDS_QUERY,
+        'metrics_hands': poker_metrics.HANDS_QUERY,
+        'metrics_hand_histories': load.HAND_HISTORIES_QUERY
+    })
+    queries = {name: query.replace('{hand_ids}', SAMPLE_HAND_IDS) for name, query in queries.items()}
+    return queries, {**SAMPLE_PARAMS, **params}
+
+
+def explain_builtin_queries(db_connection, queries=None, params=None):
+    """
+    Run EXPLAIN on the built-in queries and report the ones which read a whole table.
+
+    The stats of all hands of a database without ingest batches read every action and are not checked, with a
+    watermark all stats queries are filtered by ix_hand_history_ingest_id. A full scan points to a missing index.
+
+    :return: dict of query name -> list of the tables read with a full scan
+    """
+    if queries is None:
+        queries, builtin_params = builtin_queries(db_connection)
+        params = {**builtin_params, **(params or {})}
+    params = params or SAMPLE_PARAMS
+    report = {}
+    for name, query in queries.items():
+        plan, full_scans = db_connection.explain_query(query, params)
+        report[name] = full_scans
+        logger.debug(f'Query plan of {name}: \n' + '\n'.join(plan))
+        if full_scans:
+            logger.warning(f'{name} does a full scan of: {", ".join(full_scans)}')
+        else:
+            logger.info(f'{name} uses indexes only')
+    return report
@@ -0,0 +1,153 @@
+import os
+import mmap
+import struct
+import numpy as np
+from my_logger import CustomLogger
+
+logger = CustomLogger(__name__).get_logger()
+
+SEGMENT_SIZE = 256 * 1024 * 1024  # a new segment file is started when the current one is bigger
+INDEX_FILE = 'index.bin'
+_INDEX_HEADER = struct.Struct('<4sQ')  # magic, number of entries
+_INDEX_MAGIC = b'PJTI'
+INDEX_DTYPE = np.dtype([('hand_id', '<i8'), ('segment', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+
+
+def _segment_name(segment):
+    return f'segment-{segment:05d}.dat'
+
+
+class RawHandStore:
+    """
+    Append-only store of the raw hands, next to the database.
+
+    The hands are appended as utf-8 xml to segment files, the index is a sorted array of
+    hand_id -> (segment, offset, length) which is saved with commit(). Readers memory-map the segments and
+    get zero-copy memoryviews of the hands, without a database round trip. Hands are never changed or removed,
+    a hand_id which is already in the store is not appended again. Only one writer may append at a time.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        self.index = self._load_index()
+        self._pending = []  # index entries of the appended hands, until the next commit
+        self._pending_ids = set()
+        self._views = {}  # segment -> memoryview of the mmap of the segment file
+        self._writer = None
+        self._segment = int(self.index['segment'].max()) if len(self.index) else 0
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return np.empty(0, dtype=INDEX_DTYPE)
+        with open(index_path, 'rb') as index_file:
+            magic, count = _INDEX_HEADER.unpack(index_file.read(_INDEX_HEADER.size))
+            if magic != _INDEX_MAGIC:
+                raise ValueError(f"Not a raw hand store index: {index_path}")
+            index = np.fromfile(index_file, dtype=INDEX_DTYPE, count=count)
+        if len(index) != count:
+            raise ValueError(f"Raw hand store index is truncated: {index_path}")
+        return index
+
+    def __len__(self):
+        return len(self.index) + len(self._pending)
+
+    def __contains__(self, hand_id):
+        return self._find(hand_id) is not None or hand_id in self._pending_ids
+
+    def _find(self, hand_id):
+        position = np.searchsorted(self.index['hand_id'], hand_id)
+        if position < len(self.index) and self.index['hand_id'][position] == hand_id:
+            return position
+        return None
+
+    def append(self, hands):
+        """
+        Append hands to the current segment, they can be read after commit().
+
+        :param hands: iterable of (hand_id, hand) with the hand as str or bytes
+        :return: number of appended hands, without the ones which were in the store already
+        """
+        n_appended = 0
+        for hand_id, hand in hands:
+            hand_id = int(hand_id)
+            if hand_id in self:
+                continue
+            data = hand.encode('UTF-8') if isinstance(hand, str) else bytes(hand)
+            writer = self._get_writer()
+            offset = writer.tell()
+            writer.write(data)
+            self._pending.append((hand_id, self._segment, offset, len(data)))
+            self._pending_ids.add(hand_id)
+            n_appended += 1
+        return n_appended
+
+    def _get_writer(self):
+        if self._writer is not None and self._writer.tell() >= self.segment_size:
+            self._writer.close()
+            self._writer = None
+            self._segment += 1
+        if self._writer is None:
+            self._writer = open(os.path.join(self.path, _segment_name(self._segment)), 'ab')
+        return self._writer
+
+    def commit(self):
+        """Write the appended hands to disk and save the index with them."""
+        if not self._pending:
+            return
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        index = np.concatenate([self.index, np.array(self._pending, dtype=INDEX_DTYPE)])
+        index = index[np.argsort(index['hand_id'], kind='stable')]
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(index)))
+            index.tofile(index_file)
+        os.replace(tmp_path, index_path)
+        self.index = index
+        self._pending = []
+        self._pending_ids = set()
+
+    def _segment_view(self, segment, end):
+        view = self._views.get(segment)
+        if view is None or len(view) < end:
+            # not mapped yet or the segment grew since it was mapped, the old map stays valid for its slices
+            with open(os.path.join(self.path, _segment_name(segment)), 'rb') as segment_file:
+                view = memoryview(mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ))
+            self._views[segment] = view
+        return view
+
+    def get(self, hand_id):
+        """Return the raw hand as memoryview of the mapped segment, None if it is not in the store."""
+        position = self._find(hand_id)
+        if position is None:
+            return None
+        _, segment, offset, length = self.index[position].tolist()
+        return self._segment_view(segment, offset + length)[offset:offset + length]
+
+    def get_many(self, hand_ids):
+        """Return a dict of hand_id -> memoryview for the hand_ids which are in the store."""
+        hand_ids = np.asarray(hand_ids, dtype=np.int64)
+        positions = np.searchsorted(self.index['hand_id'], hand_ids)
+        found = positions < len(self.index)
+        found[found] = self.index['hand_id'][positions[found]] == hand_ids[found]
+        hands = {}
+        for hand_id, segment, offset, length in self.index[positions[found]].tolist():
+            hands[hand_id] = self._segment_view(segment, offset + length)[offset:offset + length]
+        return hands
+
+    def get_text(self, hand_ids):
+        """Like get_many, with the hands decoded to str."""
+        return {hand_id: str(hand, 'UTF-8') for hand_id, hand in self.get_many(hand_ids).items()}
+
+    def close(self):
+        self.commit()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        # the maps are closed when the last slice of the caller is gone
+        self._views = {}
@@ -0,0 +1,338 @@
+import pandas as pd
+
+# iPoker action types
+FOLD, SMALL_BLIND, BIG_BLIND, CALL, CHECK, BET, ALL_IN, RAISE = 0, 1, 2, 3, 4, 5, 7, 23
+# preflop action types which count for VPIP and PFR
+VPIP_ACTION_TYPES = [3, 4, 5, 23]
+PFR_ACTION_TYPES = [5, 23]
+# bets and raises, all-ins only count when they raise (see HandWalk.is_aggressive)
+AGGRESSIVE_ACTION_TYPES = frozenset(PFR_ACTION_TYPES)
+PREFLOP, FLOP = 1, 2
+
+STAT_PLUGINS = {}
+# the plugins of the player_stats columns, their counters are the COUNTERS of calculate_statistics
+CORE_STAT_PLUGINS = ('vpip_pfr', 'wwsf')
+# the plugins whose counters are stored next to the core ones in player_stats and player_stats_cube, their columns
+# are in the models of load
+STORED_STAT_PLUGINS = ('three_bet', 'fold_to_three_bet', 'cbet', 'aggression_factor', 'wtsd')
+
+
+def register_stat(plugin_class):
+    """Class decorator which adds a StatPlugin to STAT_PLUGINS, the counter names must be unique."""
+    known_counters = {counter for plugin in STAT_PLUGINS.values() for counter in plugin.counters}
+    if plugin_class.name in STAT_PLUGINS:
+        raise ValueError(f"The stat plugin {plugin_class.name} is already registered")
+    if known_counters & set(plugin_class.counters):
+        raise ValueError(f"The counters of the stat plugin {plugin_class.name} are already used by another plugin")
+    STAT_PLUGINS[plugin_class.name] = plugin_class
+    return plugin_class
+
+
+def resolve_stat_plugins(names=None):
+    """
+    The names of the plugins in the order in which they are counted: the CORE_STAT_PLUGINS, then the required
+    plugins before the ones which need them.
+    """
+    resolved = []
+
+    def add(name):
+        if name not in STAT_PLUGINS:
+            raise ValueError(f"Unknown stat plugin {name}, use one of {list(STAT_PLUGINS)}")
+        if name in resolved:
+            return
+        for required in STAT_PLUGINS[name].requires:
+            add(required)
+        resolved.append(name)
+
+    for name in (*CORE_STAT_PLUGINS, *(names or ())):
+        add(name)
+    return tuple(resolved)
+
+
+def counter_names(names=None):
+    """The counters of the plugins, in the order of the lists of count_hand."""
+    return [counter for name in resolve_stat_plugins(names) for counter in STAT_PLUGINS[name].counters]
+
+
+def plugins_with_counters(columns):
+    """The names of the plugins whose counters are all in columns, e.g. of a dataframe of summed up counters."""
+    columns = set(columns)
+    return [name for name, plugin in STAT_PLUGINS.items() if set(plugin.counters) <= columns]
+
+
+def percent(count, opportunities):
+    return (count / opportunities.where(opportunities > 0) * 100).fillna(0).round(0).astype(int)
+
+
+class HandWalk:
+    """
+    State of the single walk over the actions of one hand, shared by all plugins.
+
+    When a plugin sees an action, the state is the one before the action, except aggressive which tells if the
+    action itself is a bet or raise.
+    """
+    __slots__ = ('hand', 'counters', 'n_counters', 'cell', 'round_no', 'raises', 'first_raiser',
+                 'preflop_aggressor', 'folded', 'committed', 'highest_bet', 'aggressive')
+
+    def __init__(self, hand, counters, n_counters, cell=None):
+        self.hand = hand
+        self.counters = counters
+        self.n_counters = n_counters
+        self.cell = cell
+        self.round_no = None
+        self.raises = 0  # bets and raises in the current round
+        self.first_raiser = None  # the player who opened preflop
+        self.preflop_aggressor = None  # the last raiser preflop
+        self.folded = set()
+        self.committed = {}  # player -> amount put in during the current round
+        self.highest_bet = 0  # highest amount a player put in during the current round
+        self.aggressive = False
+
+    def counters_of(self, player):
+        """The counter list of the player (of the player and cell with by_cell), created on the first call."""
+        key = player if self.cell is None else (player, *self.cell)
+        player_counters = self.counters.get(key)
+        if player_counters is None:
+            player_counters = self.counters[key] = [0] * self.n_counters
+        return player_counters
+
+    def start_round(self, round_no):
+        # the blinds of round 0 count for the bets of the preflop round
+        if round_no != PREFLOP:
+            self.committed = {}
+            self.highest_bet = 0
+        self.round_no = round_no
+        self.raises = 0
+
+    def is_aggressive(self, action):
+        """Bets and raises, and all-ins which put in more than the highest bet of the round (not the calling ones)."""
+        if action.action_type in AGGRESSIVE_ACTION_TYPES:
+            return True
+        return action.action_type == ALL_IN and \
+            self.committed.get(action.player, 0) + (action.amount or 0) > self.highest_bet
+
+    def advance(self, action):
+        # called after the plugins saw the action
+        committed = self.committed.get(action.player, 0) + (action.amount or 0)
+        self.committed[action.player] = committed
+        self.highest_bet = max(self.highest_bet, committed)
+        if self.aggressive:
+            self.raises += 1
+            if action.round_no == PREFLOP:
+                if self.first_raiser is None:
+                    self.first_raiser = action.player
+                self.preflop_aggressor = action.player
+        elif action.action_type == FOLD:
+            self.folded.add(action.player)
+
+
+class StatPlugin:
+    """
+    A stat which is counted in the single walk over each hand, see count_hand.
+
+    A plugin adds its counters to walk.counters_of(player) at the positions offset + index in counters.
+    The walk only iterates over the actions for plugins which override on_action or set needs_walk.
+    """
+    name = None
+    counters = ()
+    requires = ()  # plugins whose counters are used by stats
+    needs_walk = False  # end_hand reads the state of the walk, e.g. walk.folded
+
+    def __init__(self, offset):
+        self.offset = offset  # position of the first counter of the plugin in the counter lists
+
+    def start_hand(self, walk):
+        pass
+
+    on_action = None  # function (walk, action), set by plugins which look at the actions
+
+    def end_hand(self, walk):
+        pass
+
+    def stats(self, counts):
+        """The stats of the plugin from the summed up counters: dict of column -> series with the index of counts."""
+        return {}
+
+
+@register_stat
+class VpipPfr(StatPlugin):
+    name = 'vpip_pfr'
+    counters = ('hands', 'vpip', 'pfr')
+
+    def end_hand(self, walk):
+        # VPIP and PFR are decided by the first preflop action of each player
+        offset = self.offset
+        for player in walk.hand.players:
+            action_type = player.first_preflop_action
+            if action_type is not None:
+                player_counters = walk.counters_of(player.name)
+                player_counters[offset] += 1
+                player_counters[offset + 1] += action_type in VPIP_ACTION_TYPES
+                player_counters[offset + 2] += action_type in PFR_ACTION_TYPES
+
+
+@register_stat
+class Wwsf(StatPlugin):
+    name = 'wwsf'
+    counters = ('saw_flop', 'won_hand')
+
+    def end_hand(self, walk):
+        offset = self.offset
+        for player in walk.hand.players:
+            if player.saw_flop:
+                player_counters = walk.counters_of(player.name)
+                player_counters[offset] += 1
+                player_counters[offset + 1] += player.win > 0
+
+
+@register_stat
+class ThreeBet(StatPlugin):
+    """A player who faces the open raise preflop 3-bets it."""
+    name = 'three_bet'
+    counters = ('three_bet_opportunities', 'three_bets')
+
+    def start_hand(self, walk):
+        self.faced = set()
+
+    def on_action(self, walk, action):
+        if action.round_no != PREFLOP or walk.raises != 1 or action.player == walk.first_raiser \
+                or action.player in self.faced:
+            return
+        self.faced.add(action.player)
+        player_counters = walk.counters_of(action.player)
+        player_counters[self.offset] += 1
+        player_counters[self.offset + 1] += walk.aggressive
+
+    def stats(self, counts):
+        return {'three_bet': percent(counts['three_bets'], counts['three_bet_opportunities'])}
+
+
+@register_stat
+class FoldToThreeBet(StatPlugin):
+    """The open raiser folds when the action comes back to them after a 3-bet."""
+    name = 'fold_to_three_bet'
+    counters = ('fold_to_three_bet_opportunities', 'folds_to_three_bet')
+
+    def start_hand(self, walk):
+        self.counted = False
+
+    def on_action(self, walk, action):
+        if action.round_no != PREFLOP or walk.raises != 2 or action.player != walk.first_raiser or self.counted:
+            return
+        self.counted = True
+        player_counters = walk.counters_of(action.player)
+        player_counters[self.offset] += 1
+        player_counters[self.offset + 1] += action.action_type == FOLD
+
+    def stats(self, counts):
+        return {'fold_to_three_bet': percent(counts['folds_to_three_bet'], counts['fold_to_three_bet_opportunities'])}
+
+
+@register_stat
+class ContinuationBet(StatPlugin):
+    """The preflop aggressor bets the flop when they act first in it without a bet before them."""
+    name = 'cbet'
+    counters = ('cbet_opportunities', 'cbets')
+
+    def start_hand(self, walk):
+        self.counted = False
+
+    def on_action(self, walk, action):
+        if action.round_no != FLOP or action.player != walk.preflop_aggressor or self.counted:
+            return
+        self.counted = True
+        if walk.raises == 0:
+            player_counters = walk.counters_of(action.player)
+            player_counters[self.offset] += 1
+            player_counters[self.offset + 1] += walk.aggressive
+
+    def stats(self, counts):
+        return {'cbet': percent(counts['cbets'], counts['cbet_opportunities'])}
+
+
+@register_stat
+class AggressionFactor(StatPlugin):
+    """(bets + raises) / calls after the flop, all-ins which only call count as calls."""
+    name = 'aggression_factor'
+    counters = ('postflop_aggressive_actions', 'postflop_calls')
+
+    def on_action(self, walk, action):
+        if action.round_no < FLOP:
+            return
+        if walk.aggressive:
+            walk.counters_of(action.player)[self.offset] += 1
+        elif action.action_type in (CALL, ALL_IN):
+            walk.counters_of(action.player)[self.offset + 1] += 1
+
+    def stats(self, counts):
+        calls = counts['postflop_calls']
+        # without calls the number of aggressive actions
+        factor = (counts['postflop_aggressive_actions'] / calls.where(calls > 0)).fillna(
+            counts['postflop_aggressive_actions'])
+        return {'aggression_factor': factor.round(2)}
+
+
+@register_stat
+class WentToShowdown(StatPlugin):
+    """WTSD, the players who saw the flop and did not fold when two or more players were left at the end."""
+    name = 'wtsd'
+    counters = ('went_to_showdown',)
+    requires = ('wwsf',)
+    needs_walk = True
+
+    def end_hand(self, walk):
+        players_left = [player for player in walk.hand.players if player.name not in walk.folded]
+        if len(players_left) < 2:
+            return
+        for player in players_left:
+            if player.saw_flop:
+                walk.counters_of(player.name)[self.offset] += 1
+
+    def stats(self, counts):
+        return {'wtsd': percent(counts['went_to_showdown'], counts['saw_flop'])}
+
+
+class StatCounter:
+    """The plugins of the names (see resolve_stat_plugins) bound to their positions in the counter lists."""
+
+    def __init__(self, names=None):
+        self.names = resolve_stat_plugins(names)
+        self.plugins = []
+        offset = 0
+        for name in self.names:
+            plugin = STAT_PLUGINS[name](offset)
+            self.plugins.append(plugin)
+            offset += len(plugin.counters)
+        self.n_counters = offset
+        self.action_plugins = [plugin for plugin in self.plugins if plugin.on_action is not None]
+        self.needs_walk = bool(self.action_plugins) or any(plugin.needs_walk for plugin in self.plugins)
+
+    def count_hand(self, parsed_hand, counters, cell=None):
+        """
+        Add the counters of one hand to counters (dict of player -> counter list), with one walk over its actions
+        for all plugins.
+
+        :param cell: tuple of the cube cell of the hand, the counters are keyed by (player, *cell) then
+        """
+        walk = HandWalk(parsed_hand, counters, self.n_counters, cell)
+        for plugin in self.plugins:
+            plugin.start_hand(walk)
+        action_plugins = self.action_plugins
+        if self.needs_walk:
+            for action in parsed_hand.actions:
+                if action.round_no != walk.round_no:
+                    walk.start_round(action.round_no)
+                walk.aggressive = walk.is_aggressive(action)
+                for plugin in action_plugins:
+                    plugin.on_action(walk, action)
+                walk.advance(action)
+        for plugin in self.plugins:
+            plugin.end_hand(walk)
+
+    def stats(self, counts):
+        """The stats of the plugins besides the core ones, as dataframe with the index of counts."""
+        stats = {}
+        for plugin in self.plugins:
+            if plugin.name not in CORE_STAT_PLUGINS:
+                stats.update(plugin.stats(counts))
+        return pd.DataFrame(stats, index=counts.index)
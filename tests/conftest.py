@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark_parsers  # noqa: E402
+
+TEST_HANDHISTORY = os.path.join(ROOT, 'test_handhistory')
+
+
+@pytest.fixture(scope='session')
+def sample_hands():
+    return benchmark_parsers.load_sample_hands(TEST_HANDHISTORY)
+
+
+@pytest.fixture(scope='session')
+def handhistory_folder():
+    return TEST_HANDHISTORY
+
+
+@pytest.fixture
+def split_hand_folders(tmp_path, sample_hands):
+    """The sample hands split into two folders of one table each, to be ingested one after the other."""
+    half = len(sample_hands) // 2
+    folders = []
+    for name, hands in (('first', sample_hands[:half]), ('second', sample_hands[half:])):
+        folder = tmp_path / name / 'table'
+        folder.mkdir(parents=True)
+        (folder / 'hands.xml').write_text('\n'.join(hands), encoding='UTF-8')
+        folders.append(str(tmp_path / name))
+    return folders
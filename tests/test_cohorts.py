@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import calculate_statistics as cs
+import load
+
+STATS_COLUMNS = ['hands', 'vpip', 'pfr', 'vpip_pfr_gap', 'wwsf']
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = load.DataBaseManagement(f"sqlite:///{tmp_path / 'stats.db'}", create_all_tables=True)
+    rng = np.random.default_rng(0)
+    stats = pd.DataFrame(rng.integers(0, 700, size=(500, 5)), columns=STATS_COLUMNS)
+    stats['vpip'] %= 80
+    stats['pfr'] = stats['vpip'] // 2
+    stats['vpip_pfr_gap'] = stats['vpip'] - stats['pfr']
+    stats['wwsf'] %= 100
+    stats.insert(0, 'player_id', range(1, len(stats) + 1))
+    with db.begin() as connection:
+        db.bulk_insert(stats, 'player_stats', connection)
+    return db
+
+
+def stored_cohorts(db):
+    return db.get_table_as_df('SELECT * FROM player_stats ORDER BY player_id')
+
+
+def test_numpy_thresholds_give_the_labels_of_the_python_rules(db):
+    cohorts = {cohort: [(column, cond, np.int64(value) if isinstance(value, int) else np.float64(value))
+                        for column, cond, value in conditions]
+               for cohort, conditions in cs.player_cohorts.items()}
+    assert 'np.' not in cs.cohort_case_sql(cohorts)
+    poker_stats = cs.PokerStats(db)
+    poker_stats.reclassify_cohorts(cohorts)
+    stats = stored_cohorts(db)
+    assert stats['cohort'].tolist() == cs.compile_cohort_rules(cohorts)(stats).tolist()
+    assert stats['cohort'].tolist() == stats.apply(cs.classify_player_type, axis=1).tolist()
+
+
+def test_failed_reclassification_keeps_the_rules(db):
+    poker_stats = cs.PokerStats(db)
+    poker_stats.reclassify_cohorts()
+    before = stored_cohorts(db)
+    with pytest.raises(Exception):
+        poker_stats.reclassify_cohorts({'fish': [('no_such_column', '>=', 1)]})
+    assert poker_stats.cohorts is None
+    assert stored_cohorts(db).equals(before)
+    with pytest.raises(ValueError):
+        cs.cohort_case_sql({'fish': [('hands', '>=', 'many')]})
@@ -0,0 +1,89 @@
+import pandas as pd
+import pytest
+
+import compression
+import load
+import transform
+
+
+def test_codec_round_trip_without_dictionary(sample_hands):
+    codec = compression.HandHistoryCodec()
+    for hand in sample_hands[:50]:
+        header_id, header, body = codec.encode(hand)
+        assert body[0] == compression.BODY_DEFLATE
+        assert header_id == compression.session_header_id(header)
+        assert codec.decode(header, body) == hand
+
+
+def test_codec_round_trip_with_dictionary(sample_hands):
+    bodies = [compression.split_hand_history(hand)[1] for hand in sample_hands]
+    codec = compression.HandHistoryCodec({1: compression.train_dictionary(bodies)})
+    for hand in sample_hands[:50]:
+        _, header, body = codec.encode(hand)
+        assert body[0] == compression.BODY_DEFLATE_DICTIONARY
+        assert codec.decode(header, body) == hand
+    # a reader without the dictionary cannot guess it
+    with pytest.raises(KeyError):
+        compression.HandHistoryCodec().decode(header, body)
+
+
+def _rows(hands):
+    return [{'hand_id': transform.find_hand_id(hand), 'hand_history': hand} for hand in hands]
+
+
+def _load(db, tables):
+    db.load_ingest_batch({'session_headers': tables['session_headers'], 'hand_history': tables['hand_history']})
+
+
+def test_failed_batch_then_retry_can_be_decoded(tmp_path, sample_hands, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    first, second = sample_hands[:300], sample_hands[300:600]
+
+    # the dictionary is committed before the batch which fails
+    tables = db.encode_hand_histories(_rows(first))
+    bulk_insert = db.bulk_insert
+
+    def failing_bulk_insert(df, table_name, connection, on_conflict=None):
+        if table_name == 'hand_history':
+            raise RuntimeError('lock wait timeout')
+        return bulk_insert(df, table_name, connection, on_conflict=on_conflict)
+
+    monkeypatch.setattr(db, 'bulk_insert', failing_bulk_insert)
+    with pytest.raises(RuntimeError):
+        _load(db, tables)
+    monkeypatch.undo()
+
+    # the same instance goes on with the next batch and retries the failed one
+    _load(db, db.encode_hand_histories(_rows(second)))
+    _load(db, db.encode_hand_histories(_rows(first)))
+
+    stored = load.DataBaseManagement(url).get_table_as_df(
+        'SELECT dictionary_id FROM compression_dictionaries')['dictionary_id'].tolist()
+    assert stored == [1]
+    hands = {row['hand_id']: row['hand_history'] for row in _rows(first + second)}
+    fresh = load.DataBaseManagement(url)
+    decoded = fresh.get_hand_histories(list(hands))
+    assert dict(zip(decoded['hand_id'], decoded['hand_history'])) == hands
+
+
+def test_concurrent_dictionary_keeps_the_stored_one(tmp_path, sample_hands):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    writer = load.DataBaseManagement(url, create_all_tables=True)
+    other = load.DataBaseManagement(url)
+    bodies = [compression.split_hand_history(hand)[1] for hand in sample_hands]
+    other_dictionary = compression.train_dictionary(bodies, seed=1)
+    # the other process stores dictionary 1 between the refresh and the insert of the writer
+    hand_history_codec = writer.hand_history_codec
+
+    def racing_codec(refresh=False):
+        codec = hand_history_codec(refresh)
+        if not other.get_table_as_df('SELECT dictionary_id FROM compression_dictionaries').shape[0]:
+            with other.begin() as connection:
+                other.bulk_insert(pd.DataFrame([{'dictionary_id': 1, 'dictionary': other_dictionary}]),
+                                  'compression_dictionaries', connection)
+        return codec
+
+    writer.hand_history_codec = racing_codec
+    codec = writer.store_dictionary(compression.train_dictionary(bodies, seed=2))
+    assert codec.dictionaries == {1: other_dictionary}
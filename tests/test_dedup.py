@@ -0,0 +1,61 @@
+import pytest
+
+import dedup
+import extract
+import load
+import transform
+
+
+def test_bloom_filter_file_keeps_the_watermark(tmp_path):
+    bloom_filter = dedup.BloomFilter(bits_log2=16, n_hashes=4, watermark=7)
+    bloom_filter.add_many([1, 2, 3])
+    bloom_filter.save(tmp_path / 'hands.bloom')
+    loaded = dedup.BloomFilter.load(tmp_path / 'hands.bloom')
+    assert loaded.watermark == 7 and loaded.count == 3
+    assert all(hand_id in loaded for hand_id in (1, 2, 3))
+
+
+@pytest.fixture
+def loaded_database(tmp_path, handhistory_folder):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    bloom_filter_path = str(tmp_path / 'hands.bloom')
+    extract.ExtractHandhistories(database_url=url, bloom_filter_path=bloom_filter_path,
+                                 flush_every_hands=1000).extract_folders(handhistory_folder)
+    return url, bloom_filter_path
+
+
+def test_valid_bloom_filter_skips_the_hand_id_scan(loaded_database, sample_hands, monkeypatch):
+    url, bloom_filter_path = loaded_database
+    db = load.DataBaseManagement(url)
+    monkeypatch.setattr(db, 'iter_query_batches', lambda *args, **kwargs: pytest.fail('hand_ids were scanned'))
+    index = dedup.HandIdIndex.from_database(db, bloom_filter_path=bloom_filter_path)
+    assert len(index.existing_hand_ids) == 0 and index.db_connection is db
+
+    hand_ids = {transform.find_hand_id(hand) for hand in sample_hands}
+    unknown_hand_id = max(hand_ids) + 1
+    assert index.loaded_hand_ids([*hand_ids, unknown_hand_id]) == hand_ids
+    assert min(hand_ids) in index and unknown_hand_id not in index
+
+
+def test_bloom_filter_of_an_older_ingest_is_rebuilt(loaded_database):
+    url, bloom_filter_path = loaded_database
+    db = load.DataBaseManagement(url)
+    bloom_filter = dedup.BloomFilter.load(bloom_filter_path)
+    bloom_filter.watermark -= 1
+    bloom_filter.save(bloom_filter_path)
+    index = dedup.HandIdIndex.from_database(db, bloom_filter_path=bloom_filter_path)
+    assert index.db_connection is None
+    assert len(index.existing_hand_ids) == db.get_table_as_df('SELECT COUNT(*) AS n FROM hand_history')['n'][0]
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_loaded_hands_are_not_transformed_again(loaded_database, handhistory_folder, sample_hands, monkeypatch,
+                                                capsys, pipelined):
+    url, bloom_filter_path = loaded_database
+    capsys.readouterr()
+    monkeypatch.setattr(extract, 'transform_hand', lambda *args: pytest.fail('a loaded hand was transformed'))
+    extract.ExtractHandhistories(database_url=url, bloom_filter_path=bloom_filter_path).extract_folders(
+        handhistory_folder, pipelined=pipelined)
+    output = capsys.readouterr().out
+    assert 'Total hands: 0' in output
+    assert f'Total duplicates: {len(sample_hands)}' in output
@@ -0,0 +1,82 @@
+import os
+import threading
+from multiprocessing import Pool
+
+import pytest
+
+import extract
+import load
+import transform
+
+
+def test_transform_folder_streams_groups_of_hands(handhistory_folder, sample_hands):
+    folder = os.path.join(handhistory_folder, os.listdir(handhistory_folder)[0])
+    n_records = 0
+    end_offsets = {}
+    for file_path, records, end_offset in extract.transform_folder(folder):
+        assert len(records) <= extract.GROUP_HANDS
+        n_records += len(records)
+        if end_offset is not None:
+            end_offsets[file_path] = end_offset
+    assert n_records == len(sample_hands)
+    assert end_offsets == {os.path.join(folder, filename): os.path.getsize(os.path.join(folder, filename))
+                           for filename in os.listdir(folder)}
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_flush_limit_bounds_the_batches(tmp_path, handhistory_folder, sample_hands, n_workers):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extract.ExtractHandhistories(database_url=url, flush_every_hands=100).extract_folders(handhistory_folder,
+                                                                                          n_workers=n_workers)
+    db = load.DataBaseManagement(url)
+    batch_sizes = db.get_table_as_df('SELECT n_hands FROM ingest_batches')['n_hands']
+    n_hands = len({transform.find_hand_id(hand) for hand in sample_hands})
+    assert batch_sizes.max() == 100
+    assert batch_sizes.sum() == n_hands
+    assert db.get_table_as_df('SELECT COUNT(*) AS n FROM hand_history')['n'][0] == n_hands
+
+
+def test_worker_groups_give_the_serial_records(handhistory_folder):
+    tasks = [(os.path.join(handhistory_folder, folder), None) for folder in os.listdir(handhistory_folder)]
+    serial = list(extract.transform_groups(extract.iter_hand_groups(tasks, group_size=50)))
+    with Pool(2) as pool:
+        parallel = list(extract.transform_groups(extract.iter_hand_groups(tasks, group_size=50), pool=pool,
+                                                 max_pending=3))
+    assert parallel == serial
+    # a single folder is split into many tasks
+    assert len(serial) > len(tasks) * 2
+
+
+def test_pipeline_writes_only_in_the_load_stage(tmp_path, handhistory_folder, sample_hands, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extractor = extract.ExtractHandhistories(database_url=url, flush_every_hands=200,
+                                             raw_store_path=str(tmp_path / 'raw'))
+    threads = {'parse': set(), 'write': set()}
+
+    def record_thread(name, func):
+        def wrapper(*args, **kwargs):
+            threads[name].add(threading.get_ident())
+            return func(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(extract, 'transform_hand', record_thread('parse', extract.transform_hand))
+    monkeypatch.setattr(extractor.DB_connection, 'begin', record_thread('write', extractor.DB_connection.begin))
+    monkeypatch.setattr(extractor.raw_store, 'append', record_thread('write', extractor.raw_store.append))
+    extractor.extract_folders(handhistory_folder, pipelined=True)
+
+    assert len(threads['parse']) == 1 and len(threads['write']) == 1
+    assert threads['parse'] != threads['write']
+    assert len(extractor.raw_store) == len({transform.find_hand_id(hand) for hand in sample_hands})
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_hands_of_the_database_are_reported_as_duplicates(tmp_path, handhistory_folder, sample_hands, capsys,
+                                                          pipelined):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    n_hands = len({transform.find_hand_id(hand) for hand in sample_hands})
+    extract.ExtractHandhistories(database_url=url, flush_every_hands=500).extract_folders(handhistory_folder)
+    assert f'Total hands: {n_hands}\nTotal duplicates: {len(sample_hands) - n_hands}\n' in capsys.readouterr().out
+
+    extract.ExtractHandhistories(database_url=url, flush_every_hands=500).extract_folders(handhistory_folder,
+                                                                                          pipelined=pipelined)
+    assert f'Total hands: 0\nTotal duplicates: {len(sample_hands)}\n' in capsys.readouterr().out
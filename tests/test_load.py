@@ -0,0 +1,27 @@
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import load
+
+
+def test_column_to_python_nullable_ints():
+    values = load._column_to_python(pd.Series([1, None], dtype='Int64'))
+    assert values == [1, None]
+    assert type(values[0]) is int
+
+
+def test_column_to_python_floats_and_objects():
+    assert load._column_to_python(pd.Series([1.5, np.nan])) == [1.5, None]
+    assert load._column_to_python(pd.Series(['a', None, b'b'], dtype=object)) == ['a', None, b'b']
+
+
+def test_column_to_python_datetimes_without_warnings():
+    series = pd.Series(pd.to_datetime(['2023-08-01 12:30:00', None]))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        values = load._column_to_python(series)
+    assert values == [datetime(2023, 8, 1, 12, 30), None]
+    assert type(values[0]) is datetime
@@ -0,0 +1,63 @@
+import os
+
+import extract
+import load
+import manifest
+import transform
+
+
+def count_transformed(monkeypatch):
+    transformed = []
+    transform_hand = extract.transform_hand
+
+    def counting_transform_hand(hand, *args):
+        transformed.append(hand)
+        return transform_hand(hand, *args)
+    monkeypatch.setattr(extract, 'transform_hand', counting_transform_hand)
+    return transformed
+
+
+def test_appended_file_is_read_from_the_stored_offset(tmp_path, sample_hands, monkeypatch):
+    folder = tmp_path / 'hands' / 'table'
+    folder.mkdir(parents=True)
+    path = folder / 'hands.xml'
+    half = len(sample_hands) // 2
+    path.write_text('\n'.join(sample_hands[:half]), encoding='UTF-8')
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    manifest_path = str(tmp_path / 'manifest.json')
+
+    def ingest():
+        extract.ExtractHandhistories(database_url=url, manifest_path=manifest_path).extract_folders(
+            str(tmp_path / 'hands'))
+
+    ingest()
+    assert manifest.IngestManifest(manifest_path).files[str(path)]['offset'] == os.path.getsize(path)
+
+    with open(path, 'a', encoding='UTF-8') as file:
+        file.write('\n' + '\n'.join(sample_hands[half:]))
+    transformed = count_transformed(monkeypatch)
+    ingest()
+    # the hands before the offset are not read again
+    assert [transform.find_hand_id(hand) for hand in transformed] == \
+        [transform.find_hand_id(hand) for hand in sample_hands[half:]]
+    db = load.DataBaseManagement(url)
+    assert db.get_table_as_df('SELECT COUNT(*) AS n FROM hand_history')['n'][0] == \
+        len({transform.find_hand_id(hand) for hand in sample_hands})
+
+    # an unchanged file is not read at all
+    transformed.clear()
+    ingest()
+    assert transformed == []
+
+
+def test_replaced_file_is_read_from_the_start(tmp_path, sample_hands):
+    path = tmp_path / 'hands.xml'
+    path.write_text('\n'.join(sample_hands[:10]), encoding='UTF-8')
+    ingest_manifest = manifest.IngestManifest(str(tmp_path / 'manifest.json'))
+    assert ingest_manifest.pending_offset(str(path)) == 0
+    ingest_manifest.mark_processed(str(path), os.path.getsize(path))
+    assert ingest_manifest.pending_offset(str(path)) is None
+
+    # a different file of the same name, longer than the processed part
+    path.write_text('\n'.join(sample_hands[10:30]), encoding='UTF-8')
+    assert ingest_manifest.pending_offset(str(path)) == 0
@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import inspect
+
+import load
+
+LEGACY_HAND_INFO = ('CREATE TABLE hand_info (hand_id BIGINT PRIMARY KEY, start_date VARCHAR(50), '
+                    'small_blind VARCHAR(50), big_blind VARCHAR(50))')
+
+
+def legacy_database(path, rows, extra_sql=()):
+    connection = sqlite3.connect(path)
+    connection.execute(LEGACY_HAND_INFO)
+    connection.executemany('INSERT INTO hand_info VALUES (?, ?, ?, ?)', rows)
+    for sql in extra_sql:
+        connection.execute(sql)
+    connection.commit()
+    connection.close()
+    return f'sqlite:///{path}'
+
+
+def blinds(db):
+    return db.get_table_as_df('SELECT hand_id, small_blind, big_blind FROM hand_info ORDER BY hand_id') \
+        .values.tolist()
+
+
+def hand_info_columns(db):
+    return {column['name'] for column in inspect(db.engine).get_columns('hand_info')}
+
+
+def test_failed_conversion_can_be_run_again(tmp_path):
+    url = legacy_database(tmp_path / 'legacy.db', [(1, '2023-08-11 06:41:43', '€0,50', '€1'),
+                                                   (2, '2023-08-11 06:42:00', '€1', 'not a blind')])
+    with pytest.raises(ValueError):
+        load.DataBaseManagement(url, create_all_tables=True)
+
+    connection = sqlite3.connect(tmp_path / 'legacy.db')
+    connection.execute("UPDATE hand_info SET big_blind = '€2' WHERE hand_id = 2")
+    connection.commit()
+    connection.close()
+
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    assert blinds(db) == [[1, 50, 100], [2, 100, 200]]
+    assert not {'small_blind_typed', 'big_blind_typed'} & hand_info_columns(db)
+
+
+def test_leftover_typed_column_is_reused(tmp_path):
+    # stopped after adding and partly filling the new column
+    url = legacy_database(tmp_path / 'legacy.db', [(1, '2023-08-11 06:41:43', '€0,50', '€1')],
+                          ['ALTER TABLE hand_info ADD COLUMN big_blind_typed INTEGER',
+                           'UPDATE hand_info SET big_blind_typed = 7'])
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    assert blinds(db) == [[1, 50, 100]]
+    assert 'big_blind_typed' not in hand_info_columns(db)
+
+
+def test_swap_stopped_after_the_drop_is_finished(tmp_path):
+    url = legacy_database(tmp_path / 'legacy.db', [(1, '2023-08-11 06:41:43', '€0,50', '€1')],
+                          ['ALTER TABLE hand_info ADD COLUMN big_blind_typed INTEGER',
+                           'UPDATE hand_info SET big_blind_typed = 100',
+                           'ALTER TABLE hand_info DROP COLUMN big_blind'])
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    assert blinds(db) == [[1, 50, 100]]
+    assert 'big_blind_typed' not in hand_info_columns(db)
+
+
+LEGACY_PLAYER_TIMESTAMPS = ('CREATE TABLE {table} (id INTEGER PRIMARY KEY, player VARCHAR(50), hand_id INTEGER, '
+                            'start_date DATETIME, big_blind {big_blind_type}, n_active_players INTEGER)')
+PLAYER_TIMESTAMP_ROWS = [(1, 'alice', 10, '2023-08-11 06:41:43', 6),
+                         (2, 'bob', 10, '2023-08-11 06:41:43', 6),
+                         (3, 'alice', 10, '2023-08-11 06:41:43', 6),  # loaded twice by the old version
+                         (4, 'alice', 11, '2023-08-11 06:42:00', 6)]
+
+
+def legacy_player_timestamps(path, table='player_timestamps', big_blind='€1'):
+    connection = sqlite3.connect(path)
+    big_blind_type = 'VARCHAR(50)' if isinstance(big_blind, str) else 'INTEGER'
+    connection.execute(LEGACY_PLAYER_TIMESTAMPS.format(table=table, big_blind_type=big_blind_type))
+    connection.executemany(f'INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?)',
+                           [(*row[:4], big_blind, row[4]) for row in PLAYER_TIMESTAMP_ROWS])
+    connection.commit()
+    connection.close()
+    return f'sqlite:///{path}'
+
+
+def player_timestamps(db):
+    return db.get_table_as_df('SELECT t.id, p.player, t.hand_id, t.big_blind FROM player_timestamps AS t '
+                              'JOIN players AS p ON t.player_id = p.player_id ORDER BY t.id').values.tolist()
+
+
+def test_duplicate_player_timestamps_are_migrated_once(tmp_path):
+    url = legacy_player_timestamps(tmp_path / 'legacy.db')
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    assert player_timestamps(db) == [[1, 'alice', 10, 100], [2, 'bob', 10, 100], [4, 'alice', 11, 100]]
+    assert 'player_timestamps_old' not in inspect(db.engine).get_table_names()
+
+
+def test_migration_stopped_after_the_rename_is_finished(tmp_path):
+    # on MySQL the rename is committed at once, the copy into the new table was lost
+    url = legacy_player_timestamps(tmp_path / 'legacy.db', 'player_timestamps_old', big_blind=100)
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    assert player_timestamps(db) == [[1, 'alice', 10, 100], [2, 'bob', 10, 100], [4, 'alice', 11, 100]]
+    assert 'player_timestamps_old' not in inspect(db.engine).get_table_names()
@@ -0,0 +1,27 @@
+import os
+
+import benchmark_parsers
+import extract
+import transform
+
+
+def test_sample_hands_are_loaded(sample_hands):
+    assert sample_hands
+    assert transform.parse_hand(sample_hands[0]).actions
+
+
+def test_backends_parse_the_same_hands(sample_hands):
+    backends = benchmark_parsers.available_backends()
+    # etree comes with python, the other backends are compared with it if they are installed
+    assert backends[0] == transform.DEFAULT_PARSER_BACKEND
+    differences = benchmark_parsers.compare_backends(sample_hands, backends)
+    assert differences == {backend: 0 for backend in backends[1:]}
+
+
+def test_iter_hands_parses_with_the_backend(handhistory_folder):
+    folder = os.path.join(handhistory_folder, os.listdir(handhistory_folder)[0])
+    path = os.path.join(folder, os.listdir(folder)[0])
+    for backend in benchmark_parsers.available_backends():
+        hands = list(extract.iter_hands(path, parser_backend=backend))
+        assert hands and all(parsed_hand == transform.parse_hand(hand) for hand, parsed_hand, _ in hands)
+        assert hands[-1][2] == os.path.getsize(path)
@@ -0,0 +1,18 @@
+import load
+
+
+def test_two_registries_give_one_id_per_name(tmp_path):
+    url = f"sqlite:///{tmp_path / 'players.db'}"
+    db = load.DataBaseManagement(url, create_all_tables=True)
+    ingest = load.PlayerRegistry(db)
+    stats = load.PlayerRegistry(load.DataBaseManagement(url))
+
+    ingest.register_players(['alice', 'bob'])
+    # the stats registry was loaded before and doesn't know alice and bob yet
+    stats.register_players(['carol', 'alice'])
+
+    assert stats.get_id('alice') == ingest.get_id('alice')
+    assert len({ingest.get_id('alice'), ingest.get_id('bob'), stats.get_id('carol')}) == 3
+    stored = db.get_table_as_df('SELECT player_id, player FROM players', index_col='player')['player_id']
+    assert stored.to_dict() == {'alice': ingest.get_id('alice'), 'bob': ingest.get_id('bob'),
+                                'carol': stats.get_id('carol')}
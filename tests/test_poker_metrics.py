@@ -0,0 +1,53 @@
+import pytest
+
+import calculate_statistics as cs
+import extract
+import load
+import poker_metrics
+
+UNFILTERED_QUERY = """
+    SELECT pt.start_date, p.player, pt.hand_id, pt.big_blind, pt.n_active_players, ps.cohort
+    FROM player_timestamps AS pt JOIN players AS p ON pt.player_id = p.player_id
+        LEFT JOIN player_stats AS ps ON pt.player_id = ps.player_id
+"""
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory, handhistory_folder):
+    url = f"sqlite:///{tmp_path_factory.mktemp('metrics') / 'hands.db'}"
+    extract.ExtractHandhistories(database_url=url).extract_folders(handhistory_folder)
+    db = load.DataBaseManagement(url)
+    cs.PokerStats(db).update_stats_from_xml()
+    # some regs, their rows are only kept at tables with at least min_active_players
+    db.mysql_query("UPDATE player_stats SET cohort = 'reg_aggro' WHERE player_id % 3 = 0")
+    return db
+
+
+def filtered_in_pandas(db, metrics):
+    """The rows of load_player_data_from_DB, filtered after reading all of them."""
+    rows = db.get_table_as_df(UNFILTERED_QUERY, index_col='start_date', parse_dates=['start_date'])
+    regs = rows['cohort'].isin(poker_metrics.REG_COHORTS)
+    return rows[~rows['player'].isin(metrics.unknown_players + metrics.hero)
+                & rows['big_blind'].between(round(metrics.min_bigblind * 100), round(metrics.max_bigblind * 100))
+                & (rows['n_active_players'] <= metrics.max_active_players)
+                & (~regs | (rows['n_active_players'] >= metrics.min_active_players))]
+
+
+def sorted_rows(rows):
+    return rows.reset_index().astype({'player': str}).sort_values(['hand_id', 'player']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('filters', [{}, {'min_bigblind': 1, 'max_bigblind': 2, 'min_active_players': 4,
+                                          'max_active_players': 5}, {'min_active_players': 6}])
+def test_sql_filters_give_the_rows_of_the_pandas_filters(db, filters):
+    metrics = poker_metrics.PokerMetrics(db, **filters)
+    rows = metrics.load_player_data_from_DB()
+    expected = filtered_in_pandas(db, metrics)
+    assert len(rows) and len(rows) < len(db.get_table_as_df(UNFILTERED_QUERY))
+    assert sorted_rows(rows).equals(sorted_rows(expected))
+
+
+def test_only_the_requested_columns_are_read(db):
+    rows = poker_metrics.PokerMetrics(db).load_player_data_from_DB(return_only_columns=['player', 'cohort'])
+    assert list(rows.columns) == ['player', 'cohort']
+    assert rows.index.name == 'start_date'
@@ -0,0 +1,25 @@
+import pytest
+
+import extract
+import load
+import query_plans
+
+
+@pytest.fixture(scope='module')
+def db_connection(tmp_path_factory, handhistory_folder):
+    url = f"sqlite:///{tmp_path_factory.mktemp('plans') / 'hands.db'}"
+    extract.ExtractHandhistories(database_url=url).extract_folders(handhistory_folder)
+    return load.DataBaseManagement(url)
+
+
+def test_builtin_queries_are_the_ones_which_run(db_connection):
+    queries, params = query_plans.builtin_queries(db_connection)
+    assert 'stats_new_players_on_flop' in queries and 'cube_all_hand_actions' in queries
+    assert ':ingest_id' in queries['stats_new_hand_id_pages']
+    # the player filter of PokerMetrics binds every excluded player
+    assert 'excluded_player_0' in params
+
+
+def test_builtin_queries_use_indexes(db_connection):
+    report = query_plans.explain_builtin_queries(db_connection)
+    assert {name: full_scans for name, full_scans in report.items() if full_scans} == {}
@@ -0,0 +1,47 @@
+import raw_store
+import transform
+
+
+def _with_ids(hands):
+    return [(transform.find_hand_id(hand), hand) for hand in hands]
+
+
+def test_append_commit_reopen_get(tmp_path, sample_hands):
+    hands = dict(_with_ids(sample_hands[:50]))
+    path = str(tmp_path / 'raw')
+    # a small segment size so the hands are spread over several segment files
+    store = raw_store.RawHandStore(path, segment_size=16 * 1024)
+    assert store.append(hands.items()) == len(hands)
+    first_id = next(iter(hands))
+    # appended hands are known at once, they can be read after the commit
+    assert first_id in store and len(store) == len(hands)
+    assert store.get(first_id) is None
+    store.commit()
+    assert bytes(store.get(first_id)) == hands[first_id].encode('UTF-8')
+    # a hand which is in the store already is not appended again
+    assert store.append([(first_id, hands[first_id])]) == 0
+    store.close()
+
+    reopened = raw_store.RawHandStore(path, segment_size=16 * 1024)
+    assert len(reopened) == len(hands)
+    assert len({segment for segment in reopened.index['segment'].tolist()}) > 1
+    missing_id = max(hands) + 1
+    assert missing_id not in reopened and reopened.get(missing_id) is None
+    assert reopened.get_text([*hands, missing_id]) == hands
+    assert set(reopened.get_many(list(hands)[:5])) == set(list(hands)[:5])
+    reopened.close()
+
+
+def test_append_after_reopen(tmp_path, sample_hands):
+    hands = dict(_with_ids(sample_hands[:20]))
+    path = str(tmp_path / 'raw')
+    ids = list(hands)
+    store = raw_store.RawHandStore(path)
+    store.append((hand_id, hands[hand_id]) for hand_id in ids[:10])
+    store.close()
+
+    store = raw_store.RawHandStore(path)
+    assert store.append(hands.items()) == 10
+    store.commit()
+    assert store.get_text(ids) == hands
+    store.close()
@@ -0,0 +1,145 @@
+import pytest
+
+import calculate_statistics
+import extract
+import load
+import stat_plugins
+import transform
+
+EXTRA_PLUGINS = [name for name in stat_plugins.STAT_PLUGINS if name not in stat_plugins.CORE_STAT_PLUGINS]
+
+
+def count(parsed_hands, names):
+    stat_counter = stat_plugins.StatCounter(names)
+    counters = {}
+    for parsed_hand in parsed_hands:
+        stat_counter.count_hand(parsed_hand, counters)
+    columns = stat_plugins.counter_names(names)
+    return {player: dict(zip(columns, player_counters)) for player, player_counters in counters.items()}
+
+
+@pytest.fixture(scope='module')
+def parsed_hands(sample_hands):
+    return [transform.parse_hand(hand) for hand in sample_hands]
+
+
+@pytest.fixture(scope='module')
+def all_counters(parsed_hands):
+    return count(parsed_hands, EXTRA_PLUGINS)
+
+
+@pytest.mark.parametrize('name', EXTRA_PLUGINS)
+def test_plugin_alone_counts_like_with_all_others(parsed_hands, all_counters, name):
+    alone = count(parsed_hands, [name])
+    counters = stat_plugins.STAT_PLUGINS[name].counters
+    for player, player_counters in all_counters.items():
+        expected = {counter: player_counters[counter] for counter in counters}
+        got = {counter: alone.get(player, {}).get(counter, 0) for counter in counters}
+        assert got == expected, player
+
+
+def test_not_everyone_who_saw_the_flop_went_to_showdown(all_counters):
+    saw_flop = sum(player_counters['saw_flop'] for player_counters in all_counters.values())
+    went_to_showdown = sum(player_counters['went_to_showdown'] for player_counters in all_counters.values())
+    assert 0 < went_to_showdown < saw_flop
+
+
+SB, BB = stat_plugins.SMALL_BLIND, stat_plugins.BIG_BLIND
+FOLD, CALL, CHECK, BET, RAISE, ALL_IN = (stat_plugins.FOLD, stat_plugins.CALL, stat_plugins.CHECK, stat_plugins.BET,
+                                         stat_plugins.RAISE, stat_plugins.ALL_IN)
+# (gamecode, winner, actions of the rounds 1 (preflop) to 4) of hands with known outcomes, the blinds are posted
+# by bob and carol in round 0, the actions put in €1 if no amount is given
+KNOWN_HANDS = [
+    # alice opens, bob 3-bets, carol folds and alice folds to the 3-bet
+    (1001, 'bob', [[('alice', RAISE), ('bob', RAISE), ('carol', FOLD), ('alice', FOLD)]]),
+    # alice opens, bob calls, alice c-bets and both go to showdown
+    (1002, 'alice', [[('alice', RAISE), ('bob', CALL), ('carol', FOLD)],
+                     [('bob', CHECK), ('alice', BET), ('bob', CALL)],
+                     [('bob', CHECK), ('alice', CHECK)],
+                     [('bob', CHECK), ('alice', CHECK)]]),
+    # alice opens, bob calls, alice c-bets and bob folds the flop
+    (1003, 'alice', [[('alice', RAISE), ('bob', CALL), ('carol', FOLD)],
+                     [('bob', CHECK), ('alice', BET), ('bob', FOLD)]]),
+]
+KNOWN_COUNTERS = {
+    'alice': {'three_bet_opportunities': 0, 'three_bets': 0, 'fold_to_three_bet_opportunities': 1,
+              'folds_to_three_bet': 1, 'cbet_opportunities': 2, 'cbets': 2, 'postflop_aggressive_actions': 2,
+              'postflop_calls': 0, 'went_to_showdown': 1},
+    'bob': {'three_bet_opportunities': 3, 'three_bets': 1, 'fold_to_three_bet_opportunities': 0,
+            'folds_to_three_bet': 0, 'cbet_opportunities': 0, 'cbets': 0, 'postflop_aggressive_actions': 0,
+            'postflop_calls': 1, 'went_to_showdown': 1},
+    'carol': {'three_bet_opportunities': 2, 'three_bets': 0, 'fold_to_three_bet_opportunities': 0,
+              'folds_to_three_bet': 0, 'cbet_opportunities': 0, 'cbets': 0, 'postflop_aggressive_actions': 0,
+              'postflop_calls': 0, 'went_to_showdown': 0},
+}
+
+
+def hand_xml(gamecode, winner, rounds):
+    players = ''.join(f'<player dealer="{int(name == "alice")}" bet="€1" seat="{seat}" chips="€100" name="{name}" '
+                      f'win="{"€3" if name == winner else "€0"}"/>'
+                      for seat, name in enumerate(['alice', 'bob', 'carol'], start=1))
+    action_no = 2
+    round_xml = ['<round no="0"><action no="1" type="1" sum="€0,50" player="bob"/>'
+                 '<action no="2" type="2" sum="€1" player="carol"/></round>']
+    for round_no, actions in enumerate(rounds, start=1):
+        round_actions = ''
+        for player, action_type, *amount in actions:
+            action_no += 1
+            round_actions += (f'<action no="{action_no}" type="{action_type}" sum="€{amount[0] if amount else 1}" '
+                              f'player="{player}"/>')
+        round_xml.append(f'<round no="{round_no}">{round_actions}</round>')
+    return (f'<root><general><mode>real</mode><gametype>Holdem NL €0,50/€1</gametype>'
+            f'<tablename>Test 1, 1</tablename><tablecurrency>EUR</tablecurrency><smallblind>€0,50</smallblind>'
+            f'<bigblind>€1</bigblind><startdate>2023-08-11 06:41:43</startdate></general>'
+            f'<game gamecode="{gamecode}"><general><startdate>2023-08-11 06:41:43</startdate>'
+            f'<players>{players}</players></general>{"".join(round_xml)}</game></root>')
+
+
+def plugin_counters(counters):
+    return {player: {counter: player_counters[counter] for counter in KNOWN_COUNTERS['alice']}
+            for player, player_counters in counters.items()}
+
+
+@pytest.mark.parametrize('backend', transform.PARSER_BACKENDS)
+def test_known_three_bet_cbet_and_showdown_outcomes(backend):
+    parsed_hands = [transform.parse_hand(hand_xml(*hand), backend) for hand in KNOWN_HANDS]
+    assert plugin_counters(count(parsed_hands, EXTRA_PLUGINS)) == KNOWN_COUNTERS
+
+
+def test_stored_stats_have_the_plugin_counters(tmp_path):
+    folder = tmp_path / 'hands' / 'table'
+    folder.mkdir(parents=True)
+    (folder / 'hands.xml').write_text('\n'.join(hand_xml(*hand) for hand in KNOWN_HANDS), encoding='UTF-8')
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extract.ExtractHandhistories(database_url=url).extract_folders(str(tmp_path / 'hands'))
+    db = load.DataBaseManagement(url)
+    # counted from the actions tables, without parsing the xml
+    calculate_statistics.PokerStats(db).update_stats_from_xml()
+
+    stored = db.get_table_as_df('SELECT p.player, s.* FROM player_stats AS s JOIN players AS p '
+                                'ON p.player_id = s.player_id', index_col='player')
+    assert plugin_counters(stored.to_dict(orient='index')) == KNOWN_COUNTERS
+    assert stored.loc['bob', 'three_bet'] == 33 and stored.loc['alice', 'cbet'] == 100
+    assert stored.loc['alice', 'wtsd'] == 50
+
+
+def test_all_in_counts_as_raise_only_when_it_raises():
+    hands = [
+        # bob 3-bets all-in from the small blind, alice folds to it
+        (1004, 'bob', [[('alice', RAISE, 3), ('bob', ALL_IN, 99), ('carol', FOLD), ('alice', FOLD)]]),
+        # bob calls the c-bet all-in for less, carol's all-in over alice's open is a 3-bet
+        (1005, 'alice', [[('alice', RAISE, 3), ('bob', CALL, '2,50'), ('carol', ALL_IN, 10), ('alice', CALL, 7),
+                          ('bob', CALL, 7)],
+                         [('bob', CHECK), ('alice', BET, 50), ('bob', ALL_IN, 20)]]),
+    ]
+    parsed_hands = [transform.parse_hand(hand_xml(*hand)) for hand in hands]
+    counters = plugin_counters(count(parsed_hands, EXTRA_PLUGINS))
+    assert counters['bob']['three_bets'] == 1 and counters['carol']['three_bets'] == 1
+    assert counters['alice']['fold_to_three_bet_opportunities'] == 2
+    assert counters['alice']['folds_to_three_bet'] == 1
+    # bob faced the open raise in both hands, carol's all-in came after bob's call to the open
+    assert counters['bob']['three_bet_opportunities'] == 2 and counters['carol']['three_bet_opportunities'] == 1
+    # the preflop aggressor is carol, who had no flop action, so alice's bet is no c-bet
+    assert counters['alice']['cbet_opportunities'] == 0
+    assert counters['alice']['postflop_aggressive_actions'] == 1
+    assert counters['bob']['postflop_aggressive_actions'] == 0 and counters['bob']['postflop_calls'] == 1
@@ -0,0 +1,47 @@
+import pytest
+
+import calculate_statistics as cs
+import extract
+import load
+
+
+def stored_stats(db):
+    return db.get_table_as_df('SELECT * FROM player_stats ORDER BY player_id').reset_index(drop=True)
+
+
+def test_incremental_stats_equal_a_full_recompute(tmp_path, split_hand_folders, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extractor = extract.ExtractHandhistories(database_url=url, flush_every_hands=400)
+    db = load.DataBaseManagement(url)
+    poker_stats = cs.PokerStats(db)
+
+    extractor.extract_folders(split_hand_folders[0])
+    # without a watermark all hands are counted
+    poker_stats.update_stats_incremental()
+    assert db.get_watermark(cs.STATS_WATERMARK) == db.last_ingest_id()
+
+    extractor.extract_folders(split_hand_folders[1])
+    with monkeypatch.context() as patch:
+        patch.setattr(poker_stats, 'update_stats_from_xml', lambda **kwargs: pytest.fail('all hands were counted'))
+        poker_stats.update_stats_incremental()
+    assert db.get_watermark(cs.STATS_WATERMARK) == db.last_ingest_id()
+    incremental = stored_stats(db)
+
+    poker_stats.update_stats_from_xml()
+    assert incremental.equals(stored_stats(db))
+
+
+def test_incremental_stats_without_new_hands_stay_the_same(tmp_path, split_hand_folders):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extractor = extract.ExtractHandhistories(database_url=url)
+    db = load.DataBaseManagement(url)
+    poker_stats = cs.PokerStats(db)
+    for folder in split_hand_folders:
+        extractor.extract_folders(folder)
+    poker_stats.update_stats_from_xml()
+    full = stored_stats(db)
+
+    # the hands of a second ingestion are all duplicates
+    extractor.extract_folders(split_hand_folders[0])
+    poker_stats.update_stats_incremental()
+    assert stored_stats(db).equals(full)
@@ -0,0 +1,55 @@
+import pytest
+
+import calculate_statistics as cs
+import extract
+import load
+
+
+def stored_cube(db):
+    return db.get_table_as_df('SELECT * FROM player_stats_cube').sort_values(cs.CUBE_KEYS).reset_index(drop=True)
+
+
+def by_player(stats):
+    return stats.sort_values('player_id').reset_index(drop=True)
+
+
+@pytest.fixture
+def db(tmp_path, split_hand_folders):
+    url = f"sqlite:///{tmp_path / 'hands.db'}"
+    extractor = extract.ExtractHandhistories(database_url=url, flush_every_hands=400)
+    db = load.DataBaseManagement(url)
+    poker_stats = cs.PokerStats(db)
+    extractor.extract_folders(split_hand_folders[0])
+    poker_stats.update_stats_cube()
+    # the cells of the second ingestion are added to the stored ones
+    extractor.extract_folders(split_hand_folders[1])
+    poker_stats.update_stats_cube()
+    return db
+
+
+def test_incremental_cube_equals_a_full_count(db):
+    incremental = stored_cube(db)
+    db.mysql_query(f"DELETE FROM stats_watermarks WHERE name = '{cs.CUBE_WATERMARK}'")
+    cs.PokerStats(db).update_stats_cube()
+    assert incremental.equals(stored_cube(db))
+
+
+def test_unfiltered_cube_sums_equal_the_player_stats(db):
+    poker_stats = cs.PokerStats(db, min_active_players=0, max_active_players=100, max_bigblind=100000)
+    poker_stats.update_stats_from_xml()
+    player_stats = db.get_table_as_df('SELECT * FROM player_stats')
+    from_cube = by_player(poker_stats.stats_from_cube())
+    assert from_cube.equals(by_player(player_stats[player_stats['hands'] > 0])[from_cube.columns])
+
+
+def test_filtered_cube_sums_equal_the_count_of_the_filtered_hands(db):
+    cube = stored_cube(db)
+    big_blind = cube.groupby('big_blind')['hands'].sum().idxmax()
+    poker_stats = cs.PokerStats(db, min_bigblind=big_blind / 100, max_bigblind=big_blind / 100,
+                                min_active_players=3, max_active_players=6)
+    counts = poker_stats._count_hands(condition=(
+        'hh.hand_id IN (SELECT hand_id FROM hand_info WHERE big_blind = :big_blind '
+        'AND n_active_players BETWEEN 3 AND 6)'), params={'big_blind': int(big_blind)})
+    expected = poker_stats.stats_from_counts(counts, key='player_id')
+    from_cube = by_player(poker_stats.stats_from_cube())
+    assert len(from_cube) and from_cube.equals(by_player(expected[expected['hands'] > 0]))
@@ -1,15 +1,136 @@
+import re
+import html
 import xml.etree.ElementTree as ET
+from datetime import datetime
+from typing import NamedTuple, Optional
 import pandas as pd
 
-import load
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
+DEFAULT_PARSER_BACKEND = 'etree'
+# the tags of the session header which go into hand_info
+HEADER_FIELDS = ('mode', 'gametype', 'tablename', 'tablecurrency', 'smallblind', 'bigblind')
+
+
+def euro_to_cents(euro_string):
+    """Convert an amount of the handhistory like '€1.234,56' to integer cents."""
+    return round(float(euro_string.replace('€', '').replace('.', '').replace(',', '.')) * 100)
+
+
+def parse_start_date(date_string):
+    return datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
+
+
+class PlayerRow(NamedTuple):
+    """One player of a hand, the amounts in cents."""
+    name: str
+    player_no: int
+    seat: int
+    dealer: int
+    bet: int
+    win: int
+    chips: int
+    first_preflop_action: Optional[int]  # type of the first action in round 1, None if the player had none
+    saw_flop: bool  # the player had an action in round 2
+
+
+class ActionRow(NamedTuple):
+    round_no: int
+    action_no: int
+    action_type: int
+    amount: int  # cents
+    player: str
+
+
+class ParsedHand(NamedTuple):
+    """Everything derived from one hand, filled by a single walk over its tree in PokerDataParser.parse()."""
+    hand_info: dict
+    players: tuple  # of PlayerRow, in the order of the handhistory
+    actions: tuple  # of ActionRow, in the order of the handhistory
+
+    @property
+    def hand_id(self):
+        return self.hand_info['hand_id']
+
+    def player_timestamps(self):
+        hand_info = self.hand_info
+        return [{'player': player.name,
+                 'hand_id': hand_info['hand_id'],
+                 'start_date': hand_info['start_date'],
+                 'big_blind': hand_info['big_blind'],
+                 'n_active_players': hand_info['n_active_players']} for player in self.players]
+
+    def action_rows(self):
+        return [{'hand_id': self.hand_id, **action._asdict()} for action in self.actions]
+
+    def hand_player_rows(self):
+        return [{'hand_id': self.hand_id, 'player': player.name, 'player_no': player.player_no, 'seat': player.seat,
+                 'dealer': player.dealer, 'bet': player.bet, 'win': player.win, 'chips': player.chips}
+                for player in self.players]
+
+
+class HandParseError(ValueError):
+    """The hand is no readable xml, raised by every parser backend."""
+
+
+def build_parsed_hand(gamecode, header, start_date, player_attributes, round_nos, actions):
+    """
+    Build the ParsedHand from what a parser backend found in the hand, so all backends give the same result.
+
+    :param header: dict of the tags of HEADER_FIELDS -> their text in the session header
+    :param start_date: text of the startdate of the game
+    :param player_attributes: attribute dicts of the players, in the order of the handhistory
+    :param round_nos: numbers of all rounds
+    :param actions: (round_no, attribute dict) of every action, in the order of the handhistory
+    """
+    action_rows = []
+    first_preflop_actions = {}
+    players_on_flop = set()
+    for round_no, attributes in actions:
+        player_name = attributes['player']
+        action_type = int(attributes['type'])
+        action_rows.append(ActionRow(round_no, int(attributes['no']), action_type,
+                                     euro_to_cents(attributes['sum']), player_name))
+        if round_no == 1:
+            first_preflop_actions.setdefault(player_name, action_type)
+        elif round_no == 2:
+            players_on_flop.add(player_name)
+
+    players = tuple(PlayerRow(name=attributes['name'],
+                              player_no=player_no,
+                              seat=int(attributes['seat']),
+                              dealer=int(attributes['dealer']),
+                              bet=euro_to_cents(attributes['bet']),
+                              win=euro_to_cents(attributes['win']),
+                              chips=euro_to_cents(attributes['chips']),
+                              first_preflop_action=first_preflop_actions.get(attributes['name']),
+                              saw_flop=attributes['name'] in players_on_flop)
+                    for player_no, attributes in enumerate(player_attributes))
+    hand_info = {
+        'hand_id': int(gamecode),
+        'start_date': parse_start_date(start_date),
+        'mode': header['mode'],
+        'game_type': header['gametype'],
+        'table_name': header['tablename'],
+        'table_currency': header['tablecurrency'],
+        'small_blind': euro_to_cents(header['smallblind']),
+        'big_blind': euro_to_cents(header['bigblind']),
+        'n_active_players': len(players),
+        'last_round': max(round_nos, default=None)
+    }
+    return ParsedHand(hand_info, players, tuple(action_rows))
 
 
 class PokerDataParser:
-    def __init__(self, handhistory):
+    def __init__(self, handhistory, root=None):
+        self._parsed = None
         try:
             self.hand_history = handhistory
-            self.root = ET.fromstring(handhistory)
+            # reuse an already parsed tree, so each hand is parsed only once
+            self.root = root if root is not None else ET.fromstring(handhistory)
             self.general_info = self.root.find('general')
             self.game_info = self.root.find('game')
         except Exception as e:
@@ -18,32 +139,173 @@ class PokerDataParser:
             Error: {e}
         """)
 
+    def parse(self):
+        """Return the ParsedHand of the hand, the tree is walked only on the first call."""
+        if self._parsed is None:
+            self._parsed = self._walk()
+        return self._parsed
+
+    def _walk(self):
+        start_date = None
+        player_attributes = []
+        round_nos = []
+        actions = []
+        for element in self.game_info:
+            if element.tag == 'general':
+                for child in element:
+                    if child.tag == 'startdate':
+                        start_date = child.text
+                    elif child.tag == 'players':
+                        player_attributes = [player.attrib for player in child.iterfind('player')]
+            elif element.tag == 'round':
+                round_no = int(element.attrib['no'])
+                round_nos.append(round_no)
+                actions.extend((round_no, action.attrib) for action in element.iterfind('action'))
+        header = {tag: self.general_info.findtext(tag) for tag in HEADER_FIELDS}
+        return build_parsed_hand(self.game_info.attrib["gamecode"], header, start_date, player_attributes,
+                                 round_nos, actions)
+
+    # the table rows of the hand, all from the same parse()
     def parse_hand_information(self):
-        data = {
-            'hand_id': self.game_info.attrib["gamecode"],
-            'start_date': self.game_info.find('general/startdate').text,
-            'mode': self.general_info.find('mode').text,
-            'game_type': self.general_info.find('gametype').text,
-            'table_name': self.general_info.find('tablename').text,
-            'table_currency': self.general_info.find('tablecurrency').text,
-            'small_blind': self.general_info.find('smallblind').text.replace('€', ""),
-            'big_blind': self.general_info.find('bigblind').text.replace('€', ""),
-            'n_active_players': len(self.root.find('.//players').findall('player'))
-        }
-        return data
+        return self.parse().hand_info
 
     def parse_date_of_each_player(self):
-        # extract player, start_date, hand_id, limit
-        player_list = []
-        hand_id = self.game_info.attrib["gamecode"]
-        start_date = self.game_info.find('general/startdate').text
-        big_blind = self.general_info.find('bigblind').text.replace('€', "")
-        for player in self.root.findall('.//players/player'):
-            player_list.append({
-                'player_name': player.attrib['name'],
-                'hand_id': hand_id,
-                'start_date': start_date,
-                'big_blind': big_blind,
-                'n_active_players': len(self.root.find('.//players').findall('player'))
-            })
-        return player_list
+        return self.parse().player_timestamps()
+
+    def parse_actions(self):
+        return self.parse().action_rows()
+
+    def parse_hand_players(self):
+        return self.parse().hand_player_rows()
+
+
+# _____________________parser backends____________________________
+# a backend is a function hand xml -> ParsedHand, they all give the same result for the same hand
+
+def parse_etree(hand):
+    try:
+        root = ET.fromstring(hand)
+    except ET.ParseError as e:
+        raise HandParseError(f"Cannot parse the hand: {e}") from e
+    return PokerDataParser(hand, root=root).parse()
+
+
+# the elements which go into the ParsedHand, lxml filters them in C while iterating over the tree
+_LXML_TAGS = ('game', 'startdate', 'player', 'round', 'action', *HEADER_FIELDS)
+
+
+def parse_lxml(hand):
+    """
+    Parse a hand with lxml. Instead of the find calls of the etree walk it iterates once over the elements of
+    _LXML_TAGS and copies their attributes with items(), which is faster than reading lxml's attrib proxies.
+    """
+    try:
+        root = lxml_etree.fromstring(hand.encode('UTF-8'))
+    except lxml_etree.XMLSyntaxError as e:
+        raise HandParseError(f"Cannot parse the hand: {e}") from e
+    gamecode = None
+    header = {}
+    start_date = None
+    player_attributes = []
+    round_nos = []
+    actions = []
+    round_no = None
+    for element in root.iter(_LXML_TAGS):
+        tag = element.tag
+        if tag == 'action':
+            actions.append((round_no, dict(element.items())))
+        elif tag == 'player':
+            player_attributes.append(dict(element.items()))
+        elif tag == 'round':
+            round_no = int(element.get('no'))
+            round_nos.append(round_no)
+        elif tag == 'game':
+            gamecode = element.get('gamecode')
+        elif gamecode is None:
+            # the tags of the session header come before the game
+            header.setdefault(tag, element.text)
+        elif tag == 'startdate':
+            start_date = element.text
+    if gamecode is None:
+        raise HandParseError("Cannot parse the hand: no <game> element")
+    return build_parsed_hand(gamecode, {tag: header.get(tag) for tag in HEADER_FIELDS}, start_date,
+                             player_attributes, round_nos, actions)
+
+
+_GAME_TAG = re.compile(r'<game\b([^>]*)>')
+_GAME_ELEMENT_TAG = re.compile(r'<(round|action|player)\b([^>]*)>')
+_ATTRIBUTE = re.compile(r'([\w.:-]+)\s*=\s*(["\'])(.*?)\2', re.DOTALL)
+_STARTDATE = re.compile(r'<startdate>([^<]*)</startdate>')
+_HEADER_TEXTS = {tag: re.compile(rf'<{tag}>([^<]*)</{tag}>') for tag in HEADER_FIELDS}
+
+
+def _unescape(value):
+    return html.unescape(value) if '&' in value else value
+
+
+def _attributes(tag_content):
+    if '&' not in tag_content:
+        return {name: value for name, _, value in _ATTRIBUTE.findall(tag_content)}
+    return {name: html.unescape(value) for name, _, value in _ATTRIBUTE.findall(tag_content)}
+
+
+def _header_text(header, tag):
+    match = _HEADER_TEXTS[tag].search(header)
+    return _unescape(match.group(1)) if match else None
+
+
+def parse_scanner(hand):
+    """
+    Parse a hand with regular expressions, specialized for the iPoker schema.
+
+    It only reads the tags which go into the ParsedHand and builds no tree, the hand is expected to be well formed.
+    """
+    game = _GAME_TAG.search(hand)
+    if game is None:
+        raise HandParseError("Cannot parse the hand: no <game> element")
+    header = hand[:game.start()]
+    start_date = _STARTDATE.search(hand, game.end())
+    if start_date is None:
+        raise HandParseError("Cannot parse the hand: no <startdate> in the game")
+
+    player_attributes = []
+    round_nos = []
+    actions = []
+    round_no = None
+    for tag, tag_content in _GAME_ELEMENT_TAG.findall(hand, game.end()):
+        attributes = _attributes(tag_content)
+        if tag == 'action':
+            actions.append((round_no, attributes))
+        elif tag == 'round':
+            round_no = int(attributes['no'])
+            round_nos.append(round_no)
+        else:
+            player_attributes.append(attributes)
+    return build_parsed_hand(_attributes(game.group(1))['gamecode'],
+                             {tag: _header_text(header, tag) for tag in HEADER_FIELDS},
+                             _unescape(start_date.group(1)), player_attributes, round_nos, actions)
+
+
+PARSER_BACKENDS = {'etree': parse_etree, 'lxml': parse_lxml, 'scanner': parse_scanner}
+
+
+def get_parser(backend=DEFAULT_PARSER_BACKEND):
+    """Return the parse function of the backend: 'etree' (stdlib), 'lxml' or 'scanner'."""
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend {backend}, use one of {list(PARSER_BACKENDS)}")
+    if backend == 'lxml' and lxml_etree is None:
+        raise ImportError("The lxml parser backend needs the lxml package")
+    return PARSER_BACKENDS[backend]
+
+
+def parse_hand(hand, backend=DEFAULT_PARSER_BACKEND):
+    return get_parser(backend)(hand)
+
+
+def find_hand_id(hand):
+    """The hand_id of a hand which could not be parsed."""
+    game = _GAME_TAG.search(hand)
+    gamecode = _attributes(game.group(1)).get('gamecode') if game else None
+    if gamecode is None:
+        raise HandParseError("Cannot find the gamecode of the hand")
+    return int(gamecode)